@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import gc
+import logging
+
+import pytest
+
+from thd74tool.thd74.aio import AsyncTHDProtocol
+
+simulator = pytest.importorskip("thd74tool.thd74.simulator", reason="the simulator needs POSIX pseudo-terminals")
+
+
+@pytest.fixture
+def sim():
+    s, = simulator.start(1, mode="pcrig", firmware_version="1.23")
+    yield s
+    s.stop()
+    s.join(1.0)
+
+
+def test_detect_and_close(sim, caplog):
+    async def session():
+        async with AsyncTHDProtocol(sim.tty) as p:
+            assert p.pcrig_mode and p.model == "TH-D74"
+            assert await p.get_firmware_version() == "1.23"
+            with pytest.raises(TimeoutError):
+                await p.conn.read(1, 0)  # zero means no waiting, not the default timeout
+
+            reader = asyncio.ensure_future(p.conn.read(1, 5.0))
+            await asyncio.sleep(0.05)
+            p.close()
+            with pytest.raises(ConnectionError):
+                await reader
+            p.conn.flush_input()
+            with pytest.raises(ConnectionError):
+                p.conn.write(b"ID\r")
+
+    with caplog.at_level(logging.ERROR, logger="asyncio"):
+        asyncio.run(session())
+        gc.collect()
+    assert [r.getMessage() for r in caplog.records if r.name == "asyncio"] == []
+
+
+def test_hangup_wakes_reader(sim):
+    async def session():
+        p = AsyncTHDProtocol(sim.tty)
+        await p.connect()
+        reader = asyncio.ensure_future(p.conn.read_until(b"\r", 5.0))
+        await asyncio.sleep(0.05)
+        sim.stop()
+        sim.join(1.0)
+        with pytest.raises(ConnectionError):
+            await reader
+        assert p.conn.s is None
+
+    asyncio.run(session())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from binascii import hexlify
+
+from thd74tool.thd74.crypto import blob_offsets, decrypt_blob, decrypt_blob_buffer, decrypt_blob_lines, decrypt_line, \
+    decrypt_lines, encrypt_line
+from thd74tool.thd74.synth import make_record
+
+
+def test_decrypt_lines_matches_decrypt_line():
+    lines = ["0" * n for n in (11, 15, 43)] + ["F" * 43, "0123456789ABCDEF0123456789ABCDEF0123456789A", "1234"]
+    for i in (0, 1, 49, 171, 255, 300):
+        assert decrypt_lines(lines, [i] * len(lines)) == [decrypt_line(line, i) for line in lines]
+        assert [encrypt_line(decrypt_line(line, i), i).upper() for line in lines] == lines
+
+
+def make_records(seed: int = 0) -> list:
+    # Two blocks with 16-byte data records, then 2-byte data records like in CHECKBYTES,
+    # which have the same 15-char length as block headers
+    records = []
+    for block in range(2):
+        records.append(make_record(0, 4, bytes([0, block])))
+        for n in range(20):
+            records.append(make_record(n * 16, 0, bytes((seed + block + n + k) % 256 for k in range(16))))
+    for n in range(5):
+        records.append(make_record(n * 2, 0, bytes([n, 0xa5])))
+    records.append(make_record(0, 1))
+    return records
+
+
+def encrypt_records(records: list, start_offset: int) -> list:
+    plain = [hexlify(r).decode("ascii")[1:] for r in records]
+    return [encrypt_line(p, i).upper() for p, i in zip(plain, blob_offsets(plain, start_offset))]
+
+
+def record_lines(records: bytes, lengths: list) -> list:
+    # The high nibble of each record's padding byte is undefined
+    lines = []
+    pos = 0
+    for length in lengths:
+        lines.append(hexlify(records[pos:pos + length]).decode("ascii")[1:])
+        pos += length
+    return lines
+
+
+def test_decrypt_blob_buffer_matches_decrypt_blob():
+    for start_offset in [0, 0x51, 0xff]:
+        records = make_records(start_offset)
+        lines = encrypt_records(records, start_offset)
+        reference = list(decrypt_blob(lines, start_offset))
+        assert reference == [hexlify(r).decode("ascii")[1:] for r in records]
+        records = decrypt_blob_buffer("\r\n".join(lines).encode("ascii"), start_offset)
+        assert record_lines(records, [len(r) for r in make_records(start_offset)]) == reference
+
+
+def test_decrypt_blob_lines_from_second_block():
+    records = make_records()
+    lines = encrypt_records(records, 7)
+    decrypted = decrypt_blob_lines([line.encode("ascii") for line in lines[21:]], 7, first_block=1)
+    assert record_lines(decrypted, [len(r) for r in records[21:]]) == list(decrypt_blob(lines, 7))[21:]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import pytest
+
+from thd74tool.thd74 import flash, fwprog
+from thd74tool.thd74.device import THD74
+from thd74tool.thd74.plan import data_nouns, message_size, page_wire_size, plan_flash
+
+from .test_plan import flash_sections, make_targets
+
+simulator = pytest.importorskip("thd74tool.thd74.simulator", reason="the simulator needs POSIX pseudo-terminals")
+
+
+@pytest.fixture
+def simulators():
+    started = []
+
+    def start(count: int = 1, **kwargs):
+        started.extend(simulator.start(count, mode="fwprog", busy_time=0.05, busy_interval=0.02, **kwargs))
+        return started[-count:]
+
+    yield start
+    for s in started:
+        s.stop()
+    for s in started:
+        s.join(1.0)
+
+
+def flat_images(targets: dict) -> dict:
+    return dict((name, (image.span[0], bytes(image.flatten()[1]))) for name, image in targets.items())
+
+
+def test_flash_round_trip(simulators, caplog):
+    targets = make_targets()
+    plan = plan_flash(flash_sections, targets)
+    sim, = simulators(1)
+    device = THD74(sim.tty, 0.2)
+    assert device.is_fwprog_mode
+
+    with caplog.at_level(logging.WARNING):
+        result = flash.flash_device(device, flat_images(targets), plan, depth=2)
+    device.close()
+    assert result["ok"], result["error"]
+    assert result["attempts"] == 1
+    assert result["bytes"] == len(plan[0]["pages"]) * page_wire_size() + \
+        message_size(data_nouns + 2) + message_size(data_nouns + 32)
+    assert sim.received[:4] == [fwprog.PROGRAM, 0xa0, 0x31, 0x33]
+    assert sim.received[-1] == fwprog.FINISH
+    assert sim.flash.verify(targets) == []
+    assert [r for r in caplog.records if r.levelno >= logging.WARNING] == []
+
+
+def test_retry_enters_command_mode_again(simulators):
+    targets = make_targets(3)
+    plan = plan_flash(flash_sections, targets)
+    sim, = simulators(1, fail_setups=1)
+    device = THD74(sim.tty, 0.2)
+    result = flash.flash_device(device, flat_images(targets), plan, retries=1)
+    device.close()
+    assert result["ok"], result["error"]
+    assert result["attempts"] == 2
+    assert sim.sessions == 2
+    assert sim.flash.verify(targets) == []
+
+
+@pytest.mark.parametrize("depth", [1, 128])
+def test_busy_while_streaming(simulators, caplog, depth):
+    # With one page per write, BUSY is picked up between writes once the simulator
+    # falls behind. With all pages in one write, it arrives while waiting for the 0x46 reply.
+    targets = make_targets(2)
+    address = targets["FIRMWARE"].span[1]
+    targets["FIRMWARE"].add(address, bytes(range(256)) * 4 * 120)
+    plan = plan_flash(flash_sections, targets)
+    sim, = simulators(1, busy_pages=16)
+    device = THD74(sim.tty, 0.2)
+    device.comm.cmd_mode()
+    writer = flash.FlashWriter(device.comm, device.comm.key, depth, max_depth=depth, busy_timeout=2.0)
+    with caplog.at_level(logging.DEBUG, logger=flash.__name__):
+        writer.flash(flat_images(targets), plan)
+    device.close()
+    assert sim.flash.verify(targets) == []
+    if depth == 1:
+        assert any("busy while streaming" in r.getMessage() for r in caplog.records)
+
+
+def test_flash_fleet(simulators):
+    targets = make_targets(1)
+    plan = plan_flash(flash_sections, targets)
+    sims = simulators(3)
+    devices = [THD74(s.tty, 0.2) for s in sims]
+    results = flash.flash_fleet(devices, flat_images(targets), plan)
+    for d in devices:
+        d.close()
+    assert [r["tty"] for r in results] == [d.tty for d in devices]
+    assert all(r["ok"] for r in results)
+    assert all(s.flash.verify(targets) == [] for s in sims)
+
+
+def test_known_segment_checksums():
+    firmware = bytearray(0x400)
+    firmware[0xa0:0xaf] = b"V1.10.000      "
+    assert fwprog.known_segment_checksum("FIRMWARE", firmware) == 0x1f0366ab
+    assert fwprog.known_segment_checksum("CHECKBYTES", b"\xcd\xb6") == 0x36ce36ce
+    assert fwprog.known_segment_checksum("CHECKBYTES", b"\x00\x00") is None
+    assert fwprog.known_segment_checksum("DATA 0100", bytes(0x400)) is None
+
+    setup = fwprog.SegmentPacketizer("FIRMWARE", 0x200000, firmware, 0, 0x1f0366ab).setup()
+    assert setup[8 + 28:8 + 32] == bytes.fromhex("ab66031f")
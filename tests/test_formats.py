@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO, StringIO
+from struct import unpack_from
+
+from thd74tool.thd74 import elf, ihex, srec
+
+
+def test_srec_record():
+    data = bytes.fromhex("285F245F2212226A000424290008237C")
+    assert srec.make_record(1, 0, data).upper() == "S1130000285F245F2212226A000424290008237C2A\r\n"
+    assert srec.make_record(9, 0) == "S9030000fc\r\n"
+
+
+def test_srec_chunking():
+    records = [(0x100, b"A" * 5), (0x105, b"B" * 5), (0x200, b"C" * 3)]
+    assert list(srec.chunk_records(records, 4)) == [(0x100, b"AAAA"), (0x104, b"ABBB"), (0x108, b"BB"),
+                                                    (0x200, b"CCC")]
+    lines = list(srec.make(32, records, "TEST", record_size=4))
+    assert lines[0].startswith("S0")
+    assert [line[:2] for line in lines[1:]] == ["S3"] * 4 + ["S7"]
+    assert lines[1] == srec.make_record(3, 0x100, b"AAAA")
+
+    f = StringIO()
+    assert srec.write(f, 32, records, "TEST", record_size=4, buffer_size=16) == len("".join(lines))
+    assert f.getvalue() == "".join(lines)
+
+
+def test_ihex_record():
+    data = bytes.fromhex("214601360121470136007EFE09D21901")
+    assert ihex.make_record(0, 0x100, data) == ":10010000214601360121470136007EFE09D2190140\r\n"
+    assert ihex.make_record(1, 0) == ":00000001FF\r\n"
+
+
+def test_ihex_64k_boundary():
+    lines = list(ihex.make(0x1fff8, bytes(range(16)), 32))
+    assert lines == [ihex.make_record(4, 0, b"\x00\x01"), ihex.make_record(0, 0xfff8, bytes(range(8))),
+                     ihex.make_record(4, 0, b"\x00\x02"), ihex.make_record(0, 0, bytes(range(8, 16))),
+                     ihex.make_record(1, 0)]
+
+
+def test_elf_write_matches_make():
+    data = bytes(range(256)) * 3
+    made = elf.make(0x100000, data, ".text")
+    f = BytesIO()
+    assert elf.write(f, [(0x100000, data[:500]), (0x100000 + 500, data[500:])], ".text") == len(data)
+    assert f.getvalue() == made
+
+    assert made[:4] == b"\x7fELF"
+    e_type, e_machine, _, e_entry, e_phoff, e_shoff = unpack_from("<HHIIII", made, 16)
+    assert (e_type, e_machine, e_entry, e_phoff) == (elf.ET_EXEC, elf.EM_ARM, 0x100000, elf.header_size)
+    p_type, p_offset, p_vaddr, _, p_filesz = unpack_from("<IIIII", made, e_phoff)
+    assert (p_type, p_vaddr, p_filesz) == (elf.PT_LOAD, 0x100000, len(data))
+    assert made[p_offset:p_offset + p_filesz] == data
+    assert e_shoff % 4 == 0 and len(made) == e_shoff + 3 * elf.section_header_size
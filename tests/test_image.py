@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+from thd74tool.thd74.image import MemoryImage, write_flat
+
+
+def test_write_flat_overlapping_record():
+    # The second record overlaps the first and extends past it
+    f = BytesIO()
+    assert write_flat(f, [(0, b"AAAA"), (2, b"BBBB"), (6, b"CC")]) == (0, 8)
+    assert f.getvalue() == b"AABBBBCC"
+
+
+def test_write_flat_holes_and_rewrites():
+    f = BytesIO(b"xx")
+    f.seek(2)
+    assert write_flat(f, [(0x10, b"AA"), (0x14, b"BB"), (0x11, b"C")], fill=0) == (0x10, 6)
+    assert f.getvalue() == b"xx" + b"AC\0\0BB"
+
+
+def test_overlaps_are_recorded():
+    image = MemoryImage.from_records([(0x10, b"AAAA"), (0x12, b"BB"), (0x20, b"C")], "X")
+    assert image.overlaps == [(0x12, 0x14, "X", "X")]
+    assert image.read(0x10, 4) == b"AABB"
+
+
+def test_open_slices():
+    image = MemoryImage.from_records([(0x10, b"ABCD")])
+    assert image[:0x12] == b"AB"
+    assert image[0x12:] == b"CD"
+    assert image[:] == b"ABCD"
+
+
+def test_merging_sections():
+    image = MemoryImage()
+    image.update([(0x00, b"AAAA"), (0x08, b"BBBB")], "first")
+    image.update([(0x04, b"CCCC")], "second")
+    image.update([(0x0a, b"DD"), (0x10, b"EE")], "third")
+    assert list((start, bytes(data)) for start, data in image) == [(0x00, b"AAAACCCCBBDD"), (0x10, b"EE")]
+    assert image.overlaps == [(0x0a, 0x0c, "third", "first")]
+    assert image.holes() == [(0x0c, 0x10)]
+    assert image.flatten(0) == (0x00, bytearray(b"AAAACCCCBBDD\0\0\0\0EE"))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from random import Random
+
+from thd74tool.thd74.binary import sections
+from thd74tool.thd74.fwprog import page_size
+from thd74tool.thd74.image import MemoryImage
+from thd74tool.thd74.plan import SimulatedFlash, plan_flash
+
+by_name = dict((s["name"], s) for s in sections)
+flash_sections = [by_name[name] for name in ("FIRMWARE", "CHECKBYTES", "FINAL ZZZ")]
+
+
+def make_targets(seed: int = 0, blank_page: int = 3) -> dict:
+    firmware = bytearray(Random(seed).getrandbits(8 * 8 * page_size).to_bytes(8 * page_size, "little"))
+    firmware[blank_page * page_size:(blank_page + 1) * page_size] = b"\xff" * page_size
+    address = by_name["FIRMWARE"]["memory_address"]
+    return {
+        "FIRMWARE": MemoryImage.from_records([(address, bytes(firmware))], "FIRMWARE"),
+        "CHECKBYTES": MemoryImage.from_records([(by_name["CHECKBYTES"]["memory_address"], b"\xcd\xb6")]),
+        "FINAL ZZZ": MemoryImage.from_records([(by_name["FINAL ZZZ"]["memory_address"], b"Z" * 32)])
+    }
+
+
+def test_full_plan_skips_blank_pages():
+    targets = make_targets()
+    plan = plan_flash(flash_sections, targets)
+    assert [s["name"] for s in plan] == ["FIRMWARE", "CHECKBYTES", "FINAL ZZZ"]
+    assert [s["patch"] for s in plan] == [False, True, True]
+    assert plan[0]["pages"] == [p * page_size for p in (0, 1, 2, 4, 5, 6, 7)]
+
+    flash = SimulatedFlash()
+    flash.apply(plan, targets)
+    assert flash.verify(targets) == []
+
+
+def test_unchanged_plan_is_empty():
+    targets = make_targets()
+    assert all(s["wire_bytes"] == 0 for s in plan_flash(flash_sections, targets, make_targets()))
+
+
+def test_delta_plan():
+    current = make_targets(0)
+    targets = make_targets(0)
+    address = by_name["FIRMWARE"]["memory_address"]
+    targets["FIRMWARE"].add(address + 5 * page_size, b"changed")
+    plan = plan_flash(flash_sections, targets, current)
+    # The segment is cleared on setup, so all pages that are not blank are sent again,
+    # and the patches within it as well
+    assert plan[0]["pages"] == [p * page_size for p in (0, 1, 2, 4, 5, 6, 7)]
+    assert all(s["wire_bytes"] > 0 for s in plan)
+
+    flash = SimulatedFlash(current)
+    flash.apply(plan, targets)
+    assert flash.verify(targets) == []
+
+
+def test_delta_plan_without_erase():
+    current = make_targets(0)
+    targets = make_targets(0)
+    address = by_name["FIRMWARE"]["memory_address"]
+    targets["FIRMWARE"].add(address + 5 * page_size, b"changed")
+    plan = plan_flash(flash_sections, targets, current, erase=False)
+    assert plan[0]["pages"] == [5 * page_size]
+    assert [s["wire_bytes"] for s in plan[1:]] == [0, 0]
+
+    flash = SimulatedFlash(current)
+    flash.apply(plan, targets, erase=False)
+    assert flash.verify(targets) == []
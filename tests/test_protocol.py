@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from thd74tool.thd74.protocol import Message, MessageParser, encode_messages
+
+
+def test_frame_ending_in_newline_bytes():
+    # Payload ends in 0x0d and the checksum is 0x0a, so the frame itself ends in \r\n
+    m = Message(0x40, [bytes([0xba, 0x0d])], key=0)
+    assert bytes(m)[-4:] == b"\r\n\r\n"
+    parsed = MessageParser(0).messages(bytes(m))
+    assert parsed == [m]
+    assert parsed[0].validate()
+    assert list(Message.parse(bytes(m) * 2)) == [m, m]
+
+
+def test_encode_messages():
+    messages = [Message(0x43, [b"\x00\x04", b"\x10\x00"], [bytes(range(64))], key=key) for key in (0, 0x5a)]
+    messages.append(Message(0x50, (b"\xcd\xb6",), key=3))
+    buffer = bytearray(1024)
+    encoded = encode_messages(messages, buffer)
+    assert encoded.obj is buffer
+    assert bytes(encoded) == b"".join(bytes(m) for m in messages)
+
+
+def test_parser_chunks():
+    messages = [Message(0x43, [b"\x00\x00\x00\x00\x04\x00\x00\x00"], [b"\r\n" * 512], key=0x5a),
+                Message(0x06, [b"\x07"], key=0x5a),
+                Message(0x40, [b"\r\n\r\n"], [b"\r"], key=0x5a)]
+    stream = b"".join(bytes(m) for m in messages)
+    for size in (1, 3, 8, 1000, len(stream)):
+        parser = MessageParser(0x5a)
+        parsed = []
+        for pos in range(0, len(stream), size):
+            parsed.extend(parser.messages(stream[pos:pos + size]))
+        assert parsed == messages
+        assert all(m.validate() for m in parsed)
+        assert parser.pending == 0
+
+
+def test_parser_skips_garbage():
+    m = Message(0x06, [b"\x07"], key=0)
+    parser = MessageParser()
+    assert parser.messages(b"\x16\x06junk" + bytes(m)[:5]) == []
+    assert parser.messages(bytes(m)[5:] + bytes(m)) == [m, m]
+    assert parser.key == 0
+
+
+def test_parser_learns_key():
+    m = Message(0x32, [b"info"], key=0x21)
+    parser = MessageParser()
+    assert parser.messages(bytes(m)) == [m]
+    assert parser.key == 0x21
+    parser.reset()
+    assert parser.pending == 0
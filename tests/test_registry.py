@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from thd74tool.thd74 import device, registry
+from thd74tool.thd74.registry import DeviceRegistry
+
+simulator = pytest.importorskip("thd74tool.thd74.simulator", reason="the simulator needs POSIX pseudo-terminals")
+
+
+@pytest.fixture
+def sim():
+    s, = simulator.start(1, mode="pcrig", firmware_version="1.23")
+    yield s
+    s.stop()
+    s.join(1.0)
+
+
+def test_identityless_ports_probed_on_change(sim, tmp_path, monkeypatch):
+    probed = []
+    probe_one = DeviceRegistry._DeviceRegistry__probe_one
+    monkeypatch.setattr(DeviceRegistry, "_DeviceRegistry__probe_one",
+                        lambda self, model, tty: probed.append(tty) or probe_one(self, model, tty))
+    signature = [("by-id", "ttyACM0")]
+    monkeypatch.setattr(registry, "ports_signature", lambda ttys=None: tuple(signature))
+    monkeypatch.setattr(registry.list_ports, "comports", lambda: [])
+    path = tmp_path / "devices.json"
+
+    added, removed = DeviceRegistry(path, ttys=[sim.tty]).refresh()
+    assert [e["firmware_version"] for e in added] == ["1.23"] and removed == []
+    assert probed == [sim.tty]
+
+    # Same ports, also from a new process: the radio is not written to again
+    assert DeviceRegistry(path, ttys=[sim.tty]).refresh() == ([], [])
+    assert probed == [sim.tty]
+
+    signature.append(("by-id", "ttyACM1"))
+    assert DeviceRegistry(path, ttys=[sim.tty]).refresh() == ([], [])
+    assert probed == [sim.tty, sim.tty]
+
+
+def test_probe_skips_bad_ports(sim, tmp_path):
+    devices = device.probe(device.THD74, [str(tmp_path / "missing"), sim.tty])
+    assert [d.tty for d in devices] == [sim.tty]
+    assert devices[0].firmware_version == "1.23"
+    devices[0].close()
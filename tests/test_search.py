@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from thd74tool.thd74.cache import CacheEntry
+from thd74tool.thd74.search import SectionIndex
+
+firmware = {"name": "FIRMWARE"}
+font = {"name": "FONT DATA"}
+
+
+def make_index(entry=None) -> SectionIndex:
+    index = SectionIndex(entry)
+    index.add(0, firmware, 0x1000, b"\xffaaa\x00GPS Data TX\x00Digital Squelch\xff")
+    index.add(2, font, 0x8000, b"\x00\x01Digital\x00")
+    return index
+
+
+def test_find_overlapping():
+    index = make_index()
+    hits = list(index.find([b"aa", b"Digital", b"Digital Squelch", b""]))
+    assert hits == [(firmware, 0x1001, b"aa"), (firmware, 0x1002, b"aa"), (firmware, 0x1011, b"Digital Squelch"),
+                    (font, 0x8002, b"Digital")]
+    assert list(index.find([b"Digital"], [2])) == [(font, 0x8002, b"Digital")]
+    assert list(index.find([b"aa", b"Digital Squelch"], limit=3)) == hits[:3]
+    assert list(index.find([b"."])) == []
+
+
+def test_strings_cached(tmp_path):
+    entry = CacheEntry(tmp_path / "entry")
+    strings = list(make_index(entry).strings(5))
+    assert strings == [(firmware, 0x1005, b"GPS Data TX"), (firmware, 0x1011, b"Digital Squelch"),
+                       (font, 0x8002, b"Digital")]
+    assert entry.load_strings(2, 5) == [(0x8002, b"Digital")]
+
+    # Served from the cache entry without scanning the images again
+    index = SectionIndex(entry)
+    index.add(0, firmware, 0x1000, b"")
+    index.add(2, font, 0x8000, b"")
+    assert list(index.strings(5)) == strings
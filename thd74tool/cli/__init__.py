@@ -2,10 +2,16 @@
 
 from .base import run, list_commands
 
+from . import bench
 from . import devices
+from . import diff
 from . import extract
+from . import flash
 from . import pcap
+from . import plan
+from . import search
+from . import simulate
 
 __all__ = [
-    "devices", "extract", "pcap"
+    "bench", "devices", "diff", "extract", "flash", "pcap", "plan", "search", "simulate"
 ]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import json
+from logging import getLogger
+from pathlib import Path
+
+from .base import CliCommand
+from ..thd74 import bench
+
+logger = getLogger(__name__)
+
+
+class BenchCommand(CliCommand):
+
+    name = "bench"
+    help = "benchmark extraction on a synthetic updater"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("--scale",
+                            help="section sizes relative to real updaters (default: 1.0)",
+                            type=float,
+                            default=1.0,
+                            action="store")
+
+        parser.add_argument("--repeat",
+                            help="runs per benchmark, the fastest counts (default: 3)",
+                            type=int,
+                            default=3,
+                            action="store")
+
+        parser.add_argument("--baseline",
+                            help="compare against results saved with --save",
+                            type=Path,
+                            action="store")
+
+        parser.add_argument("--tolerance",
+                            help="allowed slowdown against baseline (default: 0.25)",
+                            type=float,
+                            default=0.25,
+                            action="store")
+
+        parser.add_argument("--save",
+                            help="save results as JSON for later comparison",
+                            type=Path,
+                            action="store")
+
+    def run(self) -> int:
+        baseline = None
+        if self.args.baseline is not None:
+            try:
+                with open(self.args.baseline, "r") as f:
+                    baseline = json.load(f)
+            except FileNotFoundError:
+                logger.critical(f"Unable to open {str(self.args.baseline.absolute())}")
+                return 10
+
+        results = bench.run(self.args.scale, self.args.repeat)
+
+        regressions = []
+        if baseline is not None:
+            regressions = bench.compare(results, baseline, self.args.tolerance)
+
+        for name, r in results.items():
+            flag = "\tREGRESSION" if name in regressions else ""
+            print(f"{name:<20}\t{r['seconds']:8.4f} s\t{r['lines_per_s']:12.0f} lines/s\t{r['mb_per_s']:8.2f} MB/s{flag}")
+
+        if self.args.save is not None:
+            with open(self.args.save, "w") as f:
+                json.dump(results, f, indent=2)
+            logger.info(f"Results saved to `{str(self.args.save.absolute())}`")
+
+        if len(regressions) > 0:
+            logger.critical(f"Performance regression in {', '.join(regressions)}")
+            return 10
+
+        return 0
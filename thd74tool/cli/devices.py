@@ -3,7 +3,9 @@
 from logging import getLogger
 
 from .base import CliCommand
+from ..thd74 import device as thd_device
 from ..thd74.device import enumerate
+from ..thd74.registry import DeviceRegistry, poll_interval
 
 logger = getLogger(__name__)
 
@@ -13,14 +15,56 @@ class DevicesCommand(CliCommand):
     name = "devices"
     help = "enumerate detected devices"
 
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("--probe-timeout",
+                            help=f"seconds to wait for each device to identify (default: {thd_device.probe_timeout})",
+                            type=float,
+                            default=thd_device.probe_timeout,
+                            action="store")
+
+        parser.add_argument("-w", "--watch",
+                            help="keep reporting devices as they are connected and disconnected",
+                            action="store_true")
+
+        parser.add_argument("--interval",
+                            help=f"seconds between checks for changes with --watch (default: {poll_interval})",
+                            type=float,
+                            default=poll_interval,
+                            action="store")
+
+        parser.add_argument("--rescan",
+                            help="probe all devices again instead of trusting the device registry",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        # Also the default command, then without its own arguments
+        for name, default in [("probe_timeout", thd_device.probe_timeout), ("watch", False),
+                              ("interval", poll_interval), ("rescan", False)]:
+            setattr(args, name, getattr(args, name, default))
+        if args.probe_timeout <= 0:
+            logger.critical("Probe timeout must be positive")
+            return False
+        if args.interval <= 0:
+            logger.critical("Interval must be positive")
+            return False
+        return True
+
     def run(self):
-        devices = enumerate()
+        if self.args.watch:
+            return self.__watch()
+        if self.args.tty is None:
+            return self.__list()
+
+        devices = enumerate(self.args.tty, probe_timeout=self.args.probe_timeout)
         if len(devices) > 0:
             for device in devices:
                 mode = "unknown mode (BE CAREFUL)"
                 if device.comm.pcrig_mode:
                     mode = "PCRIG mode"
-                    fv = f"firmware {device.comm.get_firmware_version()}"
+                    fv = f"firmware {device.firmware_version}"
                 if device.comm.fwprog_mode:
                     mode = "FWPROG mode"
                     fv = None
@@ -33,3 +77,46 @@ class DevicesCommand(CliCommand):
         else:
             logger.critical("No device detected. Is it connected?")
             return 10
+
+    def __registry(self) -> DeviceRegistry:
+        ttys = [self.args.tty] if self.args.tty is not None else None
+        registry = DeviceRegistry.default(ttys=ttys, probe_timeout=self.args.probe_timeout)
+        if self.args.rescan:
+            registry.entries = {}
+        return registry
+
+    @staticmethod
+    def __format(entry: dict) -> str:
+        mode = "unknown hardware (BE CAREFUL)"
+        fv = None
+        if entry["mode"] == "pcrig":
+            mode = "PCRIG mode"
+            fv = f"firmware {entry['firmware_version']}"
+        elif entry["mode"] == "fwprog":
+            mode = "FWPROG mode"
+        return f"{entry['tty']}\t{entry['brand']}\t{entry['model']}\t{mode}\t{fv}"
+
+    def __list(self) -> int:
+        registry = self.__registry()
+        registry.refresh()
+        devices = registry.devices
+        if len(devices) == 0:
+            logger.critical("No device detected. Is it connected?")
+            return 10
+        for n, entry in zip(range(len(devices)), devices):
+            print(f"[{n}]\t{self.__format(entry)}")
+        return 0
+
+    def __watch(self) -> int:
+        def report(added, removed):
+            for entry in removed:
+                print(f"-\t{entry['tty']}\t{entry['brand']}\t{entry['model']}\tdisconnected", flush=True)
+            for entry in added:
+                print(f"+\t{self.__format(entry)}", flush=True)
+
+        logger.info("Watching for devices, press Ctrl-C to stop")
+        try:
+            self.__registry().watch(report, self.args.interval)
+        except KeyboardInterrupt:
+            pass
+        return 0
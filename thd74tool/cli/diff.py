@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from pathlib import Path
+
+from .base import CliCommand
+from ..thd74 import diff
+from ..thd74.cache import SectionCache, load_sections
+
+logger = getLogger(__name__)
+
+
+class DiffCommand(CliCommand):
+
+    name = "diff"
+    help = "compare firmware sections of two updaters"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("-e", "--exe",
+                            help="path to firmware updater .exe file, give twice (old, then new)",
+                            type=Path,
+                            required=True,
+                            action="append")
+
+        parser.add_argument("-b", "--block-size",
+                            help=f"block size for hash comparison (default: {diff.block_size})",
+                            type=int,
+                            default=diff.block_size,
+                            action="store")
+
+        parser.add_argument("-g", "--gap",
+                            help="merge changed ranges at most this many bytes apart (default: 0)",
+                            type=int,
+                            default=0,
+                            action="store")
+
+        parser.add_argument("--no-cache",
+                            help="neither read from nor write to the decrypted section cache",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        if len(args.exe) != 2:
+            logger.critical("Need exactly two updaters to compare, give --exe twice")
+            return False
+        if args.block_size <= 0:
+            logger.critical("Block size must be positive")
+            return False
+        if args.gap < 0:
+            logger.critical("Gap must not be negative")
+            return False
+        return True
+
+    def run(self) -> int:
+        cache = None if self.args.no_cache else SectionCache()
+
+        updaters = []
+        for exe in self.args.exe:
+            exe = exe.absolute()
+            if not exe.is_file():
+                logger.critical(f"Unable to open {str(exe)}")
+                return 10
+            try:
+                updaters.append(load_sections(exe, cache))
+            except ValueError as e:
+                logger.critical(str(e))
+                return 10
+
+        report = diff.diff_sections(*updaters, size=self.args.block_size, gap=self.args.gap)
+
+        for entry in report:
+            old, new = entry["old"], entry["new"]
+            if old is None:
+                print(f"{entry['name']}\tonly in new\t{new['version'] or ''}")
+                continue
+            if new is None:
+                print(f"{entry['name']}\tonly in old\t{old['version'] or ''}")
+                continue
+            ranges = entry["ranges"]
+            changed = sum(end - start for start, end in ranges)
+            version = f"{old['version'] or ''} -> {new['version'] or ''}"
+            if len(ranges) == 0:
+                print(f"{entry['name']}\tidentical\t{version}")
+                continue
+            print(f"{entry['name']}\t{changed} bytes in {len(ranges)} ranges\t{version}")
+            for start, end in ranges:
+                print(f"\t{start:#010x}-{end:#010x}\t{end - start} bytes")
+
+        return 0
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor
 from logging import getLogger
+from os import cpu_count
 from pathlib import Path
+from typing import Iterable, List, Tuple
 
 from .base import CliCommand
-from ..thd74.binary import extract_from_exe, get_flash_blobs, identify_blob, count_blob_bytes, parse_blob
-from ..thd74.crypto import decrypt_blob
-from ..thd74.srec import make
+from ..thd74 import pipeline, srec
+from ..thd74.binary import Blob, BlobError, UpdaterPayload, get_flash_blobs, parse_blob_records
+from ..thd74.cache import CacheEntry, SectionCache, make_manifest, manifest_section
+from ..thd74.crypto import decrypt_blob_buffer
 
 logger = getLogger(__name__)
 
@@ -26,7 +30,7 @@ class ExtractCommand(CliCommand):
                             action="store")
 
         parser.add_argument("-p", "--path",
-                            help="export firmware sections to path in SREC format",
+                            help="export firmware sections to path",
                             type=Path,
                             action="store")
 
@@ -35,56 +39,236 @@ class ExtractCommand(CliCommand):
                             type=int,
                             action="append")
 
-    def run(self) -> int:
-        try:
-            with open(self.args.exe, "rb") as f:
-                logger.info(f"Reading updater from `{str(self.args.exe.absolute())}`")
-                exe = f.read()
-        except FileNotFoundError:
-            logger.critical(f"Unable to open {str(self.args.exe.absolute())}")
-            return 10
+        parser.add_argument("-f", "--format",
+                            help="export format (default: srec)",
+                            choices=list(pipeline.formats.keys()),
+                            default="srec",
+                            action="store")
 
-        logger.info("Parsing updater blobs")
-        blobs = list(get_flash_blobs(extract_from_exe(exe)))
-        sections = []
-        for n, blob in zip(range(len(blobs)), blobs):
-            section = identify_blob(blob, n)
-            sections.append(section)
-            if section is None:
-                logger.warning(f"Unknown blob [{n}]")
-            else:
-                logger.info(f"Detected firmware section [{n}], looks like `{section['name']}` at permutation offet {section['permute_offset']}")
-                section["size"] = count_blob_bytes(blob)
+        parser.add_argument("-r", "--record-size",
+                            help="data bytes per SREC or Intel HEX record (default: as in updater for SREC, 32 for Intel HEX)",
+                            type=int,
+                            action="store")
 
-        if self.args.path is None:
-            logger.info(f"Found {len(sections)} updater blobs")
-            for n, s in zip(range(len(sections)), sections):
-                if s is None:
-                    print(f"[{n}]\tUNKNOWN BLOB\t0 bytes")
-                else:
-                    print(f"[{n}]\t{s['name']}\t{s['size']} bytes")
-            logger.info("Now give ma a --path to write them to!")
-            return 0
+        parser.add_argument("-j", "--jobs",
+                            help="number of parallel worker processes for export, 0 for one per CPU (default: 1)",
+                            type=int,
+                            default=1,
+                            action="store")
 
-        if not self.args.path.is_dir():
+        parser.add_argument("--no-cache",
+                            help="neither read from nor write to the decrypted section cache",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        if args.record_size is not None:
+            limit = srec.max_record_size(3) if args.format == "srec" else 255
+            if not 0 < args.record_size <= limit:
+                logger.critical(f"Record size must be between 1 and {limit} for {args.format} export")
+                return False
+        return True
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.payload = None
+        self.cache = None
+        self.cache_entry = None
+
+    def run(self) -> int:
+        exe = self.args.exe.absolute()
+        if not exe.is_file():
+            logger.critical(f"Unable to open {str(exe)}")
+            return 10
+
+        if self.args.path is not None and not self.args.path.is_dir():
             logger.critical(f"Unable to export to directory `{str(self.args.path.absolute())}` (must exist)")
+            return 10
+
+        manifest = None
+        if not self.args.no_cache:
+            self.cache = SectionCache()
+            self.cache_entry = self.cache.entry(exe)
+            manifest = self.cache_entry.load_manifest()
 
         if self.args.section is None:
             export = [0, 1, 2, 3, 4]
         else:
             export = self.args.section
-        
-        for n in export:
+        jobs = self.args.jobs or cpu_count()
+
+        if self.args.path is None:
+            return self.__list(exe, manifest)
+
+        cached = manifest is not None and \
+            all(self.cache_entry.has_records(n) for n in export if 0 <= n < len(manifest["blobs"]))
+        if not cached and jobs <= 1:
+            return self.__stream(exe, export)
+        return self.__export(exe, manifest, cached, export, jobs)
+
+    def __list(self, exe: Path, manifest: dict or None) -> int:
+        """
+        Describe all blobs of the updater, from the cached manifest or in a single pass
+        """
+        if manifest is None:
             try:
-                s = sections[n]
-            except IndexError:
-                logger.warning(f"Unable to export unknown section [{n}], skipping")
-                continue
-            file_name = self.args.path.absolute() / f"{s['name']}.srec"
-            logger.info(f"Decrypting section [{n}] to `{file_name}`")
-            with open(file_name, "w") as f:
-                for rec in make(32, parse_blob(decrypt_blob(blobs[n], s["permute_offset"], s["end_offset"]),
-                                               s["memory_address"]), s["name"]):
-                    f.write(rec)
-                    
+                logger.info(f"Streaming updater from `{str(exe)}`")
+                manifest = {"blobs": pipeline.extract(exe, None, cache=self.cache_entry)}
+            except (ValueError, BlobError) as e:
+                logger.critical(str(e))
+                return 10
+        else:
+            logger.info(f"Using cached section manifest for `{str(exe)}`")
+
+        logger.info(f"Found {len(manifest['blobs'])} updater blobs")
+        for n, entry in zip(range(len(manifest["blobs"])), manifest["blobs"]):
+            if entry["name"] is None:
+                logger.warning(f"Unknown blob [{n}]")
+                print(f"[{n}]\tUNKNOWN BLOB\t{entry['size']} bytes\tpermutation offset {entry['permute_offset']}")
+            else:
+                logger.info(f"Detected firmware section [{n}], looks like `{entry['name']}` "
+                            f"at permutation offet {entry['permute_offset']}")
+                print(f"[{n}]\t{entry['name']}\t{entry['size']} bytes\t{entry['version'] or ''}")
+        logger.info("Now give ma a --path to write them to!")
         return 0
+
+    def __stream(self, exe: Path, export: List[int]) -> int:
+        """
+        Export sections in a single pass over the updater, as they are decrypted
+        """
+        try:
+            logger.info(f"Streaming updater from `{str(exe)}`")
+            entries = pipeline.extract(exe, self.args.path.absolute(), export, self.args.format,
+                                       self.args.record_size, self.cache_entry)
+        except (ValueError, BlobError) as e:
+            logger.critical(str(e))
+            return 10
+
+        results = []
+        for n in export:
+            if not 0 <= n < len(entries) or entries[n]["name"] is None:
+                results.append((n, IndexError(n)))
+            else:
+                results.append((n, entries[n].get("error", entries[n])))
+        return self.__report(results)
+
+    def __export(self, exe: Path, manifest: dict or None, cached: bool, export: List[int], jobs: int) -> int:
+        """
+        Export sections from the cached records where possible, in parallel if asked to
+        :param manifest: cached manifest, None to build it from the updater
+        :param cached: whether all sections to export have cached records
+        """
+        if manifest is not None:
+            logger.info(f"Using cached section manifest for `{str(exe)}`")
+        if cached:
+            logger.info("Serving all sections from cache")
+            blobs = [None] * len(manifest["blobs"])
+        else:
+            blobs = self.__load_blobs()
+            if blobs is None:
+                return 10
+        if manifest is None:
+            manifest = make_manifest(blobs)
+            if self.cache_entry is not None:
+                self.cache_entry.save_manifest(manifest)
+        return self.__report(self.__export_blobs(blobs, manifest["blobs"], export, jobs))
+
+    def __report(self, results: Iterable[Tuple[int, dict or Exception]]) -> int:
+        failed = False
+        for n, result in results:
+            if isinstance(result, IndexError):
+                logger.warning(f"Unable to export unknown section [{n}], skipping")
+            elif isinstance(result, Exception):
+                logger.error(f"Failed to export section [{n}]: {result}")
+                failed = True
+            else:
+                logger.info(f"Exported section [{n}] `{result['name']}` with {result['size']} bytes "
+                            f"to `{result['file_name']}`")
+        if self.cache is not None:
+            self.cache.evict(keep=self.cache_entry)
+        return 10 if failed else 0
+
+    def teardown(self):
+        if self.payload is not None:
+            self.payload.close()
+            self.payload = None
+
+    def __load_blobs(self) -> List[Blob] or None:
+        try:
+            logger.info(f"Reading updater from `{str(self.args.exe.absolute())}`")
+            self.payload = UpdaterPayload(self.args.exe)
+        except FileNotFoundError:
+            logger.critical(f"Unable to open {str(self.args.exe.absolute())}")
+            return None
+        except ValueError as e:
+            logger.critical(str(e))
+            return None
+
+        logger.info("Parsing updater blobs")
+        return list(get_flash_blobs(self.payload))
+
+    def __export_blobs(self, blobs: List[Blob or None], entries: List[dict], export: List[int],
+                       jobs: int) -> Iterable[Tuple[int, dict or Exception]]:
+        """
+        Export sections, in parallel if asked to. Results are reported in the
+        order of `export` regardless of which worker finishes first.
+        """
+        path = self.args.path.absolute()
+        options = (path, self.args.format, self.args.record_size, self.cache_entry)
+
+        if jobs <= 1:
+            for n in export:
+                if not 0 <= n < len(blobs):
+                    yield n, IndexError(n)
+                    continue
+                try:
+                    yield n, export_blob(n, blobs[n], entries[n], *options)
+                except Exception as e:
+                    yield n, e
+            return
+
+        logger.info(f"Exporting {len(export)} sections using {jobs} worker processes")
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = []
+            for n in export:
+                if 0 <= n < len(blobs):
+                    futures.append((n, pool.submit(export_blob, n, blobs[n], entries[n], *options)))
+                else:
+                    futures.append((n, None))
+            for n, future in futures:
+                if future is None:
+                    yield n, IndexError(n)
+                    continue
+                try:
+                    yield n, future.result()
+                except Exception as e:
+                    yield n, e
+
+
+def export_blob(n: int, blob: Blob or None, entry: dict, path: Path, fmt: str = "srec",
+                record_size: int or None = None, cache: CacheEntry or None = None) -> dict:
+    """
+    Decrypt, parse and write a single updater blob.
+    Runs as worker process function, so it must not depend on command state.
+    :param n: blob number
+    :param blob: encrypted blob, may be None if its records are cached
+    :param entry: manifest entry of the blob
+    :param path: export directory
+    :param fmt: export format, key of `formats`
+    :param record_size: data bytes per record for text formats
+    :param cache: cache entry for the updater, if caching
+    :return: section dict with added `file_name`
+    """
+    extension, mode, writer = pipeline.formats[fmt]
+    section = manifest_section(entry)
+    if section is None:
+        raise ValueError(f"Unknown blob [{n}] at permutation offset {entry['permute_offset']}")
+    section["file_name"] = path / f"{section['name']}.{extension}"
+    records = cache.load_records(n) if cache is not None else None
+    if records is None:
+        records = decrypt_blob_buffer(blob.raw, section["permute_offset"], section["end_offset"])
+        if cache is not None:
+            cache.save_records(n, records)
+    with open(section["file_name"], mode) as f:
+        writer(f, section, parse_blob_records(records, section["memory_address"]), record_size)
+    return section
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from pathlib import Path
+from sys import stderr
+from threading import Lock
+from time import time
+from typing import Dict, Tuple
+
+from .base import CliCommand
+from ..thd74 import flash, fwprog, plan
+from ..thd74.cache import SectionCache, load_images
+from ..thd74.device import enumerate
+
+logger = getLogger(__name__)
+
+
+class FlashCommand(CliCommand):
+
+    name = "flash"
+    help = "flash firmware sections from an updater to devices in FWPROG mode"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("-e", "--exe",
+                            help="path to firmware updater .exe file to flash",
+                            type=Path,
+                            required=True,
+                            action="store")
+
+        parser.add_argument("-d", "--device",
+                            help="path to updater last flashed to the device, to send only changed pages",
+                            type=Path,
+                            action="store")
+
+        parser.add_argument("-s", "--section",
+                            help="select firmware section to flash (default: all known sections)",
+                            type=int,
+                            action="append")
+
+        parser.add_argument("-a", "--all",
+                            help="flash all detected devices in FWPROG mode concurrently",
+                            action="store_true")
+
+        parser.add_argument("--retries",
+                            help="times to restart a failed session per device (default: 1)",
+                            type=int,
+                            default=1,
+                            action="store")
+
+        parser.add_argument("--depth",
+                            help=f"data messages per write to start with (default: {flash.pipeline_depth})",
+                            type=int,
+                            default=flash.pipeline_depth,
+                            action="store")
+
+        parser.add_argument("--segment-checksum",
+                            help="0x40 checksum field of a section as captured from the updater, "
+                                 "as NAME=VALUE with VALUE in hex (default: known values of the 1.10 updater)",
+                            metavar="NAME=VALUE",
+                            action="append")
+
+        parser.add_argument("--force",
+                            help="flash sections without known checksum field, sending 0 instead",
+                            action="store_true")
+
+        parser.add_argument("--no-cache",
+                            help="neither read from nor write to the decrypted section cache",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        if args.depth < 1:
+            logger.critical("Pipeline depth must be positive")
+            return False
+        if args.retries < 0:
+            logger.critical("Retries must not be negative")
+            return False
+        if args.all and args.tty is not None:
+            logger.critical("Use either --all or --tty")
+            return False
+        for value in args.segment_checksum or []:
+            name, _, checksum = value.partition("=")
+            if name not in fwprog.segments:
+                logger.critical(f"Unknown section `{name}` in --segment-checksum")
+                return False
+            try:
+                int(checksum, 16)
+            except ValueError:
+                logger.critical(f"Invalid checksum `{checksum}` in --segment-checksum, expected hex")
+                return False
+        return True
+
+    def run(self) -> int:
+        cache = None if self.args.no_cache else SectionCache()
+
+        targets = self.__load_images(self.args.exe, cache)
+        if targets is None:
+            return 10
+        device_images = None
+        if self.args.device is not None:
+            device = self.__load_images(self.args.device, cache)
+            if device is None:
+                return 10
+            device_images = {s["name"]: image for s, image in filter(None, device)}
+
+        select = self.args.section if self.args.section is not None else range(len(targets))
+        sections = []
+        for n in select:
+            if not 0 <= n < len(targets) or targets[n] is None:
+                if self.args.section is not None:
+                    logger.warning(f"Unable to flash unknown section [{n}], skipping")
+                continue
+            sections.append(targets[n][0])
+
+        images = {s["name"]: image for s, image in filter(None, targets)}
+        segments = plan.plan_flash(sections, images, device_images)
+        flat = self.flatten(images, [s["name"] for s in sections])
+        checksums = self.__checksums(flat)
+        if checksums is None:
+            return 10
+
+        devices = [d for d in enumerate(self.args.tty) if d.is_fwprog_mode]
+        if len(devices) == 0:
+            logger.critical("No device in FWPROG mode detected")
+            return 10
+        if len(devices) > 1 and not self.args.all:
+            logger.critical(f"{len(devices)} devices in FWPROG mode detected, select one with --tty or use --all")
+            return 10
+
+        logger.info(f"Flashing {', '.join(s['name'] for s in sections)} to {len(devices)} device(s)")
+        self.__devices = devices
+        self.__progress = {}
+        self.__shown = 0.0
+        self.__lock = Lock()
+        results = flash.flash_fleet(devices, flat, segments, self.args.retries, self.args.depth, self.__report,
+                                    checksums)
+        stderr.write("\n")
+
+        for n, device, result in zip(range(len(devices)), devices, results):
+            state = "OK" if result["ok"] else f"FAILED ({result['error']})"
+            print(f"[{n}]\t{device.tty}\t{state}\t{result['attempts']} attempt(s)"
+                  f"\t{result['bytes']} bytes\t{result['seconds']:.1f} s")
+        failed = sum(1 for r in results if not r["ok"])
+        if failed > 0:
+            logger.critical(f"Flashing failed on {failed} of {len(devices)} devices")
+            return 10
+        logger.info(f"Flashed {len(devices)} device(s) in {max(r['seconds'] for r in results):.1f} s")
+        return 0
+
+    @staticmethod
+    def flatten(images: dict, names: list) -> Dict[str, Tuple[int, bytes]]:
+        """
+        (address, contiguous image) per section name, immutable to be shared by all sessions
+        """
+        flat = {}
+        for name in names:
+            start, data = images[name].flatten()
+            flat[name] = (start, bytes(data))
+        return flat
+
+    def __checksums(self, flat: dict) -> Dict[str, int] or None:
+        """
+        0x40 checksum field per section, None if any is unknown and not forced
+        """
+        given = {}
+        for value in self.args.segment_checksum or []:
+            name, _, checksum = value.partition("=")
+            given[name] = int(checksum, 16)
+
+        checksums = {}
+        unknown = []
+        for name, (_, data) in flat.items():
+            checksum = given.get(name, fwprog.known_segment_checksum(name, data))
+            if checksum is None:
+                unknown.append(name)
+                checksum = 0
+            checksums[name] = checksum
+        if len(unknown) > 0:
+            if not self.args.force:
+                logger.critical(f"Unknown 0x40 checksum field for {', '.join(unknown)}, pass captured values "
+                                f"with --segment-checksum or flash anyway with --force")
+                return None
+            logger.warning(f"Sending 0 as 0x40 checksum field for {', '.join(unknown)}, "
+                           f"the radio may reject or misflash these sections")
+        return checksums
+
+    def __report(self, device, progress: flash.FlashProgress) -> None:
+        """
+        Progress of all devices on one status line, redrawn at most every 0.2 s
+        """
+        with self.__lock:
+            self.__progress[device.tty] = progress
+            now = time()
+            if now - self.__shown < 0.2 and progress.sent < progress.total:
+                return
+            self.__shown = now
+            if len(self.__devices) == 1:
+                line = str(progress)
+            else:
+                states = []
+                for n, d in zip(range(len(self.__devices)), self.__devices):
+                    p = self.__progress.get(d.tty)
+                    if p is not None:
+                        states.append(f"[{n}] {100 * p.sent // max(p.total, 1)}% {p.rate / 1024:.0f} KiB/s")
+                line = " | ".join(states)
+            stderr.write(f"\r{line}\033[K")
+            stderr.flush()
+
+    @staticmethod
+    def __load_images(exe: Path, cache: SectionCache or None) -> list or None:
+        exe = exe.absolute()
+        if not exe.is_file():
+            logger.critical(f"Unable to open {str(exe)}")
+            return None
+        try:
+            return load_images(exe, cache)
+        except ValueError as e:
+            logger.critical(str(e))
+            return None
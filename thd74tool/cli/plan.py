@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from pathlib import Path
+
+from .base import CliCommand
+from ..thd74 import plan
+from ..thd74.cache import SectionCache, load_images
+
+logger = getLogger(__name__)
+
+
+class PlanCommand(CliCommand):
+
+    name = "plan"
+    help = "plan a delta flash against the firmware on the device"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("-e", "--exe",
+                            help="path to firmware updater .exe file to flash",
+                            type=Path,
+                            required=True,
+                            action="store")
+
+        parser.add_argument("-d", "--device",
+                            help="path to updater last flashed to the device (default: assume unknown contents)",
+                            type=Path,
+                            action="store")
+
+        parser.add_argument("-s", "--section",
+                            help="select firmware section to flash (default: all known sections)",
+                            type=int,
+                            action="append")
+
+        parser.add_argument("--no-erase",
+                            help="assume the device does not clear segments on setup, so only changed pages are sent",
+                            action="store_true")
+
+        parser.add_argument("--baud",
+                            help="serial line speed for time estimates (default: 115200)",
+                            type=int,
+                            default=115200,
+                            action="store")
+
+        parser.add_argument("--latency",
+                            help="seconds per command round trip for time estimates (default: 0.01)",
+                            type=float,
+                            default=0.01,
+                            action="store")
+
+        parser.add_argument("--simulate",
+                            help="apply the plan to a simulated device and verify the result",
+                            action="store_true")
+
+        parser.add_argument("--no-cache",
+                            help="neither read from nor write to the decrypted section cache",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        if args.baud <= 0:
+            logger.critical("Baud rate must be positive")
+            return False
+        return True
+
+    def run(self) -> int:
+        cache = None if self.args.no_cache else SectionCache()
+
+        targets = self.__load_images(self.args.exe, cache)
+        if targets is None:
+            return 10
+        device = None
+        if self.args.device is not None:
+            device = self.__load_images(self.args.device, cache)
+            if device is None:
+                return 10
+
+        select = self.args.section if self.args.section is not None else range(len(targets))
+        sections = []
+        for n in select:
+            if not 0 <= n < len(targets) or targets[n] is None:
+                if self.args.section is None:
+                    continue
+                logger.warning(f"Unable to flash unknown section [{n}], skipping")
+                continue
+            sections.append(targets[n][0])
+
+        images = {s["name"]: image for s, image in filter(None, targets)}
+        device_images = None
+        if device is not None:
+            device_images = {s["name"]: image for s, image in filter(None, device)}
+
+        erase = not self.args.no_erase
+        segments = plan.plan_flash(sections, images, device_images, erase)
+        for segment in segments:
+            print(f"{segment['name']}\t{segment['address']:#010x}\t{len(segment['pages'])}/{segment['total_pages']} pages"
+                  f"\t{segment['wire_bytes']} bytes")
+
+        totals = plan.estimate(segments, self.args.baud, self.args.latency)
+        print(f"Total\t{totals['wire_bytes']} of {totals['full_wire_bytes']} bytes on the wire"
+              f"\t{totals['seconds']:.1f} s instead of {totals['full_seconds']:.1f} s"
+              f"\t{totals['saved_seconds']:.1f} s saved")
+
+        if self.args.simulate:
+            flash = plan.SimulatedFlash(device_images)
+            flash.apply(segments, images, erase)
+            failed = flash.verify(images, [s["name"] for s in sections])
+            if len(failed) > 0:
+                logger.critical(f"Simulated flash differs from target in {', '.join(failed)}")
+                return 10
+            logger.info(f"Simulated flash matches target after writing {flash.written} bytes")
+
+        return 0
+
+    @staticmethod
+    def __load_images(exe: Path, cache: SectionCache or None) -> list or None:
+        """
+        (section, memory image) per blob of an updater, None for unknown blobs
+        """
+        exe = exe.absolute()
+        if not exe.is_file():
+            logger.critical(f"Unable to open {str(exe)}")
+            return None
+        try:
+            return load_images(exe, cache)
+        except ValueError as e:
+            logger.critical(str(e))
+            return None
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from binascii import unhexlify, Error as HexError
+from logging import getLogger
+from pathlib import Path
+
+from .base import CliCommand
+from ..thd74 import search
+from ..thd74.cache import SectionCache
+
+logger = getLogger(__name__)
+
+
+class SearchCommand(CliCommand):
+
+    name = "search"
+    help = "search decrypted firmware sections for strings and byte patterns"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("-e", "--exe",
+                            help="path to firmware updater .exe file",
+                            type=Path,
+                            required=True,
+                            action="store")
+
+        parser.add_argument("-t", "--text",
+                            help="search for ASCII text, may be given multiple times",
+                            action="append",
+                            default=[])
+
+        parser.add_argument("-x", "--hex",
+                            help="search for hex byte pattern like `5aa30000`, may be given multiple times",
+                            action="append",
+                            default=[])
+
+        parser.add_argument("-s", "--section",
+                            help="restrict search to firmware section",
+                            type=int,
+                            action="append")
+
+        parser.add_argument("--strings",
+                            help="list printable strings, filtered by --text if given",
+                            action="store_true")
+
+        parser.add_argument("-m", "--min-length",
+                            help=f"minimum length for --strings (default: {search.min_string_length})",
+                            type=int,
+                            default=search.min_string_length,
+                            action="store")
+
+        parser.add_argument("--max-hits",
+                            help=f"stop after this many hits or strings, 0 for all (default: {search.max_hits})",
+                            type=int,
+                            default=search.max_hits,
+                            action="store")
+
+        parser.add_argument("--no-cache",
+                            help="neither read from nor write to the decrypted section cache",
+                            action="store_true")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        for h in args.hex:
+            try:
+                unhexlify(h.replace(" ", ""))
+            except HexError:
+                logger.critical(f"Invalid hex pattern `{h}`")
+                return False
+        if len(args.text) == 0 and len(args.hex) == 0 and not args.strings:
+            logger.critical("Nothing to search for, give --text, --hex or --strings")
+            return False
+        if args.min_length < 1:
+            logger.critical("Minimum string length must be positive")
+            return False
+        if args.max_hits < 0:
+            logger.critical("Maximum number of hits must not be negative")
+            return False
+        return True
+
+    def run(self) -> int:
+        exe = self.args.exe.absolute()
+        if not exe.is_file():
+            logger.critical(f"Unable to open {str(exe)}")
+            return 10
+
+        cache = None if self.args.no_cache else SectionCache()
+        try:
+            index = search.load_index(exe, cache)
+        except ValueError as e:
+            logger.critical(str(e))
+            return 10
+
+        texts = [t.encode("ascii") for t in self.args.text]
+        limit = self.args.max_hits or None
+
+        if self.args.strings:
+            hits = 0
+            for section, address, string in index.strings(self.args.min_length, self.args.section):
+                if len(texts) > 0 and not any(t in string for t in texts):
+                    continue
+                if hits == limit:
+                    logger.warning(f"Stopped after {hits} strings, see --max-hits")
+                    break
+                print(f"{section['name']}\t{address:#010x}\t{string.decode('ascii')}")
+                hits += 1
+            logger.info(f"Found {hits} strings")
+            return 0
+
+        patterns = texts + [unhexlify(h.replace(" ", "")) for h in self.args.hex]
+        hits = 0
+        # Ask for one more to tell whether the limit cut the search short
+        for section, address, pattern in index.find(patterns, self.args.section, limit and limit + 1):
+            if hits == limit:
+                logger.warning(f"Stopped after {hits} hits, see --max-hits")
+                break
+            print(f"{section['name']}\t{address:#010x}\t{pattern!r}")
+            hits += 1
+        logger.info(f"Found {hits} hits")
+        return 0
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from time import sleep
+
+from .base import CliCommand
+
+logger = getLogger(__name__)
+
+
+class SimulateCommand(CliCommand):
+
+    name = "simulate"
+    help = "simulate radios on pseudo-terminals for testing without hardware"
+
+    @staticmethod
+    def setup_args(parser) -> None:
+
+        parser.add_argument("-m", "--mode",
+                            help="operating mode of the simulated radios (default: pcrig)",
+                            choices=["pcrig", "fwprog"],
+                            default="pcrig",
+                            action="store")
+
+        parser.add_argument("-n", "--count",
+                            help="number of simulated radios (default: 1)",
+                            type=int,
+                            default=1,
+                            action="store")
+
+        parser.add_argument("--baud",
+                            help="simulated serial line speed (default: unlimited)",
+                            type=int,
+                            action="store")
+
+        parser.add_argument("--busy-time",
+                            help="seconds a simulated radio is busy clearing a segment (default: 0.3)",
+                            type=float,
+                            default=0.3,
+                            action="store")
+
+        parser.add_argument("--busy-pages",
+                            help="be busy after every this many data pages while flashing (default: never)",
+                            type=int,
+                            default=0,
+                            action="store")
+
+        parser.add_argument("--firmware-version",
+                            help="firmware version reported in PCRIG mode (default: 1.10)",
+                            default="1.10",
+                            action="store")
+
+    @staticmethod
+    def check_args(args) -> bool:
+        if args.count < 1:
+            logger.critical("Need at least one simulated radio")
+            return False
+        if args.busy_pages < 0:
+            logger.critical("Busy pages must not be negative")
+            return False
+        if args.baud is not None and args.baud <= 0:
+            logger.critical("Baud rate must be positive")
+            return False
+        return True
+
+    def run(self) -> int:
+        # Imported here, the simulator needs POSIX pseudo-terminals
+        from ..thd74 import simulator
+        simulators = simulator.start(self.args.count, mode=self.args.mode, baud=self.args.baud,
+                                     busy_time=self.args.busy_time, busy_pages=self.args.busy_pages,
+                                     firmware_version=self.args.firmware_version)
+        for s in simulators:
+            print(f"{s.tty}\t{s.model}\t{s.mode.upper()} mode")
+        logger.info("Simulating until interrupted, point --tty at a device above")
+        while any(s.is_alive() for s in simulators):
+            sleep(0.5)
+        return 0
+
+    def teardown(self):
+        from ..thd74 import simulator
+        simulator.Simulator.stop_instances()
+        simulator.Simulator.join_instances(1.0)
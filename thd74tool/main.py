@@ -4,7 +4,7 @@
 import atexit
 from argparse import ArgumentParser
 from logging import getLogger
-from sys import exit, argv, stdout
+from sys import exit, argv, modules, stdout
 
 import coloredlogs
 from pkg_resources import require
@@ -47,12 +47,16 @@ def get_args(args=None):
     return parser.parse_args(args or argv[1:])
 
 
-# @atexit.register
-# def at_exit():
-#     logger.debug("Waiting for backround threads")
-#     Simulator.stop_instances()
-#     Simulator.join_instances()
-#     logger.debug("Backround threads finished")
+@atexit.register
+def at_exit():
+    # The simulator is POSIX only and imported on demand, nothing to wait for unless it was
+    simulator = modules.get("thd74tool.thd74.simulator")
+    if simulator is None:
+        return
+    logger.debug("Waiting for backround threads")
+    simulator.Simulator.stop_instances()
+    simulator.Simulator.join_instances()
+    logger.debug("Backround threads finished")
 
 
 # This is the entry point used in setup.py
@@ -1,6 +1,18 @@
+from . import aio
 from . import binary
 from . import crypto
+from . import diff
+from . import elf
+from . import flash
+from . import fwprog
+from . import ihex
+from . import image
+from . import pipeline
+from . import plan
 from . import protocol
+from . import registry
+from . import search
 from . import srec
+from . import synth
 
-__all__ = ["binary", "crypto", "protocol", "srec"]
\ No newline at end of file
+__all__ = ["aio", "binary", "crypto", "diff", "elf", "flash", "fwprog", "ihex", "image", "pipeline", "plan", "protocol", "registry", "search", "srec", "synth"]
\ No newline at end of file
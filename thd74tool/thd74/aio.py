@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from collections import deque
+from logging import getLogger
+import os
+from typing import Awaitable, Iterable
+
+from serial import Serial
+
+from .protocol import Message, MessageParser, ProtocolError
+
+logger = getLogger(__name__)
+
+
+async def wait(awaitable: Awaitable, timeout: float or None, what: str):
+    """
+    Await with a timeout, raising the builtin `TimeoutError` like the blocking API
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"{what} timeout")
+
+
+class AsyncTHDTTY(object):
+    """
+    Non-blocking serial communication for Kenwood TH series ham radios. The
+    port's file descriptor is watched by the running event loop, received
+    bytes collect in `buffer` until a reader takes them. Readers only take
+    data once their condition is met, so cancelling a read loses nothing.
+    POSIX only.
+    """
+
+    def __init__(self, tty, timeout=0.2):
+        """
+        :param tty: str TTY device to use
+        :param timeout: float default timeout for reads
+        """
+        self.tty = tty
+        self.default_timeout = timeout
+        self.s = None
+        self.buffer = bytearray()
+        self.__out = bytearray()
+        self.__loop = None
+        self.__waiter = None
+        self.__drained = None
+        self.__error = None
+
+    async def open(self) -> None:
+        logger.debug(f"Connecting to {self.tty}")
+        self.__loop = asyncio.get_running_loop()
+        self.__error = None
+        self.s = Serial(self.tty, timeout=0, write_timeout=0)
+        self.s.reset_input_buffer()
+        self.s.reset_output_buffer()
+        self.__loop.add_reader(self.s.fileno(), self.__readable)
+
+    def close(self) -> None:
+        if self.s is None:
+            return
+        self.__loop.remove_reader(self.s.fileno())
+        self.__loop.remove_writer(self.s.fileno())
+        self.s.close()
+        self.s = None
+        self.__out.clear()
+        self.__error = ConnectionError(f"{self.tty} closed")
+        # Waiters are woken normally and raise `__error` themselves, a future left
+        # with an exception nobody awaits would be reported by the event loop
+        self.__wake()
+        if self.__drained is not None and not self.__drained.done():
+            self.__drained.set_result(None)
+        self.__drained = None
+
+    def __wake(self) -> None:
+        if self.__waiter is not None and not self.__waiter.done():
+            self.__waiter.set_result(None)
+        self.__waiter = None
+
+    def __readable(self) -> None:
+        try:
+            data = os.read(self.s.fileno(), 0x10000)
+        except OSError as e:
+            logger.error(f"{self.tty} read error: {e}")
+            self.close()
+            return
+        if len(data) == 0:
+            # End of file, the other end hung up. The reader would fire again right away
+            logger.error(f"{self.tty} disconnected")
+            self.close()
+            return
+        logger.debug("  IN: %s", repr(data))
+        self.buffer += data
+        self.__wake()
+
+    async def wait_data(self) -> None:
+        """
+        Wait until more bytes arrived
+        """
+        self.__check_open()
+        if self.__waiter is None:
+            self.__waiter = self.__loop.create_future()
+        # Shielded, so a cancelled waiter leaves the shared future to the others
+        await asyncio.shield(self.__waiter)
+        self.__check_open()
+
+    def __check_open(self) -> None:
+        if self.s is None:
+            raise self.__error or ConnectionError(f"{self.tty} not open")
+
+    def read_available(self) -> bytes:
+        """
+        Take all received bytes without waiting
+        """
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    async def __read(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            await self.wait_data()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def __read_until(self, separator: bytes) -> bytes:
+        start = 0
+        while True:
+            end = self.buffer.find(separator, start)
+            if end >= 0:
+                end += len(separator)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            start = max(0, len(self.buffer) - len(separator) + 1)
+            await self.wait_data()
+
+    async def read(self, size: int = 1, timeout: float or None = None) -> bytes:
+        timeout = self.default_timeout if timeout is None else timeout
+        return await wait(self.__read(size), timeout, f"{self.tty} read()")
+
+    async def read_until(self, separator: bytes = b"\r", timeout: float or None = None) -> bytes:
+        timeout = self.default_timeout if timeout is None else timeout
+        return await wait(self.__read_until(separator), timeout, f"{self.tty} read_until()")
+
+    def write(self, data: bytes) -> None:
+        """
+        Queue data for sending, written out as the port accepts it
+        """
+        self.__check_open()
+        logger.debug("OUT: %s" % repr(data))
+        if len(self.__out) == 0:
+            try:
+                written = os.write(self.s.fileno(), data)
+            except BlockingIOError:
+                written = 0
+            data = data[written:]
+            if len(data) == 0:
+                return
+            self.__loop.add_writer(self.s.fileno(), self.__writable)
+        self.__out += data
+
+    def __writable(self) -> None:
+        try:
+            written = os.write(self.s.fileno(), self.__out)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"{self.tty} write error: {e}")
+            self.close()
+            return
+        del self.__out[:written]
+        if len(self.__out) == 0:
+            self.__loop.remove_writer(self.s.fileno())
+            if self.__drained is not None and not self.__drained.done():
+                self.__drained.set_result(None)
+            self.__drained = None
+
+    async def drain(self) -> None:
+        """
+        Wait until all queued data is written
+        """
+        if len(self.__out) == 0:
+            return
+        self.__check_open()
+        if self.__drained is None:
+            self.__drained = self.__loop.create_future()
+        await asyncio.shield(self.__drained)
+        self.__check_open()
+
+    def available(self) -> int:
+        return len(self.buffer)
+
+    def flush_input(self) -> None:
+        if len(self.buffer) > 0:
+            logger.warning(f"{self.tty} flushing {len(self.buffer)} bytes from input buffer")
+        self.buffer.clear()
+        if self.s is not None:
+            self.s.reset_input_buffer()
+
+
+class AsyncTHDProtocol(object):
+    """
+    Awaitable counterpart to `GenericTHDProtocol`. Mode detection returns as
+    soon as the reply is complete instead of sleeping, so many radios can be
+    handled from one event loop.
+    """
+
+    def __init__(self, tty, timeout=0.2):
+        self.conn = AsyncTHDTTY(tty, timeout)
+        self.connected = False
+        self.thd_hardware = False
+        self.fwprog_mode = False
+        self.pcrig_mode = False
+        self.key = None
+        self.model = None
+        self.parser = MessageParser()
+        self.received = deque()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    async def connect(self, timeout: float = 0.5) -> None:
+        await self.conn.open()
+        await self.detect(timeout)
+        self.connected = True
+
+    def close(self) -> None:
+        self.conn.close()
+        self.connected = False
+
+    async def detect(self, timeout: float = 0.5) -> None:
+        """
+        Detect the device mode from its reply to `ID`
+        :param timeout: seconds to wait for the reply, radios in FWPROG mode do not answer
+        """
+        self.conn.flush_input()
+        self.conn.write(b"ID\r")
+        try:
+            r = await self.conn.read_until(b"\r", timeout)
+        except TimeoutError:
+            logger.debug("No response, so probably in FWPROG mode")
+            self.thd_hardware = True
+            self.pcrig_mode = False
+            self.fwprog_mode = True
+            return
+
+        if r.startswith(b"ID "):
+            logger.debug("Response like THD hardware in PCRIG mode")
+            self.model = r[3:].rstrip(b"\r").decode("ascii", "replace")
+            self.thd_hardware = True
+            self.pcrig_mode = True
+            self.fwprog_mode = False
+            return
+
+        logger.warning("Unknown response from `ID` command")
+        self.thd_hardware = False
+        self.pcrig_mode = True
+        self.fwprog_mode = False
+
+    async def get_firmware_version(self, timeout: float or None = None) -> str or None:
+        if not self.pcrig_mode:
+            return None
+        self.conn.write(b"FV\r")
+        try:
+            r = await self.conn.read_until(b"\r", timeout)
+        except TimeoutError:
+            logger.warning("No reply from device to firmware version request")
+            return None
+
+        if not r.startswith(b"FV "):
+            logger.warning("Ignoring strange reply from device to firmware version request.")
+            self.conn.flush_input()
+            return None
+
+        return r[3:].rstrip(b"\r").decode("ascii")
+
+    async def cmd_mode(self, timeout: float or None = None) -> None:
+        if not self.fwprog_mode:
+            return
+        logger.debug("Sending command mode request")
+        self.conn.write(b"FPROMOD")
+        self.key = 0
+        self.parser = MessageParser(self.key)
+        self.received.clear()
+        res = await self.conn.read(2, timeout)
+        if res != b"\x16\x06":
+            raise ProtocolError("Unexpected response to command mode request")
+        logger.debug("Device now ready to receive commands")
+
+    def write(self, data: bytes) -> None:
+        self.conn.write(data)
+
+    async def drain(self) -> None:
+        await self.conn.drain()
+
+    async def send(self, verb: int, nouns: Iterable[bytes] = None, payload: Iterable[bytes] = None) -> None:
+        self.conn.write(bytes(Message(verb, nouns, payload, key=self.key)))
+        await self.conn.drain()
+
+    async def __receive(self) -> Message:
+        while len(self.received) == 0:
+            data = self.conn.read_available()
+            if len(data) > 0:
+                self.received.extend(self.parser.messages(data))
+            else:
+                await self.conn.wait_data()
+        return self.received.popleft()
+
+    async def receive(self, timeout: float or None = None) -> Message:
+        timeout = self.conn.default_timeout if timeout is None else timeout
+        return await wait(self.__receive(), timeout, f"{self.conn.tty} receive()")
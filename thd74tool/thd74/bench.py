@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+from io import StringIO
+import os
+from pathlib import Path
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import perf_counter
+from typing import Callable, List
+
+from . import fwprog, pipeline, srec
+from .binary import UpdaterPayload, sections, get_flash_blobs, identify_blob, parse_blob_records
+from .crypto import decrypt_line, decrypt_lines, decrypt_blob_buffer, blob_offsets
+from .image import MemoryImage
+from .synth import make_updater
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+# Lines fed to the per-byte reference decryption, which is far too slow for whole sections
+reference_lines = 20000
+
+# Identification only looks at a blob's first and last lines, so repeat it to get measurable times
+identify_rounds = 1000
+
+
+def measure(function: Callable, repeat: int) -> float:
+    """
+    Best wall time of `repeat` calls
+    """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def result(seconds: float, lines: int, size: int) -> dict:
+    return {
+        "seconds": seconds,
+        "lines_per_s": lines / seconds if seconds > 0 else 0.0,
+        "mb_per_s": size / seconds / 1e6 if seconds > 0 else 0.0
+    }
+
+
+def run(scale: float = 1.0, repeat: int = 3, seed: int = 0) -> dict:
+    """
+    Benchmark the extraction hot paths on a synthetic updater
+    :param scale: section sizes relative to their typical lengths
+    :param repeat: runs per benchmark, the fastest one counts
+    :param seed: random seed for the synthetic updater
+    :return: dict of benchmark name to seconds, lines/s and MB/s
+    """
+    sizes = [max(int(s["typical_length"] * scale), 2) for s in sections]
+    logger.info(f"Generating synthetic updater with {sum(sizes)} bytes of section data")
+    exe, images = make_updater(sizes, seed)
+
+    results = {}
+    with NamedTemporaryFile(suffix=".exe", delete=False) as f:
+        f.write(exe)
+    try:
+        payload = None
+
+        def load():
+            nonlocal payload
+            if payload is not None:
+                payload.close()
+            payload = UpdaterPayload(f.name)
+            return list(get_flash_blobs(payload))
+
+        results["load"] = result(measure(load, repeat), 0, len(exe))
+        blobs = load()
+        results["load"]["lines_per_s"] = len(payload) / results["load"]["seconds"]
+
+        # FIRMWARE is the largest section and representative for all others
+        blob = blobs[0]
+        section = identify_blob(blob, 0)
+        lines = list(blob)
+        offsets = list(blob_offsets(lines, section["permute_offset"], section["end_offset"]))
+        text_size = sum(map(len, lines))
+
+        sample = lines[:reference_lines]
+        results["decrypt_line"] = result(measure(lambda: [decrypt_line(line, i) for line, i in zip(sample, offsets)],
+                                                 repeat), len(sample), sum(map(len, sample)))
+        results["decrypt_lines"] = result(measure(lambda: decrypt_lines(lines, offsets), repeat),
+                                          len(lines), text_size)
+        results["decrypt_blob_buffer"] = result(
+            measure(lambda: decrypt_blob_buffer(blob.raw, section["permute_offset"], section["end_offset"]), repeat),
+            len(lines), text_size)
+
+        records = decrypt_blob_buffer(blob.raw, section["permute_offset"], section["end_offset"])
+        results["parse"] = result(
+            measure(lambda: sum(1 for _ in parse_blob_records(records, section["memory_address"])), repeat),
+            len(lines), len(images[0]))
+
+        def identify():
+            for _ in range(identify_rounds):
+                for n, b in zip(range(len(blobs)), blobs):
+                    identify_blob(b, n)
+
+        results["identify"] = result(measure(identify, repeat), identify_rounds * len(blobs), 0)
+
+        def emit():
+            srec.write(StringIO(), 32, parse_blob_records(records, section["memory_address"]), section["name"])
+
+        results["srec"] = result(measure(emit, repeat), len(lines), len(images[0]))
+
+        _, image = MemoryImage.from_records(parse_blob_records(records, section["memory_address"])).flatten()
+
+        def packetize():
+            return sum(map(len, fwprog.SegmentPacketizer(section["name"], section["memory_address"], image).messages()))
+
+        results["packetize"] = result(measure(packetize, repeat), len(lines), len(images[0]))
+
+        def stream():
+            with TemporaryDirectory() as path:
+                pipeline.extract(Path(f.name), Path(path), [0, 1, 2, 3, 4])
+
+        results["pipeline"] = result(measure(stream, repeat), len(payload), sum(map(len, images[:5])))
+
+        payload.close()
+    finally:
+        os.unlink(f.name)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.25) -> List[str]:
+    """
+    Benchmarks whose throughput dropped below `baseline` by more than `tolerance`.
+    Throughput is compared in lines/s, so results of different scales are comparable.
+    """
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        if r["lines_per_s"] * (1 + tolerance) < baseline[name]["lines_per_s"]:
+            regressions.append(name)
+    return regressions
@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 
+from array import array
 from binascii import unhexlify
-from functools import reduce
+from hashlib import sha256
+import mmap
+import re
 import sys
 from struct import unpack
 from typing import List, Iterable, Generator, Tuple
 
-from .crypto import decrypt_line
+from .crypto import keystream_table, column_mask, decrypt_blob_buffer, add_bytes
+from .image import MemoryImage
 
 from logging import getLogger
 logger = getLogger(__name__)
 
 
+class BlobError(Exception):
+    pass
+
+
+class ChecksumError(BlobError):
+    """
+    Record checksum mismatch, `indices` lists the failed records
+    """
+
+    def __init__(self, message: str, indices: List[int]):
+        super().__init__(message)
+        self.indices = indices
+
+
 sections = [
     {
         "name": "FIRMWARE",
@@ -93,6 +111,41 @@ sections = [
 ]
 
 
+# Changes whenever the section table does, for invalidating derived data
+sections_version = sha256(repr(sections).encode("ascii")).hexdigest()[:16]
+
+sections_by_permute_offset = dict((s["permute_offset"], s) for s in sections)
+
+# Known plaintext of the first header line of every blob, after the padding nibble:
+# payload length 2, noun 0, verb 4 (new block), block number 0
+header_plaintext = b"\x02\x00\x00\x04\x00\x00"
+
+
+def __header_ciphertext(i: int) -> bytes:
+    key = keystream_table[8][i][1:1 + len(header_plaintext)]
+    mask = column_mask[1:1 + len(header_plaintext)]
+    return bytes(((p - k) % 256) ^ m for p, k, m in zip(header_plaintext, key, mask))
+
+
+# Inverted keystream, maps a first header line's ciphertext to its permute offset
+permute_offset_map = dict((__header_ciphertext(i), i) for i in range(256))
+
+
+def derive_permute_offset(header: str) -> int or None:
+    """
+    Derive a blob's permute offset from the ciphertext of its first header line
+    :param header: 15-char encrypted header line
+    :return: permute offset or None if the line is no valid block header
+    """
+    if len(header) != 15:
+        return None
+    try:
+        data = unhexlify("0" + header)
+    except ValueError:
+        return None
+    return permute_offset_map.get(data[1:1 + len(header_plaintext)])
+
+
 def extract_from_exe(exe: bytes) -> List[str] or None:
     try:
         offset = exe.index(b"TH-D74 Firmware Updater") + 24
@@ -106,19 +159,182 @@ def extract_from_exe(exe: bytes) -> List[str] or None:
     return exe[start:end].decode("ascii").split()
 
 
-def get_flash_blobs(data: Iterable[str]) -> Iterable[List[str]]:
-    blob = []
-    for line in data:
-        if line.startswith("$"):
+updater_marker = b"TH-D74 Firmware Updater"
+
+
+class PayloadLines(object):
+    """
+    Zero-copy line index over a buffer of whitespace-separated hex lines.
+    Lines are kept as offsets and lengths into the buffer and are only sliced
+    or decoded on demand. The index is built when first needed.
+    """
+
+    line_pattern = re.compile(rb"\S+")
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.__offsets = None
+        self.__lengths = None
+
+    def __index(self) -> None:
+        # Built on first use, streaming readers of `data` never need it
+        self.__offsets = array("L")
+        self.__lengths = array("H")
+        for m in self.line_pattern.finditer(self.data):
+            self.__offsets.append(m.start())
+            self.__lengths.append(m.end() - m.start())
+
+    @property
+    def line_offsets(self) -> array:
+        if self.__offsets is None:
+            self.__index()
+        return self.__offsets
+
+    @property
+    def line_lengths(self) -> array:
+        if self.__lengths is None:
+            self.__index()
+        return self.__lengths
+
+    def __len__(self):
+        return len(self.line_offsets)
+
+    def line(self, n: int) -> memoryview:
+        offset = self.line_offsets[n]
+        return self.data[offset:offset + self.line_lengths[n]]
+
+    def lines(self, start: int, end: int) -> memoryview:
+        """
+        Raw payload text spanning lines `start` up to, but excluding, `end`
+        """
+        if start >= end:
+            return self.data[0:0]
+        return self.data[self.line_offsets[start]:self.line_offsets[end - 1] + self.line_lengths[end - 1]]
+
+    def __getitem__(self, n: int) -> str:
+        return str(self.line(n), "ascii")
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+class UpdaterPayload(PayloadLines):
+    """
+    Memory-mapped, zero-copy view of the hex payload embedded in a firmware updater
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        try:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.file.close()
+            raise ValueError(f"No firmware payload in `{path}`")
+
+        offset = self.mmap.find(updater_marker)
+        if offset < 0:
+            self.mmap.close()
+            self.file.close()
+            raise ValueError(f"No firmware payload in `{path}`")
+        offset += 24
+        length = unpack("<L", self.mmap[offset:offset + 4])[0]
+        self.start = offset + 4
+        self.end = min(self.start + length, len(self.mmap))
+
+        super().__init__(memoryview(self.mmap)[self.start:self.end])
+
+    def close(self):
+        self.data.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            logger.debug(f"Views into `{self.path}` still exported, leaving unmap to garbage collection")
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Blob(object):
+    """
+    Lightweight descriptor of one encrypted blob within a payload.
+    Holds line positions only, lines are decoded when the blob is iterated.
+    """
+
+    def __init__(self, payload: PayloadLines, line_numbers: range or array, headers: array):
+        self.payload = payload
+        self.line_numbers = line_numbers
+        self.headers = headers  # blob-relative line numbers of block headers
+
+    @classmethod
+    def from_text(cls, text: bytes) -> "Blob":
+        """
+        Build a blob from its raw hex text, for example after pickling
+        """
+        return next(get_flash_blobs(PayloadLines(text)))
+
+    def __reduce__(self):
+        return Blob.from_text, (bytes(self.raw),)
+
+    @property
+    def raw(self) -> memoryview or bytes:
+        """
+        Raw ciphertext lines of the blob as one contiguous buffer
+        """
+        if isinstance(self.line_numbers, range):
+            return self.payload.lines(self.line_numbers.start, self.line_numbers.stop)
+        return b"\n".join(self.payload.line(n) for n in self.line_numbers)
+
+    @property
+    def lengths(self) -> Iterable[int]:
+        if isinstance(self.line_numbers, range):
+            return self.payload.line_lengths[self.line_numbers.start:self.line_numbers.stop]
+        return [self.payload.line_lengths[n] for n in self.line_numbers]
+
+    def __len__(self):
+        return len(self.line_numbers)
+
+    def __getitem__(self, n: int) -> str:
+        return self.payload[self.line_numbers[n]]
+
+    def __iter__(self):
+        for n in self.line_numbers:
+            yield self.payload[n]
+
+
+def get_flash_blobs(data: PayloadLines or Iterable[str]) -> Iterable[Blob]:
+    if not isinstance(data, PayloadLines):
+        data = PayloadLines("\n".join(data).encode("ascii"))
+
+    lengths = data.line_lengths
+    start = None
+    skipped = []
+    headers = array("L")
+    for n in range(len(data)):
+        if data.data[data.line_offsets[n]] == 0x24:  # "$" line
+            if start is not None:
+                skipped.append(n)
             continue
-        if len(line) == 15 and (len(blob) % 4097) == 0:  # block header
-            blob.append(line)
-        elif len(line) == 11:  # blob end record
-            blob.append(line)
-            yield blob
-            blob = []
-        else:
-            blob.append(line)
+        if start is None:
+            start = n
+            skipped = []
+            headers = array("L")
+        size = n - start - len(skipped)
+        if lengths[n] == 15 and (size % 4097) == 0:  # block header
+            headers.append(size)
+        elif lengths[n] == 11:  # blob end record
+            if len(skipped) == 0:
+                line_numbers = range(start, n + 1)
+            else:
+                skip = set(skipped)
+                line_numbers = array("L", (k for k in range(start, n + 1) if k not in skip))
+            yield Blob(data, line_numbers, headers)
+            start = None
 
 
 def get_data_lines(data: Iterable[str], as_bytes = False) -> Iterable[List[str]]:
@@ -135,21 +351,24 @@ def identify_blob(blob: List[str], blob_number) -> dict or None:
     if len(blob[0]) != 15 or len(blob[-1]) != 11:
         logger.debug(f"Unexpected blob format for blob [{blob_number}]")
         return None
-    # Try to ID by permute offset
-    permute_offsets = [s["permute_offset"] for s in sections]
-    for permute_offset in permute_offsets:
-        test_line = decrypt_line(blob[0], permute_offset)
-        if "020000040000" in test_line:
-            return sections[permute_offsets.index(permute_offset)].copy()
-    return None
+    permute_offset = derive_permute_offset(blob[0])
+    if permute_offset is None:
+        logger.debug(f"Unable to derive permute offset for blob [{blob_number}]")
+        return None
+    try:
+        return sections_by_permute_offset[permute_offset].copy()
+    except KeyError:
+        logger.info(f"Blob [{blob_number}] has unknown permute offset {permute_offset}")
+        return None
 
 
-def count_blob_bytes(blob: List[str]) -> int:
+def count_blob_bytes(blob: Blob or List[str]) -> int:
+    lengths = blob.lengths if isinstance(blob, Blob) else [len(line) for line in blob]
     size = 0
-    for n, line in zip(range(len(blob) - 1), blob):
-        if len(line) == 15 and (n % 4097) == 0:
+    for n, length in zip(range(len(lengths) - 1), lengths):
+        if length == 15 and (n % 4097) == 0:
             continue  # likely header line
-        size += (len(line) - 11) >> 1
+        size += (length - 11) >> 1
     return size
 
 
@@ -164,7 +383,7 @@ def parse_blob_line(line: str, verify=True) -> dict:
         "checksum": int(line[-2:], 16)
     }
     if verify and not verify_record(r):
-        raise Exception("parse_data_line: checksum error")  # TODO: proper exception
+        raise BlobError("parse_data_line: checksum error")
     return r
 
 
@@ -173,7 +392,7 @@ def record_checksum(r: dict) -> int:
     check += r["noun"] >> 8
     check += r["noun"] & 255
     check += r["verb"]
-    check += reduce(lambda a, b: a + b, r["payload"], 0)
+    check += sum(r["payload"])
     check += r["checksum"]
     return check % 256
 
@@ -182,6 +401,170 @@ def verify_record(r: dict) -> bool:
     return record_checksum(r) == 0
 
 
+class RecordTable(object):
+    """
+    Columnar view of a buffer of binary records as produced by `crypto.decrypt_blob_buffer()`.
+    Records are described by compact arrays of absolute addresses, verbs, payload
+    lengths and payload offsets into the record buffer, which doubles as payload buffer.
+    """
+
+    # Records scanned at a time when looking for the end of a run
+    window = 4096
+
+    def __init__(self, records: bytes, start_address: int = 0):
+        self.buffer = memoryview(records)
+        self.addresses = array("L")
+        self.verbs = array("B")
+        self.lengths = array("B")
+        self.offsets = array("L")
+        # Runs of equally long records as (first record, byte offset, record size, count)
+        self.runs = []
+
+        view = self.buffer
+        block_address = start_address
+        pos = 0
+        end = len(view)
+        while pos < end:
+            record_size = view[pos + 1] + 6
+            if pos + record_size > end:
+                raise BlobError(f"Truncated record [{len(self.verbs)}]")
+            # Records are self-delimiting, so while the length column of a stride of
+            # `record_size` keeps its value, every stride is aligned with a record.
+            length = bytes([record_size - 6])
+            count = 0
+            while True:
+                window = pos + count * record_size
+                column = view[window + 1:min(end, window + self.window * record_size):record_size].tobytes()
+                matched = len(column) - len(column.lstrip(length))
+                count += matched
+                if matched < len(column) or len(column) == 0:
+                    break
+            while pos + count * record_size > end:
+                count -= 1
+            verbs = view[pos + 4:pos + count * record_size:record_size].tobytes()
+            first = len(self.verbs)
+
+            if verbs.count(4) == 0:
+                nouns = bytearray(2 * count)
+                nouns[0::2] = view[pos + 2:pos + count * record_size:record_size]
+                nouns[1::2] = view[pos + 3:pos + count * record_size:record_size]
+                nouns = array("H", bytes(nouns))
+                if sys.byteorder == "little":
+                    nouns.byteswap()
+                self.addresses.extend(map(block_address.__add__, nouns))
+            else:
+                for n in range(count):
+                    record = pos + n * record_size
+                    if verbs[n] == 4:  # new block
+                        block_address = int.from_bytes(view[record + 5:record + record_size - 1], "big") * 65536 \
+                                        + start_address
+                    self.addresses.append(block_address + ((view[record + 2] << 8) | view[record + 3]))
+
+            self.runs.append([first, pos, record_size, count])
+            self.verbs.frombytes(verbs)
+            self.lengths.frombytes(length * count)
+            self.offsets.extend(range(pos + 5, pos + 5 + count * record_size, record_size))
+            pos += count * record_size
+
+    def __len__(self):
+        return len(self.verbs)
+
+    def payload(self, n: int) -> memoryview:
+        return self.buffer[self.offsets[n]:self.offsets[n] + self.lengths[n]]
+
+    def verify(self) -> List[int]:
+        """
+        Verify all record checksums, one column of a run of equally long records at a time
+        :return: indices of records with checksum errors
+        """
+        failed = []
+        for first, pos, record_size, count in self.runs:
+            total = bytes(count)
+            for column in range(1, record_size):  # skip padding
+                start = pos + column
+                total = add_bytes(total, self.buffer[start:start + record_size * count:record_size].tobytes())
+            if total.count(0) != count:
+                failed += [first + k for k in range(count) if total[k] != 0]
+        return failed
+
+    def data(self) -> Iterable[Tuple[int, memoryview]]:
+        """
+        (address, payload view) tuples of all data records up to the end record
+        """
+        buffer = self.buffer
+        for n, address, offset, length, verb in zip(range(len(self.verbs)), self.addresses, self.offsets,
+                                                    self.lengths, self.verbs):
+            if verb == 0:  # data record
+                yield address, buffer[offset:offset + length]
+            elif verb == 1:  # end of blob
+                return
+            elif verb != 4:
+                raise BlobError(f"Unknown record type {verb:#04x} in record [{n}]")
+
+    @property
+    def data_size(self) -> int:
+        return sum(length for length, verb in zip(self.lengths, self.verbs) if verb == 0)
+
+
+def parse_blob_records(records: bytes, start_address: int = 0, verify: bool = True) -> Iterable[Tuple]:
+    """
+    Buffer-based equivalent of `parse_blob()` for binary records
+    :param records: concatenated plaintext records
+    :param start_address: memory address of the section
+    :param verify: check all record checksums before yielding anything
+    :return: generator of (address, payload view) tuples
+    """
+    table = RecordTable(records, start_address)
+    if verify:
+        failed = table.verify()
+        if len(failed) > 0:
+            raise ChecksumError(f"Checksum error in {len(failed)} records, first is [{failed[0]}]", failed)
+    yield from table.data()
+
+
+def assemble(records: Iterable[Tuple[int, bytes]], fill: int = 0xff) -> Tuple[int, bytearray]:
+    """
+    Assemble (address, payload) records into one contiguous memory image.
+    Gaps are filled with `fill`, the erased flash state by default.
+    :param records: (address, payload) tuples as yielded by `parse_blob_records()`
+    :param fill: value for bytes not covered by any record
+    :return: (base address, image) tuple
+    """
+    return MemoryImage.from_records(records).flatten(fill)
+
+
+def section_version(image: bytes, section: dict, base: int = 0) -> str or None:
+    """
+    Version string of a section, read from its memory image
+    :param image: section memory image
+    :param section: section dict
+    :param base: offset of the image relative to the section start
+    """
+    if section["version_offset"] is None:
+        return None
+    offset = section["version_offset"] - base
+    data = bytes(image[max(offset, 0):offset + section["version_length"]])
+    return data.decode("ascii", "replace").strip("\x00 ")
+
+
+def blob_version(blob: Blob, section: dict) -> str or None:
+    """
+    Version string of a section, decrypting only as many lines as needed
+    """
+    if section["version_offset"] is None:
+        return None
+    end = section["version_offset"] + section["version_length"]
+    lines = 2 + end // 16
+    while True:
+        lines = min(lines, len(blob))
+        text = b"\n".join(blob.payload.line(n) for n in blob.line_numbers[:lines])
+        records = decrypt_blob_buffer(text, section["permute_offset"], section["end_offset"])
+        base, image = assemble(parse_blob_records(records, 0))
+        if base + len(image) >= end or lines == len(blob):
+            return section_version(image, section, base)
+        lines *= 2
+
+
 def parse_blob(blob: Iterable[str], start_address: int = 0) -> Iterable[Tuple]:
     block_address = start_address
     for record in map(parse_blob_line, blob):
@@ -193,4 +576,4 @@ def parse_blob(blob: Iterable[str], start_address: int = 0) -> Iterable[Tuple]:
         elif record["verb"] == 1:  # end of blob
             return  # TODO: check sanity, all lines consumed
         else:
-            raise Exception("parse_blob: unknown record type")  # TODO: proper exception
+            raise BlobError("parse_blob: unknown record type")
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from hashlib import sha256
+import json
+from logging import getLogger
+import os
+from pathlib import Path
+from shutil import rmtree
+from struct import pack, unpack
+from typing import List, Tuple
+
+from .binary import Blob, UpdaterPayload, sections_version, sections_by_permute_offset, identify_blob, \
+    derive_permute_offset, count_blob_bytes, blob_version, get_flash_blobs, parse_blob_records
+from .crypto import decrypt_blob_buffer
+from .image import MemoryImage
+
+logger = getLogger(__name__)
+
+
+def default_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "thd74tool"
+
+
+def file_digest(path: Path) -> str:
+    h = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_manifest(blobs: List[Blob]) -> dict:
+    """
+    Describe all blobs of an updater: section name, size and version string
+    """
+    manifest = {
+        "sections_version": sections_version,
+        "blobs": []
+    }
+    for n, blob in zip(range(len(blobs)), blobs):
+        section = identify_blob(blob, n)
+        if section is None:
+            manifest["blobs"].append({
+                "name": None,
+                "permute_offset": derive_permute_offset(blob[0]),
+                "size": count_blob_bytes(blob),
+                "version": None
+            })
+        else:
+            manifest["blobs"].append({
+                "name": section["name"],
+                "permute_offset": section["permute_offset"],
+                "size": count_blob_bytes(blob),
+                "version": blob_version(blob, section)
+            })
+    return manifest
+
+
+def manifest_section(entry: dict) -> dict or None:
+    """
+    Section dict for a manifest blob entry, None for unknown blobs
+    """
+    if entry["name"] is None:
+        return None
+    section = sections_by_permute_offset[entry["permute_offset"]].copy()
+    section["size"] = entry["size"]
+    section["version"] = entry["version"]
+    return section
+
+
+class CacheEntry(object):
+    """
+    Cached decryption results for one updater. The manifest lists all blobs
+    of the updater, decrypted record buffers are stored per blob as they are
+    produced. Entries are plain paths, so they can be handed to worker processes.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    @property
+    def manifest_file(self) -> Path:
+        return self.path / "manifest.json"
+
+    def records_file(self, n: int) -> Path:
+        return self.path / f"{n}.rec"
+
+    def load_manifest(self) -> dict or None:
+        try:
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self.touch()
+        return manifest
+
+    def save_manifest(self, manifest: dict) -> None:
+        self.__write(self.manifest_file, json.dumps(manifest, indent=2).encode("utf-8"))
+
+    def has_records(self, n: int) -> bool:
+        return self.records_file(n).is_file()
+
+    def load_records(self, n: int) -> bytes or None:
+        try:
+            with open(self.records_file(n), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save_records(self, n: int, records: bytes) -> None:
+        self.__write(self.records_file(n), records)
+
+    @contextmanager
+    def records_writer(self, n: int):
+        """
+        Binary file to stream decrypted records into. The cached records are
+        only replaced once the file is closed without error.
+        """
+        path = self.records_file(n)
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        try:
+            with open(tmp, "wb") as f:
+                yield f
+            os.replace(tmp, path)
+            self.touch()
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def image_file(self, n: int) -> Path:
+        return self.path / f"{n}.img"
+
+    def load_image(self, n: int) -> Tuple[int, bytes] or None:
+        """
+        Flattened memory image of a blob as (start address, data) tuple
+        """
+        try:
+            with open(self.image_file(n), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return unpack("<L", data[:4])[0], data[4:]
+
+    def save_image(self, n: int, start: int, image: bytes) -> None:
+        self.__write(self.image_file(n), pack("<L", start) + image)
+
+    def strings_file(self, n: int, min_length: int) -> Path:
+        return self.path / f"{n}-{min_length}.str"
+
+    def load_strings(self, n: int, min_length: int) -> List[Tuple[int, bytes]] or None:
+        """
+        Printable strings of a blob's memory image as (absolute address, string) tuples
+        """
+        try:
+            with open(self.strings_file(n, min_length), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        strings = []
+        for line in data.splitlines():
+            address, string = line.split(b"\t", 1)
+            strings.append((int(address, 16), string))
+        return strings
+
+    def save_strings(self, n: int, min_length: int, strings: List[Tuple[int, bytes]]) -> None:
+        # Printable strings contain neither tabs nor newlines
+        self.__write(self.strings_file(n, min_length),
+                     b"".join(b"%x\t%s\n" % (address, string) for address, string in strings))
+
+    def touch(self) -> None:
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def size(self) -> int:
+        return sum(f.stat().st_size for f in self.path.iterdir() if f.is_file())
+
+    def __write(self, path: Path, data: bytes) -> None:
+        # Write atomically, parallel export workers may share an entry
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.touch()
+
+
+class SectionCache(object):
+    """
+    Content-addressed on-disk cache of decrypted firmware sections, keyed by
+    the updater's SHA-256 and the section table version
+    """
+
+    def __init__(self, path: Path or None = None, max_size: int = 1 << 30):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+
+    @staticmethod
+    def key(exe: Path) -> str:
+        return f"{file_digest(exe)}-{sections_version}"
+
+    def entry(self, exe: Path) -> CacheEntry:
+        key = self.key(exe)
+        logger.debug(f"Cache key for `{exe}` is {key}")
+        return CacheEntry(self.path / key)
+
+    def entries(self) -> list:
+        if not self.path.is_dir():
+            return []
+        return [CacheEntry(p) for p in self.path.iterdir() if p.is_dir()]
+
+    def evict(self, keep: CacheEntry or None = None) -> None:
+        """
+        Remove least recently used entries until the cache fits `max_size`
+        :param keep: entry to never evict, typically the one in use
+        """
+        entries = [(e.path.stat().st_mtime, e.size, e) for e in self.entries()]
+        total = sum(size for _, size, _ in entries)
+        for _, size, e in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_size:
+                break
+            if keep is not None and e.path == keep.path:
+                continue
+            logger.debug(f"Evicting cache entry `{e.path.name}`")
+            rmtree(e.path, ignore_errors=True)
+            total -= size
+
+
+def load_sections(exe: Path, cache: SectionCache or None = None) -> List[Tuple[dict or None, bytes or None]]:
+    """
+    Decrypt all known sections of an updater, serving them from the cache where possible
+    :param exe: path to updater
+    :param cache: section cache, None to always decrypt
+    :return: (section dict, record buffer) per blob, both None for unknown blobs
+    """
+    entry = cache.entry(exe) if cache is not None else None
+    manifest = entry.load_manifest() if entry is not None else None
+    if manifest is not None and all(entry.has_records(n) for n, e in zip(range(len(manifest["blobs"])), manifest["blobs"])
+                                    if e["name"] is not None):
+        logger.info(f"Serving all sections of `{str(exe)}` from cache")
+        result = []
+        for n, e in zip(range(len(manifest["blobs"])), manifest["blobs"]):
+            section = manifest_section(e)
+            result.append((section, entry.load_records(n) if section is not None else None))
+        return result
+
+    logger.info(f"Reading updater from `{str(exe)}`")
+    with UpdaterPayload(exe) as payload:
+        blobs = list(get_flash_blobs(payload))
+        if manifest is None:
+            manifest = make_manifest(blobs)
+            if entry is not None:
+                entry.save_manifest(manifest)
+        result = []
+        for n, blob in zip(range(len(blobs)), blobs):
+            section = manifest_section(manifest["blobs"][n])
+            if section is None:
+                result.append((None, None))
+                continue
+            records = entry.load_records(n) if entry is not None else None
+            if records is None:
+                records = bytes(decrypt_blob_buffer(blob.raw, section["permute_offset"], section["end_offset"]))
+                if entry is not None:
+                    entry.save_records(n, records)
+            result.append((section, records))
+    if cache is not None:
+        cache.evict(keep=entry)
+    return result
+
+
+def load_images(exe: Path, cache: SectionCache or None = None) -> List[Tuple[dict, MemoryImage] or None]:
+    """
+    Memory images of all known sections of an updater
+    :param exe: path to updater
+    :param cache: section cache, None to always decrypt
+    :return: (section dict, memory image) per blob, None for unknown blobs
+    """
+    images = []
+    for section, records in load_sections(exe, cache):
+        if section is None:
+            images.append(None)
+            continue
+        records = parse_blob_records(records, section["memory_address"])
+        images.append((section, MemoryImage.from_records(records, section["name"])))
+    return images
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from binascii import unhexlify
-from typing import List, Iterable, Generator
+from binascii import hexlify, unhexlify
+from typing import List, Iterable, Generator, Sequence
 
 from logging import getLogger
 logger = getLogger(__name__)
@@ -37,7 +37,112 @@ def decrypt_line(data: str, i: int = 0) -> str:
         return bytes(res).hex()
 
 
-def decrypt_blob(blob: Iterable[str], start_offset: int = 0, end_offset: int = 49) -> Iterable[str]:
+# Longest encrypted line in bytes, including the nibble-padding of odd-length lines.
+# Keys are right-aligned to this length, see `decrypt_line()`.
+max_line_bytes = 22
+
+
+def __keystream_row(i: int, length: int) -> bytes:
+    # Decryption is `x - z` for even and `z - x` for odd columns, which equals
+    # `x + (-z)` and `~x + (z + 1)` respectively. The row holds the additive part.
+    i -= 11
+    jd = max_line_bytes - length
+    return bytes(((z_ij(i, j + jd) + 1) if j % 2 == 1 else -z_ij(i, j + jd)) % 256 for j in range(length))
+
+
+# keystream_table[length][i] holds the additive keystream for a line of `length` bytes at offset `i`
+keystream_table = [[__keystream_row(i, length) for i in range(256)] for length in range(max_line_bytes + 1)]
+
+# Inversion mask for odd columns, left-aligned
+column_mask = b"\x00\xff" * (max_line_bytes // 2)
+
+
+def add_bytes(a: bytes, b: bytes) -> bytes:
+    """
+    Byte-wise addition modulo 256 of two equally long byte strings.
+    Works on the whole buffer at once by treating it as one big integer
+    and keeping carries from spilling into neighbouring bytes.
+    """
+    n = len(a)
+    assert len(b) == n
+    if n == 0:
+        return b""
+    low = int.from_bytes(b"\x7f" * n, "big")
+    x = int.from_bytes(a, "big")
+    y = int.from_bytes(b, "big")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & ~low)).to_bytes(n, "big")
+
+
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    """
+    Byte-wise xor of two equally long byte strings
+    """
+    n = len(a)
+    assert len(b) == n
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(n, "big")
+
+
+def decrypt_bytes(data: bytes, offsets: Sequence[int], lengths: Sequence[int]) -> bytes:
+    """
+    Decrypt a buffer of concatenated, nibble-padded binary lines in one pass.
+    :param data: concatenated ciphertext lines
+    :param offsets: keystream offset `i` for every line
+    :param lengths: length in bytes of every line
+    :return: concatenated plaintext lines
+    """
+    key = b"".join(keystream_table[length][i % 256] for i, length in zip(offsets, lengths))
+    mask = b"".join(column_mask[:length] for length in lengths)
+    return add_bytes(xor_bytes(data, mask), key)
+
+
+def decrypt_lines(lines: Sequence[str], offsets: Sequence[int]) -> List[str]:
+    """
+    Table-driven equivalent of `decrypt_line()` for many lines at once.
+    :param lines: hex encoded ciphertext lines
+    :param offsets: keystream offset `i` for every line
+    :return: list of hex encoded plaintext lines
+    """
+    lengths = [(len(line) + 1) >> 1 for line in lines]
+    data = unhexlify("".join("0" + line if len(line) % 2 == 1 else line for line in lines))
+    plain = hexlify(decrypt_bytes(data, offsets, lengths)).decode("ascii")
+    result = []
+    pos = 0
+    for line, length in zip(lines, lengths):
+        end = pos + 2 * length
+        result.append(plain[end - len(line):end])
+        pos = end
+    return result
+
+
+def decrypt_line_fast(data: str, i: int = 0) -> str:
+    """
+    Table-driven equivalent of `decrypt_line()`
+    """
+    return decrypt_lines([data], [i])[0]
+
+
+def encrypt_bytes(data: bytes, offsets: Sequence[int], lengths: Sequence[int]) -> bytes:
+    """
+    Inverse of `decrypt_bytes()`
+    """
+    key = b"".join(keystream_table[length][i % 256] for i, length in zip(offsets, lengths))
+    mask = b"".join(column_mask[:length] for length in lengths)
+    # -key is ~key + 1, byte-wise
+    negative_key = add_bytes(xor_bytes(key, b"\xff" * len(key)), b"\x01" * len(key))
+    return xor_bytes(add_bytes(data, negative_key), mask)
+
+
+def encrypt_line(data: str, i: int = 0) -> str:
+    """
+    Inverse of `decrypt_line()`, only needed for generating test data
+    """
+    odd = len(data) % 2 == 1
+    raw = unhexlify("0" + data) if odd else unhexlify(data)
+    res = encrypt_bytes(raw, [i], [len(raw)]).hex()
+    return res[1:] if odd else res
+
+
+def blob_offsets(blob: Iterable[str], start_offset: int = 0, end_offset: int = 49) -> Iterable[int]:
     block_number = -1
     for line in blob:
         if len(line) == 15:  # block header line
@@ -45,10 +150,73 @@ def decrypt_blob(blob: Iterable[str], start_offset: int = 0, end_offset: int = 4
             i = (171 * block_number + start_offset) % 256
         if len(line) == 11:  # last line in blob
             i = (171 * block_number + start_offset + end_offset) % 256
-        yield decrypt_line(line, i)
+        yield i
         i += 1
 
 
+def decrypt_blob(blob: Iterable[str], start_offset: int = 0, end_offset: int = 49) -> Iterable[str]:
+    blob = list(blob)
+    yield from decrypt_lines(blob, list(blob_offsets(blob, start_offset, end_offset)))
+
+
+def blob_schedule(lengths: Sequence[int], start_offset: int = 0, end_offset: int = 49,
+                  first_block: int = 0) -> List[int]:
+    """
+    Keystream offsets for every line of a blob, given the hex lengths of its lines.
+    Same rules as `blob_offsets()`: every 15-char block header resets the offset to
+    `171 * block_number + start_offset`, the 11-char end record uses `end_offset`.
+    :param first_block: number of the first block header in `lengths`, for
+                        scheduling a run of lines from the middle of a blob
+    """
+    offsets = []
+    block_number = first_block - 1
+    i = start_offset
+    for length in lengths:
+        if length == 15:  # block header line
+            block_number += 1
+            i = (171 * block_number + start_offset) % 256
+        if length == 11:  # last line in blob
+            i = (171 * block_number + start_offset + end_offset) % 256
+        offsets.append(i)
+        i += 1
+    return offsets
+
+
+def decrypt_blob_buffer(buf: bytes, start_offset: int = 0, end_offset: int = 49) -> bytearray:
+    """
+    Decrypt a whole blob given as its raw, whitespace-separated hex text.
+    Every line becomes one nibble-padded binary record of the form
+    [padding] [payload length] [2 byte noun] [verb] [payload] [checksum],
+    so records can be walked by their length byte.
+    :param buf: raw ciphertext lines of one blob
+    :param start_offset: section permutation offset
+    :param end_offset: offset adjustment for the blob end record
+    :return: concatenated plaintext records
+    """
+    return decrypt_blob_lines(bytes(buf).split(), start_offset, end_offset)
+
+
+def decrypt_blob_lines(lines: List[bytes], start_offset: int = 0, end_offset: int = 49,
+                       first_block: int = 0) -> bytearray:
+    """
+    Decrypt consecutive ciphertext lines of a blob, see `decrypt_blob_buffer()`.
+    Blobs may be decrypted piecewise in runs of lines starting at a block header.
+    :param lines: hex ciphertext lines
+    :param start_offset: section permutation offset
+    :param end_offset: offset adjustment for the blob end record
+    :param first_block: number of the block the first line belongs to
+    :return: concatenated plaintext records
+    """
+    lengths = list(map(len, lines))
+    if all(length & 1 for length in lengths):
+        hex_data = b"0" + b"0".join(lines)
+    else:
+        hex_data = b"".join(b"0" + line if len(line) & 1 else line for line in lines)
+    return bytearray(decrypt_bytes(unhexlify(hex_data),
+                                   blob_schedule(lengths, start_offset, end_offset, first_block),
+                                   [(length + 1) >> 1 for length in lengths]))
+
+
 def get_columns(offset: int, length: int, out_of: List[str], unhex=True) -> Iterable[List[str]]:
     if unhex:
         yield from map(lambda x: x[offset:offset+length][0], map(unhexlify, out_of))
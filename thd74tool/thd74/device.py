@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from serial.tools import list_ports
 
@@ -8,8 +9,10 @@ from .protocol import THD74Protocol
 
 logger = getLogger(__name__)
 
+probe_timeout = 0.5  # seconds to wait for a radio's reply to `ID`
 
-def enumerate(force_device=None, force_model=None):
+
+def enumerate(force_device=None, force_model=None, probe_timeout=probe_timeout):
 
     global models
 
@@ -17,7 +20,7 @@ def enumerate(force_device=None, force_model=None):
 
     if force_device is None and force_model is None:
         for model in models.values():
-            devices += enumerate_model(model)
+            devices += enumerate_model(model, probe_timeout)
         return devices
 
     elif force_device is not None and force_model is None:
@@ -25,7 +28,7 @@ def enumerate(force_device=None, force_model=None):
         if force_device.isdecimal():
             # User addressed device by its numeric selector
             for model in models.values():
-                devices += enumerate_model(model)
+                devices += enumerate_model(model, probe_timeout)
             try:
                 return [devices[int(force_device)]]
             except IndexError:
@@ -33,7 +36,7 @@ def enumerate(force_device=None, force_model=None):
                 return []
 
         # Device is given as tty spec
-        return [THD74(force_device)]
+        return [THD74(force_device, probe_timeout)]
 
     elif force_device is not None and force_model is not None:
 
@@ -43,23 +46,50 @@ def enumerate(force_device=None, force_model=None):
             logger.critical(f"Invalid model specifier `{force_model}`")
             return []
 
-        return [model(force_device)]
+        return [model(force_device, probe_timeout)]
 
     logger.critical("Unable to detect device")
     return []
 
 
-def enumerate_model(thd_device) -> list:
+def enumerate_model(thd_device, probe_timeout=probe_timeout) -> list:
 
-    devices = []
+    ports = []
 
-    for d in list_ports.comports():
+    for d in sorted(list_ports.comports(), key=lambda p: p.device):
         if d.vid == thd_device.usb_vendor_id and d.pid == thd_device.usb_product_id:
             if not d.product == thd_device.usb_product_name:
                 logger.warning(f"Unexpected serial device product `{d.product}` (BE CAREFUL)")
-            devices.append(thd_device(d.device))
+            ports.append(d.device)
+
+    return probe(thd_device, ports, probe_timeout)
 
-    return devices
+
+def probe(thd_device, ports, probe_timeout=probe_timeout) -> list:
+    """
+    Open and identify devices on all ports at once, so probing takes about one
+    timeout no matter how many radios are connected. Ports that fail to open
+    are logged and skipped, they don't stop probing the others.
+    :param thd_device: device class
+    :param ports: tty paths
+    :return: device objects in port order
+    """
+    if len(ports) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        devices = list(pool.map(lambda port: probe_one(thd_device, port, probe_timeout), ports))
+    return [d for d in devices if d is not None]
+
+
+def probe_one(thd_device, port, probe_timeout=probe_timeout):
+    """
+    :return: device object, None if the port could not be opened
+    """
+    try:
+        return thd_device(port, probe_timeout)
+    except OSError as e:  # Includes SerialException
+        logger.warning(f"Unable to probe {port}: {e}")
+        return None
 
 
 class THD74(object):
@@ -77,9 +107,9 @@ class THD74(object):
     protocol_model = THD74Protocol
     config_model = THD74Config
 
-    def __init__(self, tty):
+    def __init__(self, tty, probe_timeout=probe_timeout):
         self.tty = tty
-        self.comm = self.protocol_model(tty=tty)
+        self.comm = self.protocol_model(tty=tty, probe_timeout=probe_timeout)
         self.pcrig_mode = None
         self.fwprog_mode = None
         self.firmware_version = None
@@ -91,7 +121,7 @@ class THD74(object):
             if self.comm.pcrig_mode:
                 self.config = None
                 self.fwprog_mode = None
-                self.firmware_version = "V1.10"
+                self.firmware_version = self.comm.firmware_version
                 logger.info(f"Device on {self.tty} is {self.handle} in PCRIG mode")
             elif self.comm.fwprog_mode:
                 self.config = self.config_model(self.comm)
@@ -108,6 +138,9 @@ class THD74(object):
         else:
             logger.error(f"Device on {self.tty} does not behave like TH hardware")
 
+    def close(self) -> None:
+        self.comm.close()
+
     @property
     def is_fwprog_mode(self) -> bool:
         return self.comm.fwprog_mode
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from hashlib import blake2b
+from logging import getLogger
+import re
+from typing import List, Tuple
+
+from .binary import parse_blob_records
+from .crypto import xor_bytes
+from .image import MemoryImage
+
+logger = getLogger(__name__)
+
+block_size = 4096
+__nonzero = re.compile(rb"[^\x00]+")
+
+
+def block_digests(data: bytes, size: int = block_size) -> List[bytes]:
+    """
+    Digest of every `size` bytes of data, the last block may be short
+    """
+    view = memoryview(data)
+    return [blake2b(view[i:i + size], digest_size=16).digest() for i in range(0, len(view), size)]
+
+
+def byte_ranges(old: bytes, new: bytes, base: int = 0) -> List[Tuple[int, int]]:
+    """
+    Ranges of differing bytes between two equally long buffers
+    :return: list of (start, end) offsets, end exclusive
+    """
+    delta = xor_bytes(old, new)
+    return [(base + m.start(), base + m.end()) for m in __nonzero.finditer(delta)]
+
+
+def changed_ranges(old: bytes, new: bytes, size: int = block_size,
+                   old_digests: List[bytes] or None = None,
+                   new_digests: List[bytes] or None = None) -> List[Tuple[int, int]]:
+    """
+    Ranges of changed bytes between two buffers. Blocks are compared by digest
+    first, only blocks with different digests are compared bytewise. Bytes
+    beyond the end of the shorter buffer count as changed.
+    :param old: old data
+    :param new: new data
+    :param size: block size
+    :param old_digests: precomputed block digests of `old`
+    :param new_digests: precomputed block digests of `new`
+    :return: list of (start, end) offsets, end exclusive, adjacent ranges merged
+    """
+    if old_digests is None:
+        old_digests = block_digests(old, size)
+    if new_digests is None:
+        new_digests = block_digests(new, size)
+    common = min(len(old), len(new))
+    ranges = []
+    for n, a, b in zip(range(len(old_digests)), old_digests, new_digests):
+        if a == b:
+            continue
+        start = n * size
+        end = min(start + size, common)
+        ranges += byte_ranges(old[start:end], new[start:end], start)
+    if len(old) != len(new):
+        ranges.append((common, max(len(old), len(new))))
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges: List[Tuple[int, int]], gap: int = 0) -> List[Tuple[int, int]]:
+    """
+    Merge sorted ranges that touch or are at most `gap` bytes apart
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def diff_images(old: MemoryImage, new: MemoryImage, size: int = block_size,
+                fill: int = 0xff, gap: int = 0) -> List[Tuple[int, int]]:
+    """
+    Changed address ranges between two memory images. Both images are compared
+    over their combined span with holes filled, as they would end up in flash.
+    :return: list of (start, end) addresses, end exclusive
+    """
+    spans = [image.span for image in (old, new) if len(image)]
+    if not spans:
+        return []
+    start = min(s for s, _ in spans)
+    end = max(e for _, e in spans)
+    _, a = old.flatten(fill, start, end)
+    _, b = new.flatten(fill, start, end)
+    return [(start + s, start + e) for s, e in merge_ranges(changed_ranges(a, b, size), gap)]
+
+
+def diff_sections(old: List[Tuple[dict or None, bytes or None]], new: List[Tuple[dict or None, bytes or None]],
+                  size: int = block_size, gap: int = 0) -> List[dict]:
+    """
+    Compare the sections of two updaters by name
+    :param old: (section, records) per blob of the old updater, as from `cache.load_sections`
+    :param new: (section, records) per blob of the new updater
+    :param size: block size for digest comparison
+    :param gap: merge changed ranges at most this many bytes apart
+    :return: one dict per section name with `name`, `old` and `new` section dicts
+             (None if missing on either side) and `ranges` of changed addresses
+    """
+    old_by_name = {s["name"]: (s, r) for s, r in old if s is not None}
+    new_by_name = {s["name"]: (s, r) for s, r in new if s is not None}
+    names = list(old_by_name) + [name for name in new_by_name if name not in old_by_name]
+
+    report = []
+    for name in names:
+        a, a_records = old_by_name.get(name, (None, None))
+        b, b_records = new_by_name.get(name, (None, None))
+        ranges = None
+        if a is not None and b is not None:
+            logger.debug(f"Comparing section `{name}`")
+            a_image = MemoryImage.from_records(parse_blob_records(a_records, a["memory_address"]), name)
+            b_image = MemoryImage.from_records(parse_blob_records(b_records, b["memory_address"]), name)
+            ranges = diff_images(a_image, b_image, size, gap=gap)
+        report.append({"name": name, "old": a, "new": b, "ranges": ranges})
+    return report
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from struct import pack
+from typing import Iterable, Tuple
+
+from .image import write_flat
+
+# TH-D74 firmware is little endian 32 bit ARM code
+EM_ARM = 40
+EF_ARM_EABI_VER5 = 0x05000000
+
+ET_EXEC = 2
+PT_LOAD = 1
+PF_X, PF_W, PF_R = 1, 2, 4
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+SHF_WRITE, SHF_ALLOC, SHF_EXECINSTR = 1, 2, 4
+
+header_size = 52
+program_header_size = 32
+section_header_size = 40
+data_offset = header_size + program_header_size
+
+
+def make(address: int, data: bytes, name: str = ".data", machine: int = EM_ARM, flags: int = EF_ARM_EABI_VER5,
+         entry: int or None = None) -> bytes:
+    """
+    Minimal ELF32 executable with the memory image as single loadable segment
+    :param address: load address of the image
+    :param data: memory image
+    :param name: section name for the image
+    :param machine: ELF machine type
+    :param flags: processor-specific ELF flags
+    :param entry: entry point, defaults to the load address
+    :return: ELF file contents
+    """
+    return make_header(address, len(data), name, machine, flags, entry) + bytes(data) + \
+        make_trailer(address, len(data), name)
+
+
+def write(f, records: Iterable[Tuple[int, bytes]], name: str = ".data", fill: int = 0xff, **kwargs) -> int:
+    """
+    Stream records into an ELF file like `make()` without holding the image in memory
+    :param f: seekable binary file object
+    :param records: (address, data) tuples, see `image.write_flat()`
+    :param kwargs: further arguments to `make_header()`
+    :return: image size
+    """
+    base = f.tell()
+    f.write(bytes(data_offset))  # placeholder until the image size is known
+    address, size = write_flat(f, records, fill)
+    f.write(make_trailer(address, size, name))
+    end = f.tell()
+    f.seek(base)
+    f.write(make_header(address, size, name, **kwargs))
+    f.seek(end)
+    return size
+
+
+def make_header(address: int, size: int, name: str = ".data", machine: int = EM_ARM,
+                flags: int = EF_ARM_EABI_VER5, entry: int or None = None) -> bytes:
+    """
+    ELF and program header preceding an image of `size` bytes, see `make()`
+    """
+    if entry is None:
+        entry = address
+    shstrtab_offset = data_offset + size
+    section_headers_offset = (shstrtab_offset + len(__shstrtab(name)) + 3) & ~3
+
+    elf = b"\x7fELF" + bytes([1, 1, 1, 0]) + bytes(8)  # 32 bit, little endian, version 1, SysV
+    elf += pack("<HHIIIIIHHHHHH", ET_EXEC, machine, 1, entry, header_size, section_headers_offset, flags,
+                header_size, program_header_size, 1, section_header_size, 3, 2)
+    elf += pack("<IIIIIIII", PT_LOAD, data_offset, address, address, size, size,
+                PF_R | PF_W | PF_X, 4)
+    return elf
+
+
+def make_trailer(address: int, size: int, name: str = ".data") -> bytes:
+    """
+    Section name table and section headers following an image of `size` bytes, see `make()`
+    """
+    shstrtab = __shstrtab(name)
+    shstrtab_offset = data_offset + size
+    section_headers_offset = (shstrtab_offset + len(shstrtab) + 3) & ~3
+
+    elf = shstrtab
+    elf += bytes(section_headers_offset - shstrtab_offset - len(shstrtab))
+    elf += bytes(section_header_size)  # null section
+    elf += pack("<IIIIIIIIII", 1, SHT_PROGBITS, SHF_ALLOC | SHF_WRITE | SHF_EXECINSTR, address, data_offset,
+                size, 0, 0, 4, 0)
+    elf += pack("<IIIIIIIIII", 2 + len(name), SHT_STRTAB, 0, 0, shstrtab_offset, len(shstrtab), 0, 0, 1, 0)
+    return elf
+
+
+def __shstrtab(name: str) -> bytes:
+    return b"\x00" + name.encode("ascii") + b"\x00.shstrtab\x00"
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from time import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from . import fwprog
+from .plan import message_size, page_wire_size, data_nouns
+from .protocol import GenericTHDProtocol, Message, MessageParser, ProtocolError
+
+logger = getLogger(__name__)
+
+reply_timeout = 2.0  # seconds to wait for a reply
+busy_timeout = 10.0  # seconds to wait after a BUSY reply, clearing a segment takes a while
+pipeline_depth = 8  # data messages per write to start with
+max_pipeline_depth = 64
+
+# Replies to the messages from `fwprog.start_messages()`
+start_replies = [fwprog.OK, fwprog.OK, 0x32, fwprog.OK]
+
+
+class FlashProgress(object):
+    """
+    Transfer progress of a flashing session, counted in data message bytes
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.segment = None
+        self.started = time()
+
+    @property
+    def elapsed(self) -> float:
+        return time() - self.started
+
+    @property
+    def rate(self) -> float:
+        """
+        Bytes per second so far
+        """
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> float or None:
+        """
+        Seconds until all data is sent at the current rate, None if unknown
+        """
+        rate = self.rate
+        if rate == 0:
+            return None
+        return (self.total - self.sent) / rate
+
+    def __str__(self):
+        eta = self.eta
+        eta = f"{eta:.0f} s" if eta is not None else "unknown"
+        return f"{self.segment or ''} {self.sent}/{self.total} bytes, {self.rate / 1024:.1f} KiB/s, ETA {eta}"
+
+
+class FlashWriter(object):
+    """
+    Streams a flashing session to a device in FWPROG mode. The device does not
+    reply to 0x43 data messages, so they are written in back to back batches,
+    picking up any BUSY replies in between. The batch size starts at `depth`,
+    doubles after as many clean batches and halves on BUSY. Replies are awaited
+    with deadlines that every BUSY reply extends.
+    """
+
+    def __init__(self, comm: GenericTHDProtocol, key: int = 0, depth: int = pipeline_depth,
+                 max_depth: int = max_pipeline_depth, reply_timeout: float = reply_timeout,
+                 busy_timeout: float = busy_timeout, progress: Callable[[FlashProgress], None] or None = None):
+        """
+        :param comm: protocol of a device that is in FWPROG command mode
+        :param key: xor obfuscation key of the session
+        :param depth: data messages per write to start with
+        :param max_depth: upper limit for the data messages per write
+        :param reply_timeout: seconds to wait for a reply
+        :param busy_timeout: seconds to wait for a reply after BUSY
+        :param progress: called with the session's `FlashProgress` after every write
+        """
+        self.comm = comm
+        self.key = key
+        self.depth = depth
+        self.max_depth = max_depth
+        self.reply_timeout = reply_timeout
+        self.busy_timeout = busy_timeout
+        self.progress_callback = progress
+        self.progress = FlashProgress(0)
+        self.parser = MessageParser(key)
+        self.replies = deque()
+        self.__clean_batches = 0
+
+    def __receive(self) -> bool:
+        """
+        Read what the device sent, waiting up to the serial timeout for the first byte
+        :return: whether anything was received
+        """
+        try:
+            data = self.comm.read(max(1, self.comm.available()))
+        except TimeoutError:
+            return False
+        self.replies.extend(self.parser.messages(data))
+        return True
+
+    def wait_reply(self, verbs: Iterable[int], timeout: float or None = None) -> Message:
+        """
+        Wait for a reply, skipping BUSY replies
+        :param verbs: expected reply verbs
+        :param timeout: seconds until the reply must arrive, default `reply_timeout`
+        :return: reply message
+        """
+        verbs = list(verbs)
+        deadline = time() + (self.reply_timeout if timeout is None else timeout)
+        busy = False
+        while True:
+            while len(self.replies) == 0:
+                if time() >= deadline:
+                    raise TimeoutError(f"No reply from device, expected {', '.join(f'{v:#04x}' for v in verbs)}")
+                self.__receive()
+            m = self.replies.popleft()
+            if not m.validate():
+                raise ProtocolError(f"Bad checksum in reply `{m}`")
+            if m.verb == fwprog.BUSY:
+                logger.debug("Device is busy")
+                deadline = time() + self.busy_timeout
+                busy = True
+                continue
+            if m.verb in verbs:
+                return m
+            if m.verb == fwprog.OK and busy:
+                # End of a busy period during data that the batch writer did not catch
+                busy = False
+                continue
+            raise ProtocolError(f"Unexpected reply `{m}`")
+
+    def request(self, message: bytes, verbs: Iterable[int], timeout: float or None = None) -> Message:
+        self.comm.write(message)
+        return self.wait_reply(verbs, timeout)
+
+    def __report(self) -> None:
+        if self.progress_callback is not None:
+            self.progress_callback(self.progress)
+
+    def __write_batch(self, batch: List[bytes]) -> None:
+        data = b"".join(batch)
+        self.comm.write(data)
+        self.progress.sent += len(data)
+        self.__report()
+
+        if self.comm.available() == 0 and len(self.replies) == 0:
+            self.__clean_batches += 1
+            if self.__clean_batches >= self.depth and self.depth < self.max_depth:
+                self.depth = min(self.depth * 2, self.max_depth)
+                self.__clean_batches = 0
+                logger.debug(f"Pipeline depth raised to {self.depth}")
+            return
+
+        self.__receive()
+        while len(self.replies) > 0:
+            m = self.replies[0]
+            if m.verb == fwprog.BUSY:
+                self.depth = max(1, self.depth // 2)
+                self.__clean_batches = 0
+                logger.debug(f"Device busy while streaming, pipeline depth lowered to {self.depth}")
+                self.wait_reply([fwprog.OK], self.busy_timeout)
+            else:
+                raise ProtocolError(f"Unexpected reply `{self.replies.popleft()}` to data")
+
+    def stream(self, messages: Iterable[bytes]) -> None:
+        """
+        Write data messages in batches of the current pipeline depth
+        """
+        batch = []
+        for msg in messages:
+            batch.append(msg)
+            if len(batch) >= self.depth:
+                self.__write_batch(batch)
+                batch = []
+        if len(batch) > 0:
+            self.__write_batch(batch)
+
+    def start(self) -> None:
+        for msg, verb in zip(fwprog.start_messages(self.key), start_replies):
+            self.request(msg, [verb])
+
+    def segment(self, packetizer: fwprog.SegmentPacketizer, pages: Sequence[int] or None = None) -> None:
+        """
+        Flash one segment
+        :param packetizer: messages of the segment
+        :param pages: segment offsets of the pages to send, default all
+        """
+        self.progress.segment = packetizer.name
+        reply = self.request(packetizer.setup(pages), [fwprog.SEGMENT_REPLY])
+        differs = reply.noun_bytes[:1] == b"\x01"
+        logger.debug(f"Segment `{packetizer.name}` version {'differs' if differs else 'matches'}")
+        if not packetizer.patch:
+            self.request(packetizer.prepare(), [fwprog.OK], self.busy_timeout)
+        self.stream(packetizer.data(pages))
+        if not packetizer.patch:
+            self.request(packetizer.done(), [fwprog.SEGMENT_DONE_REPLY], self.busy_timeout)
+
+    def finish(self, checkbytes: bytes) -> None:
+        # The device acknowledges, then shows "Completed!!" and stops responding
+        self.request(fwprog.finish_message(checkbytes, self.key), [fwprog.OK])
+
+    def flash(self, images: Dict[str, Tuple[int, bytes]], segments: List[dict] or None = None,
+              segment_checksums: Dict[str, int] or None = None) -> FlashProgress:
+        """
+        Run a complete flashing session
+        :param images: (address, memory image) per section name
+        :param segments: segment plan dicts from `plan.plan_flash()`, default all pages
+                         of all images in `fwprog.flash_order`
+        :param segment_checksums: 0x40 checksum field per section name, see `fwprog.segment_nouns()`
+        :return: final progress
+        """
+        segment_checksums = segment_checksums or {}
+        if segments is None:
+            jobs = [(name, None) for name in fwprog.flash_order if name in images]
+        else:
+            jobs = [(s["name"], s["pages"]) for s in segments if s["wire_bytes"] > 0]
+
+        packetizers = []
+        total = 0
+        for name, pages in jobs:
+            address, image = images[name]
+            p = fwprog.SegmentPacketizer(name, address, image, self.key, segment_checksums.get(name, 0))
+            if p.patch:
+                total += message_size(data_nouns + len(image))
+            else:
+                total += page_wire_size() * (len(pages) if pages is not None else
+                                             (len(image) + fwprog.page_size - 1) // fwprog.page_size)
+            packetizers.append((p, pages))
+
+        self.progress = FlashProgress(total)
+        self.start()
+        for p, pages in packetizers:
+            logger.debug(f"Flashing segment `{p.name}`")
+            self.segment(p, pages)
+        if "CHECKBYTES" in images:
+            self.finish(bytes(images["CHECKBYTES"][1]))
+        logger.debug(f"Sent {self.progress.sent} bytes in {self.progress.elapsed:.1f} s "
+                    f"({self.progress.rate / 1024:.1f} KiB/s)")
+        return self.progress
+
+
+def flash_device(device, images: Dict[str, Tuple[int, bytes]], segments: List[dict] or None = None,
+                 retries: int = 1, depth: int = pipeline_depth,
+                 progress: Callable[[FlashProgress], None] or None = None,
+                 segment_checksums: Dict[str, int] or None = None) -> dict:
+    """
+    Flash one device, restarting the session on failure
+    :param device: device object in FWPROG mode, see `device.THD74`
+    :param images: (address, memory image) per section name, only read
+    :param segments: segment plan dicts, see `FlashWriter.flash()`
+    :param retries: times to restart a failed session
+    :param depth: data messages per write to start with
+    :param progress: called with the session's `FlashProgress` after every write
+    :param segment_checksums: 0x40 checksum field per section name, see `FlashWriter.flash()`
+    :return: result dict with `tty`, `ok`, `attempts`, `bytes`, `seconds` and `error`
+    """
+    result = {"tty": device.tty, "ok": False, "attempts": 0, "bytes": 0, "seconds": 0.0, "error": None}
+    started = time()
+    for attempt in range(retries + 1):
+        result["attempts"] += 1
+        try:
+            if attempt > 0:
+                # Start over from detection, the device may have left command mode
+                device.comm.detect()
+                if not device.comm.fwprog_mode:
+                    raise ProtocolError(f"{device.tty} is no longer in FWPROG mode")
+            device.comm.cmd_mode()
+            writer = FlashWriter(device.comm, device.comm.key, depth, progress=progress)
+            result["bytes"] = writer.flash(images, segments, segment_checksums).sent
+            result["ok"] = True
+            result["error"] = None
+            break
+        except (ProtocolError, TimeoutError, OSError) as e:
+            logger.warning(f"Flashing {device.tty} failed on attempt {attempt + 1}: {e}")
+            result["error"] = e
+    result["seconds"] = time() - started
+    return result
+
+
+def flash_fleet(devices: list, images: Dict[str, Tuple[int, bytes]], segments: List[dict] or None = None,
+                retries: int = 1, depth: int = pipeline_depth,
+                progress: Callable[[object, FlashProgress], None] or None = None,
+                segment_checksums: Dict[str, int] or None = None) -> List[dict]:
+    """
+    Flash many devices concurrently, one session per device. The images are
+    shared by all sessions, so each section is decrypted only once.
+    :param devices: device objects in FWPROG mode
+    :param progress: called with the device and its `FlashProgress`, from the device's thread
+    :return: result dict per device as from `flash_device()`, in device order, also for
+             devices whose session raised unexpectedly
+    """
+    if len(devices) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        futures = []
+        for device in devices:
+            callback = partial(progress, device) if progress is not None else None
+            futures.append(pool.submit(flash_device, device, images, segments, retries, depth, callback,
+                                       segment_checksums))
+        results = []
+        for device, f in zip(devices, futures):
+            try:
+                results.append(f.result())
+            except Exception as e:
+                logger.error(f"Flashing {device.tty} failed: {e}")
+                results.append({"tty": device.tty, "ok": False, "attempts": 0, "bytes": 0, "seconds": 0.0,
+                                "error": e})
+        return results
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from struct import pack
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+logger = getLogger(__name__)
+
+# FWPROG command verbs, see flash_update_protocol.md
+PROGRAM = 0x30
+OK = 0x06
+BUSY = 0x11
+SEGMENT_SETUP = 0x40
+SEGMENT_REPLY = 0x41
+SEGMENT_PREPARE = 0x42
+DATA = 0x43
+SEGMENT_DONE = 0x45
+SEGMENT_DONE_REPLY = 0x46
+FINISH = 0x50
+
+attention = b"\xab\xab"
+newline = b"\r\n"
+page_size = 0x400
+address_base = 0x60000000  # segment addresses are sent relative to this
+
+# Translate tables for the xor obfuscation, one per key
+xor_tables = [bytes(x ^ key for x in range(256)) for key in range(256)]
+
+# Segment parameters as sent by the updater, keyed by section name. Patch
+# segments have no clear size and carry their data in the 0x43 nouns.
+segments = {
+    "FIRMWARE": {"segment_id": 6, "clear_size": 0x280000, "version_offset": 0xa0, "version_length": 15},
+    "IMAGE DATA": {"segment_id": 1, "clear_size": 0x60000, "version_offset": 0, "version_length": 10},
+    "DATA 00E0": {"segment_id": 3, "clear_size": 0x100000, "version_offset": 0x5fff0, "version_length": 12},
+    "DATA 0100": {"segment_id": 5, "clear_size": 0x200000, "version_offset": 0, "version_length": 0},
+    "FONT DATA": {"segment_id": 2, "clear_size": 0xc0000, "version_offset": 0x10, "version_length": 4},
+    "CHECKBYTES": {"segment_id": 0, "clear_size": 0, "version_offset": 0, "version_length": 0},
+    "FINAL ZZZ": {"segment_id": 0, "clear_size": 0, "version_offset": 0, "version_length": 0}
+}
+
+# Content dependent 0x40 checksum fields as captured from the 1.10 updater, see
+# `segment_nouns()`. Keyed by section name and version string, or by the data
+# for patch segments. The algorithm is unknown, other releases need captured values.
+known_segment_checksums = {
+    ("FIRMWARE", b"V1.10.000      "): 0x1f0366ab,
+    ("IMAGE DATA", b"1.00.01.00"): 0x0fc40fc4,
+    ("DATA 00E0", b"Ds1.07.00R00"): 0x405e405e,
+    ("FONT DATA", b"1.00"): 0xaf62af62,
+    ("CHECKBYTES", b"\xcd\xb6"): 0x36ce36ce,
+    ("FINAL ZZZ", b"ZZzo..(-_- ) EX-4420 2013-04-01\x00"): 0xc7a8c7a8
+}
+
+# Order in which the updater sends segments
+flash_order = ["FIRMWARE", "IMAGE DATA", "DATA 00E0", "DATA 0100", "FONT DATA", "CHECKBYTES", "FINAL ZZZ"]
+
+
+def checksum(data: bytes) -> int:
+    return sum(data) & 0xff
+
+
+def encode(verb: int, nouns: bytes = b"", payload: bytes = b"", key: int = 0) -> bytes:
+    """
+    Encode one FWPROG message
+    :param verb: command verb
+    :param nouns: noun bytes
+    :param payload: payload bytes
+    :param key: xor obfuscation key, 0 for cleartext mode
+    :return: message as sent on the wire
+    """
+    body = pack(">HHH", len(nouns) + 1, len(payload), verb) + bytes(nouns) + bytes(payload)
+    body += bytes([checksum(body)])
+    return (attention + body).translate(xor_tables[key]) + newline
+
+
+def segment_nouns(address: int, transfer_size: int, clear_size: int, segment_id: int = 0,
+                  segment_checksum: int = 0, version_offset: int = 0, version: bytes = b"") -> bytes:
+    """
+    Nouns of the 0x40 segment setup message
+    :param address: memory address of the segment
+    :param transfer_size: bytes to be sent in 0x43 messages
+    :param clear_size: bytes the device clears, 0 for patch segments
+    :param segment_id: segment number as used by the updater
+    :param segment_checksum: content dependent value of unknown algorithm, sent as is
+    :param version_offset: offset of the version string in the segment
+    :param version: version string the device compares against, empty for no check
+    """
+    return pack("<IIIIIIIIIIIII", address_base + address, transfer_size, clear_size, 0, 0, 0x0f000000,
+                segment_id, segment_checksum, 0, clear_size, 0x0a, version_offset, len(version)) + version
+
+
+def known_segment_checksum(name: str, image: bytes) -> int or None:
+    """
+    Captured 0x40 checksum field of a segment image, see `known_segment_checksums`
+    :param name: section name
+    :param image: memory image of the segment
+    :return: checksum field, None if unknown
+    """
+    p = segments.get(name)
+    if p is None:
+        return None
+    if p["clear_size"] == 0:
+        key = bytes(image)
+    elif p["version_length"] > 0:
+        key = bytes(image[p["version_offset"]:p["version_offset"] + p["version_length"]])
+    else:
+        return None
+    return known_segment_checksums.get((name, key))
+
+
+class SegmentPacketizer(object):
+    """
+    Encoded FWPROG messages for flashing one segment from its memory image.
+    Data messages share a precomputed header and checksum base, payloads are
+    sliced from the image without copying until the message is assembled.
+    """
+
+    def __init__(self, name: str, address: int, image: bytes, key: int = 0, segment_checksum: int = 0,
+                 **parameters):
+        """
+        :param name: section name, selects segment parameters from `segments`
+        :param address: memory address of the image
+        :param image: memory image of the segment
+        :param key: xor obfuscation key
+        :param segment_checksum: content dependent 0x40 field, see `segment_nouns()`
+        :param parameters: overrides for the segment parameters
+        """
+        self.name = name
+        self.address = address
+        self.image = memoryview(image)
+        self.key = key
+        self.segment_checksum = segment_checksum
+        self.parameters = dict(segments.get(name, segments["FINAL ZZZ"]), **parameters)
+        self.table = xor_tables[key]
+
+    @property
+    def patch(self) -> bool:
+        return self.parameters["clear_size"] == 0
+
+    @property
+    def version(self) -> bytes:
+        offset = self.parameters["version_offset"]
+        return bytes(self.image[offset:offset + self.parameters["version_length"]])
+
+    def setup(self, pages: Sequence[int] or None = None) -> bytes:
+        """
+        0x40 segment setup message
+        :param pages: segment offsets of the pages to send, default all. The
+                      transfer size announces only the pages actually sent.
+        """
+        p = self.parameters
+        transfer_size = len(self.image)
+        if not self.patch:
+            count = len(pages) if pages is not None else (transfer_size + page_size - 1) // page_size
+            transfer_size = count * page_size
+        return encode(SEGMENT_SETUP, segment_nouns(self.address, transfer_size, p["clear_size"], p["segment_id"],
+                                                   self.segment_checksum, p["version_offset"], self.version),
+                      key=self.key)
+
+    def prepare(self) -> bytes:
+        return encode(SEGMENT_PREPARE, key=self.key)
+
+    def done(self) -> bytes:
+        return encode(SEGMENT_DONE, key=self.key)
+
+    def data(self, pages: Sequence[int] or None = None) -> Iterable[bytes]:
+        """
+        0x43 data messages
+        :param pages: segment offsets of the pages to send, default all
+        """
+        if self.patch:
+            # Patch data goes into the nouns, there is no payload
+            yield encode(DATA, pack("<II", 0, len(self.image)) + bytes(self.image), key=self.key)
+            return
+
+        if pages is None:
+            pages = range(0, len(self.image), page_size)
+        header = pack(">HHH", 9, page_size, DATA)
+        length = pack("<I", page_size)
+        base = checksum(header) + checksum(length)  # constant for all pages
+        for offset in pages:
+            page = self.image[offset:offset + page_size]
+            pad = bytes([0xff]) * (page_size - len(page))  # the last page is sent in full
+            noun = pack("<I", offset)
+            cs = base + sum(noun) + sum(page) + sum(pad)
+            msg = b"".join((attention, header, noun, length, page, pad, bytes([cs & 0xff])))
+            yield msg.translate(self.table) + newline
+
+    def messages(self, pages: Sequence[int] or None = None) -> Iterable[bytes]:
+        """
+        All messages of the segment in order. Replies from the device are
+        expected after setup, prepare and done, the caller waits for them.
+        """
+        yield self.setup(pages)
+        if not self.patch:
+            yield self.prepare()
+        yield from self.data(pages)
+        if not self.patch:
+            yield self.done()
+
+    def encode_all(self, pages: Sequence[int] or None = None) -> bytes:
+        """
+        All messages of the segment as one buffer
+        """
+        return b"".join(self.messages(pages))
+
+
+def start_messages(key: int = 0) -> List[bytes]:
+    """
+    Messages the updater sends before the first segment, as captured
+    """
+    return [encode(PROGRAM, b"\x00", key=key), encode(0xa0, key=key), encode(0x31, key=key),
+            encode(0x33, b"\x0a\x00", key=key)]
+
+
+def finish_message(checkbytes: bytes, key: int = 0) -> bytes:
+    """
+    Final 0x50 message, repeats the data of the CHECKBYTES segment
+    """
+    return encode(FINISH, checkbytes, key=key)
+
+
+def session_messages(images: Dict[str, Tuple[int, bytes]], key: int = 0,
+                     segment_checksums: Dict[str, int] or None = None) -> Iterable[bytes]:
+    """
+    All messages of a complete flashing session, without the device's replies
+    :param images: (address, memory image) per section name, sent in `flash_order`
+    :param key: xor obfuscation key
+    :param segment_checksums: 0x40 checksum field per section name, see `segment_nouns()`
+    """
+    segment_checksums = segment_checksums or {}
+    yield from start_messages(key)
+    for name in flash_order:
+        if name not in images:
+            continue
+        address, image = images[name]
+        yield from SegmentPacketizer(name, address, image, key, segment_checksums.get(name, 0)).messages()
+    if "CHECKBYTES" in images:
+        yield finish_message(bytes(images["CHECKBYTES"][1]), key)
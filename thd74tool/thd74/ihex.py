@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from typing import Iterable, Tuple
+
+
+def make_record(rectype: int, address: int, data: bytes = b"") -> str:
+    rec = bytes([len(data), (address >> 8) & 255, address & 255, rectype]) + bytes(data)
+    checksum = -sum(rec) % 256
+    return f":{rec.hex().upper()}{checksum:02X}\r\n"
+
+
+def make(address: int, data: bytes, record_size: int = 32) -> Iterable[str]:
+    """
+    Intel HEX records for a contiguous memory image
+    :param address: load address of the first byte
+    :param data: memory image
+    :param record_size: maximum number of data bytes per record
+    :return: generator of record lines
+    """
+    return make_records([(address, data)], record_size)
+
+
+def make_records(records: Iterable[Tuple[int, bytes]], record_size: int = 32) -> Iterable[str]:
+    """
+    Intel HEX records for a stream of (address, data) records, in any order
+    :param records: (address, data) tuples
+    :param record_size: maximum number of data bytes per record
+    :return: generator of record lines
+    """
+    assert 0 < record_size <= 255
+    upper = None
+    for address, data in records:
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            current = address + pos
+            if current >> 16 != upper:
+                upper = current >> 16
+                yield make_record(4, 0, upper.to_bytes(2, "big"))  # extended linear address
+            # Records must not cross a 64k boundary
+            length = min(record_size, len(view) - pos, 0x10000 - (current & 0xffff))
+            yield make_record(0, current & 0xffff, view[pos:pos + length])
+            pos += length
+    yield make_record(1, 0)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Tuple
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class MemoryImage(object):
+    """
+    Sparse memory image. Data is kept in sorted, non-adjacent extents of
+    contiguous bytes, so addresses are looked up by bisection. Writing over
+    existing data is allowed, but every such overlap is recorded.
+    """
+
+    def __init__(self):
+        self.starts = []  # sorted start addresses of extents
+        self.extents = []  # bytearray for every extent
+        self.sources = []  # (start, end, name) of every update() batch
+        self.overlaps = []  # (start, end, name, overwritten name)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Tuple[int, bytes]], name: str or None = None) -> "MemoryImage":
+        """
+        Image of one section. Records of a section should not overlap, any
+        that do are logged as a warning.
+        """
+        image = cls()
+        image.update(records, name)
+        if len(image.overlaps) > 0:
+            start, end, _, _ = image.overlaps[0]
+            size = sum(end - start for start, end, _, _ in image.overlaps)
+            logger.warning(f"{name or 'Image'}: {len(image.overlaps)} overlapping records, {size} bytes "
+                           f"written more than once, first at {start:#010x}")
+        return image
+
+    def update(self, records: Iterable[Tuple[int, bytes]], name: str or None = None) -> None:
+        """
+        Add (address, data) records, typically one section at a time
+        """
+        low = None
+        high = None
+        n = len(self.sources)
+        for address, data in records:
+            self.add(address, data, name)
+            low = address if low is None else min(low, address)
+            high = address + len(data) if high is None else max(high, address + len(data))
+            # Kept current, so overlaps with earlier records of the batch are attributed to it
+            self.sources[n:] = [(low, high, name)]
+
+    def add(self, address: int, data: bytes, name: str or None = None) -> None:
+        end = address + len(data)
+        if len(data) == 0:
+            return
+
+        if len(self.starts) > 0:
+            last_end = self.starts[-1] + len(self.extents[-1])
+            if address == last_end:  # appending, by far the most common case
+                self.extents[-1] += data
+                return
+
+        # Extents overlapping or adjacent to the new data
+        lo = bisect_right(self.starts, address) - 1
+        if lo < 0 or self.starts[lo] + len(self.extents[lo]) < address:
+            lo += 1
+        hi = bisect_right(self.starts, end)
+
+        if lo == hi:
+            self.starts.insert(lo, address)
+            self.extents.insert(lo, bytearray(data))
+            return
+
+        for n in range(lo, hi):
+            overlap_start = max(address, self.starts[n])
+            overlap_end = min(end, self.starts[n] + len(self.extents[n]))
+            if overlap_start < overlap_end:
+                self.overlaps.append((overlap_start, overlap_end, name, self.owner(overlap_start)))
+
+        # The new data bridges all holes between these extents
+        start = min(address, self.starts[lo])
+        merged = bytearray(max(end, self.starts[hi - 1] + len(self.extents[hi - 1])) - start)
+        for n in range(lo, hi):
+            offset = self.starts[n] - start
+            merged[offset:offset + len(self.extents[n])] = self.extents[n]
+        merged[address - start:end - start] = data
+
+        self.starts[lo:hi] = [start]
+        self.extents[lo:hi] = [merged]
+
+    def owner(self, address: int) -> str or None:
+        """
+        Name of the latest update() batch that spans `address`
+        """
+        for start, end, name in reversed(self.sources):
+            if start <= address < end:
+                return name
+        return None
+
+    def find(self, address: int) -> int or None:
+        """
+        Index of the extent containing `address`
+        """
+        n = bisect_right(self.starts, address) - 1
+        if n >= 0 and address < self.starts[n] + len(self.extents[n]):
+            return n
+        return None
+
+    def __contains__(self, address: int) -> bool:
+        return self.find(address) is not None
+
+    def __len__(self):
+        return sum(len(e) for e in self.extents)
+
+    def __getitem__(self, key: int or slice) -> int or bytes:
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise IndexError("MemoryImage slices must be contiguous")
+            low, high = self.span
+            start = low if key.start is None else key.start
+            stop = high if key.stop is None else key.stop
+            return self.read(start, max(0, stop - start))
+        n = self.find(key)
+        if n is None:
+            raise IndexError(f"Address {key:#010x} not in image")
+        return self.extents[n][key - self.starts[n]]
+
+    def read(self, address: int, length: int, fill: int or None = None) -> bytes:
+        """
+        Read `length` bytes at `address`
+        :param fill: value for bytes in holes, raise IndexError for holes if None
+        """
+        result = bytearray()
+        end = address + length
+        current = address
+        while current < end:
+            n = bisect_right(self.starts, current) - 1
+            if n >= 0 and current < self.starts[n] + len(self.extents[n]):
+                chunk_end = min(end, self.starts[n] + len(self.extents[n]))
+                result += self.extents[n][current - self.starts[n]:chunk_end - self.starts[n]]
+            else:
+                if fill is None:
+                    raise IndexError(f"Hole at {current:#010x} in image")
+                chunk_end = min(end, self.starts[n + 1]) if n + 1 < len(self.starts) else end
+                result += bytes([fill]) * (chunk_end - current)
+            current = chunk_end
+        return bytes(result)
+
+    def view(self, address: int, length: int) -> memoryview:
+        """
+        Zero-copy view of `length` bytes at `address`, which must be within one extent
+        """
+        n = self.find(address)
+        if n is None or address + length > self.starts[n] + len(self.extents[n]):
+            raise IndexError(f"Range {address:#010x}+{length:#x} not contiguous in image")
+        offset = address - self.starts[n]
+        return memoryview(self.extents[n])[offset:offset + length]
+
+    def __iter__(self) -> Iterable[Tuple[int, memoryview]]:
+        """
+        (start address, data view) of every extent
+        """
+        for start, extent in zip(self.starts, self.extents):
+            yield start, memoryview(extent)
+
+    @property
+    def span(self) -> Tuple[int, int]:
+        if len(self.starts) == 0:
+            return 0, 0
+        return self.starts[0], self.starts[-1] + len(self.extents[-1])
+
+    def holes(self, start: int or None = None, end: int or None = None) -> List[Tuple[int, int]]:
+        """
+        (start, end) ranges not covered by the image, within `start` and `end` if given
+        """
+        low, high = self.span
+        start = low if start is None else start
+        end = high if end is None else end
+        result = []
+        current = start
+        for n in range(max(bisect_left(self.starts, start) - 1, 0), len(self.starts)):
+            extent_start = self.starts[n]
+            extent_end = extent_start + len(self.extents[n])
+            if extent_start >= end:
+                break
+            if extent_start > current:
+                result.append((current, extent_start))
+            current = max(current, extent_end)
+        if current < end:
+            result.append((current, end))
+        return result
+
+    def flatten(self, fill: int = 0xff, start: int or None = None, end: int or None = None) -> Tuple[int, bytearray]:
+        """
+        Contiguous copy of the image with holes set to `fill`
+        :return: (start address, data) tuple
+        """
+        low, high = self.span
+        start = low if start is None else start
+        end = high if end is None else end
+        return start, bytearray(self.read(start, end - start, fill))
+
+
+def write_flat(f, records: Iterable[Tuple[int, bytes]], fill: int = 0xff) -> Tuple[int, int]:
+    """
+    Stream records into a seekable binary file as one contiguous image, holes
+    filled with `fill`. Only the first record must be at the lowest address,
+    later records may go back to overwrite earlier data.
+    :param f: binary file object, the image starts at its current position
+    :param records: (address, data) tuples
+    :param fill: value for bytes not covered by any record
+    :return: (start address, image size) tuple
+    """
+    base = f.tell()
+    start = None
+    size = 0
+    for address, data in records:
+        if start is None:
+            start = address
+        offset = address - start
+        if offset < 0:
+            raise ValueError(f"Record at {address:#010x} below image start {start:#010x}")
+        if offset > size:
+            f.write(bytes([fill]) * (offset - size))
+            size = offset
+        elif offset < size:
+            f.seek(base + offset)
+        f.write(data)
+        end = offset + len(data)
+        if end < size:
+            f.seek(base + size)
+        size = max(size, end)
+    if start is None:
+        return 0, 0
+    f.seek(base + size)
+    return start, size
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+from . import elf, ihex, srec
+from .binary import BlobError, UpdaterPayload, derive_permute_offset, sections_by_permute_offset, \
+    parse_blob_records, section_version, sections_version
+from .cache import CacheEntry
+from .crypto import decrypt_blob_lines
+from .image import MemoryImage, write_flat
+
+logger = getLogger(__name__)
+
+block_lines = 4097  # header plus 4096 data records
+chunk_blocks = 16  # blocks decrypted at once, bounds memory use per blob
+
+
+def iter_lines(data: bytes, buffer_size: int = 1 << 20) -> Iterable[bytes]:
+    """
+    Whitespace-separated lines of a possibly huge buffer, split `buffer_size` bytes at a time
+    """
+    view = memoryview(data)
+    tail = b""
+    for pos in range(0, len(view), buffer_size):
+        chunk = tail + bytes(view[pos:pos + buffer_size])
+        lines = chunk.split()
+        tail = b""
+        if pos + buffer_size < len(view) and len(lines) > 0 and not chunk[-1:].isspace():
+            tail = lines.pop()  # continues in the next chunk
+        yield from lines
+    if len(tail) > 0:
+        yield tail
+
+
+class StreamedBlob(object):
+    """
+    One blob of an updater while its lines stream by. The blob is identified
+    from its first line and decrypted in runs of whole blocks. Its size is
+    counted from line lengths, so it is known after the stream passed the
+    blob even if its records were never decrypted.
+    """
+
+    def __init__(self, number: int, header: bytes, lines: Iterator[bytes], chunk_blocks: int = chunk_blocks):
+        self.number = number
+        self.permute_offset = derive_permute_offset(str(header, "ascii"))
+        self.section = None
+        if self.permute_offset in sections_by_permute_offset:
+            self.section = sections_by_permute_offset[self.permute_offset].copy()
+        self.size = 0
+        self.version = None
+        self.done = False
+        self.__version_pending = self.section is not None and self.section["version_offset"] is not None
+        self.__chunk_lines = chunk_blocks * block_lines
+        self.__chunks = self.__iter_chunks(header, lines)
+
+    @property
+    def name(self) -> str or None:
+        return self.section["name"] if self.section is not None else None
+
+    @property
+    def manifest_entry(self) -> dict:
+        """
+        Blob description as in cache manifests, complete once the blob is done
+        """
+        return {
+            "name": self.name,
+            "permute_offset": self.permute_offset,
+            "size": self.size,
+            "version": self.version
+        }
+
+    def __iter_chunks(self, line: bytes, lines: Iterator[bytes]) -> Iterable[Tuple[int, List[bytes]]]:
+        """
+        Runs of ciphertext lines, each starting at a block header
+        :return: (block number of the first line, lines) tuples
+        """
+        chunk = []
+        first_block = 0
+        blocks = 0
+        count = 0
+        while line is not None:
+            length = len(line)
+            if line[:1] == b"$":
+                line = next(lines, None)
+                continue
+            if length == 15:  # block header, same rule as the keystream schedule
+                if len(chunk) >= self.__chunk_lines:
+                    yield first_block, chunk
+                    chunk = []
+                    first_block = blocks
+                blocks += 1
+            if not (length == 15 and count % block_lines == 0) and length != 11:
+                self.size += (length - 11) >> 1  # as `count_blob_bytes()`
+            chunk.append(line)
+            count += 1
+            if length == 11:  # blob end record
+                break
+            line = next(lines, None)
+        self.done = True
+        if line is None:
+            raise BlobError(f"Blob [{self.number}] ends without end record")
+        yield first_block, chunk
+
+    def __parse(self, first_block: int, lines: List[bytes], verify: bool, raw: BinaryIO or None):
+        section = self.section
+        records = decrypt_blob_lines(lines, section["permute_offset"], section["end_offset"], first_block)
+        if raw is not None:
+            raw.write(records)
+        records = parse_blob_records(records, section["memory_address"], verify)
+        if self.__version_pending:
+            records = list(records)
+            self.__find_version(records)
+        return records
+
+    def __find_version(self, records: List[Tuple[int, bytes]]) -> None:
+        section = self.section
+        image = MemoryImage.from_records(records)
+        start = section["memory_address"] + section["version_offset"]
+        try:
+            data = image.read(start, section["version_length"])
+        except IndexError:
+            if image.span[1] >= start + section["version_length"]:
+                self.__version_pending = False  # not in this blob at all
+            return
+        self.version = section_version(data, section, section["version_offset"])
+        self.__version_pending = False
+
+    def records(self, verify: bool = True, raw: BinaryIO or None = None) -> Iterable[Tuple[int, bytes]]:
+        """
+        Decrypted (address, data) records of the blob, run by run
+        :param verify: check record checksums, raising `ChecksumError`
+        :param raw: binary file receiving the decrypted record buffer, as from `decrypt_blob_buffer()`
+        """
+        if self.section is None:
+            raise BlobError(f"Unknown blob [{self.number}] at permutation offset {self.permute_offset}")
+        for first_block, lines in self.__chunks:
+            yield from self.__parse(first_block, lines, verify, raw)
+
+    def skip(self) -> None:
+        """
+        Move past the rest of the blob, decrypting only as far as its version string
+        """
+        for first_block, lines in self.__chunks:
+            if self.__version_pending:
+                self.__parse(first_block, lines, False, None)
+
+
+def stream_blobs(data: bytes, chunk_blocks: int = chunk_blocks) -> Iterable[StreamedBlob]:
+    """
+    Walk an updater payload once, blob by blob. Each blob must be dealt with
+    before asking for the next one, what is left of it is skipped.
+    :param data: payload of whitespace-separated hex lines
+    :param chunk_blocks: blocks to decrypt at once
+    :return: generator of streamed blobs
+    """
+    lines = iter_lines(data)
+    n = 0
+    for line in lines:
+        if line[:1] == b"$":
+            continue
+        blob = StreamedBlob(n, line, lines, chunk_blocks)
+        yield blob
+        blob.skip()
+        n += 1
+
+
+def write_srec(f, section: dict, records: Iterable[Tuple[int, bytes]], record_size: int or None = None) -> None:
+    srec.write(f, 32, records, section["name"], record_size=record_size)
+
+
+def write_bin(f, section: dict, records: Iterable[Tuple[int, bytes]], record_size: int or None = None) -> None:
+    write_flat(f, records)
+
+
+def write_ihex(f, section: dict, records: Iterable[Tuple[int, bytes]], record_size: int or None = None) -> None:
+    # Flattened through a temporary file first, so holes are filled as in `ihex.make()`
+    with TemporaryFile() as tmp:
+        start, size = write_flat(tmp, records)
+        tmp.seek(0)
+        f.writelines(ihex.make_records(__flat_blocks(tmp, start, size), record_size or 32))
+
+
+def __flat_blocks(f, start: int, size: int) -> Iterable[Tuple[int, bytes]]:
+    """
+    Contents of a flat image file in blocks ending at 64k boundaries, which
+    `ihex.make_records()` splits exactly like one contiguous record
+    """
+    address = start
+    end = start + size
+    while address < end:
+        length = min(end, (address | 0xffff) + 1) - address
+        yield address, f.read(length)
+        address += length
+
+
+def write_elf(f, section: dict, records: Iterable[Tuple[int, bytes]], record_size: int or None = None) -> None:
+    elf.write(f, records)
+
+
+# Export format: (file extension, open mode, writer)
+formats = {
+    "srec": ("srec", "w", write_srec),
+    "bin": ("bin", "wb", write_bin),
+    "ihex": ("hex", "w", write_ihex),
+    "elf": ("elf", "wb", write_elf)
+}
+
+
+def extract(exe: Path, path: Path or None = None, select: List[int] or None = None, fmt: str = "srec",
+            record_size: int or None = None, cache: CacheEntry or None = None,
+            chunk_blocks: int = chunk_blocks) -> List[dict]:
+    """
+    Extract firmware sections in a single pass over the updater payload.
+    Sections are written out as they are decrypted, so memory use does not
+    grow with the updater size.
+    :param exe: path to updater
+    :param path: export directory, None to only describe the blobs
+    :param select: blob numbers to export, defaults to all known sections
+    :param fmt: export format, key of `formats`
+    :param record_size: data bytes per record for text formats
+    :param cache: cache entry to store the manifest and exported sections' decrypted records in
+    :param chunk_blocks: blocks to decrypt at once
+    :return: manifest blob entries, exported ones with `file_name` or `error` added
+    """
+    extension, mode, writer = formats[fmt]
+    entries = []
+    with UpdaterPayload(exe) as payload:
+        for blob in stream_blobs(payload.data, chunk_blocks):
+            entry = blob.manifest_entry
+            entries.append(entry)
+            export = path is not None and blob.section is not None and (select is None or blob.number in select)
+            if export:
+                entry["file_name"] = path / f"{blob.name}.{extension}"
+                logger.debug(f"Streaming blob [{blob.number}] `{blob.name}` to `{entry['file_name']}`")
+                try:
+                    with open(entry["file_name"], mode) as f:
+                        if cache is not None:
+                            with cache.records_writer(blob.number) as raw:
+                                writer(f, blob.section, blob.records(raw=raw), record_size)
+                        else:
+                            writer(f, blob.section, blob.records(), record_size)
+                except BlobError as e:
+                    entry["error"] = e
+            blob.skip()
+            entry.update(blob.manifest_entry)
+    if cache is not None:
+        cache.save_manifest({
+            "sections_version": sections_version,
+            "blobs": [dict((k, e[k]) for k in ("name", "permute_offset", "size", "version")) for e in entries]
+        })
+    return entries
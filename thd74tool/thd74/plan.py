@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from typing import Dict, Iterable, List
+
+from .diff import block_digests
+from .image import MemoryImage
+
+logger = getLogger(__name__)
+
+page_size = 0x400  # payload bytes per 0x43 data packet
+message_overhead = 10  # 0xab 0xab, two length words, verb and \r\n
+segment_nouns = 52  # 0x40 segment setup nouns, without version string
+data_nouns = 8  # 0x43 offset and length nouns
+
+
+def message_size(nouns: int = 0, payload: int = 0) -> int:
+    """
+    Bytes on the wire for a FWPROG message
+    :param nouns: noun bytes
+    :param payload: payload bytes
+    """
+    return nouns + 1 + payload + message_overhead  # one checksum byte
+
+
+def segment_overhead(section: dict) -> int:
+    """
+    Bytes on the wire to set up and finish a segment, replies included:
+    0x40 setup, 0x41 reply, 0x42, OK, 0x45 done, 0x46 reply
+    """
+    return message_size(segment_nouns + section["version_length"]) + message_size(1) + \
+        message_size() + message_size() + message_size() + message_size(1)
+
+
+def page_wire_size(length: int = page_size) -> int:
+    return message_size(data_nouns, length)
+
+
+def __pages_wire_bytes(pages: Iterable[int], size: int) -> int:
+    return sum(page_wire_size(min(page_size, size - p)) for p in pages)
+
+
+def composite(images: Iterable[MemoryImage]) -> MemoryImage:
+    """
+    Flash contents after writing images in order, later ones overwriting earlier ones
+    """
+    flash = MemoryImage()
+    for image in images:
+        for start, data in image:
+            flash.add(start, bytes(data))
+    return flash
+
+
+def plan_segment(section: dict, target: MemoryImage, device: MemoryImage or None = None,
+                 erase: bool = True, patch: bool = False, expected: MemoryImage or None = None,
+                 fill: int = 0xff) -> dict:
+    """
+    Work out which pages of a segment need transmitting
+    :param section: section dict of the segment
+    :param target: image to flash
+    :param device: flash contents of the device, None if unknown
+    :param erase: device clears the whole segment on setup, so every page not
+                  blank after clearing must be sent as soon as anything changed
+    :param patch: segment is written into another segment with zero clear size,
+                  like the final writes of the updater, so it is never cleared
+    :param expected: flash contents after flashing, if later segments patch this one
+    :param fill: value of cleared flash and holes
+    :return: segment plan dict with `name`, `address`, `size`, `patch`, `pages`
+             (segment offsets of pages to send), `total_pages`, `wire_bytes` and
+             `full_wire_bytes` for sending the segment as the updater does
+    """
+    erase = erase and not patch
+    address, data = target.flatten(fill)
+    size = len(data)
+    total_pages = (size + page_size - 1) // page_size
+
+    if device is None:
+        pages = list(range(0, size, page_size))
+    else:
+        if expected is not None:
+            _, data = expected.flatten(fill, address, address + size)
+        _, current = device.flatten(fill, address, address + size)
+        changed = [n * page_size for n, a, b in zip(range(total_pages), block_digests(data, page_size),
+                                                    block_digests(current, page_size)) if a != b]
+        if len(changed) == 0:
+            pages = []
+        elif erase:
+            pages = list(range(0, size, page_size))
+        else:
+            pages = changed
+        _, data = target.flatten(fill)
+
+    if erase:
+        # Pages that are blank after clearing need not be sent
+        blank = bytes([fill]) * page_size
+        pages = [p for p in pages if data[p:p + page_size] != blank[:min(page_size, size - p)]]
+
+    full_wire_bytes = segment_overhead(section) + __pages_wire_bytes(range(0, size, page_size), size)
+    wire_bytes = 0
+    if len(pages) > 0 or device is None:
+        wire_bytes = segment_overhead(section) + __pages_wire_bytes(pages, size)
+
+    return {
+        "name": section["name"],
+        "address": address,
+        "size": size,
+        "patch": patch,
+        "pages": pages,
+        "total_pages": total_pages,
+        "wire_bytes": wire_bytes,
+        "full_wire_bytes": full_wire_bytes
+    }
+
+
+def plan_flash(sections: List[dict], targets: Dict[str, MemoryImage], device: Dict[str, MemoryImage] or None = None,
+               erase: bool = True) -> List[dict]:
+    """
+    Plan a delta flash of several segments. Segments are compared by what ends
+    up in flash, with all segments of the updater written in order.
+    :param sections: section dicts, in flashing order. Sections lying within an
+                     earlier one are written as patches into that segment.
+    :param targets: images of the updater to flash by section name
+    :param device: images of the updater last flashed to the device by section name
+    :param erase: device clears segments on setup
+    :return: list of segment plan dicts, see `plan_segment`
+    """
+    expected = composite(targets.values())
+    current = composite(device.values()) if device is not None else None
+    plan = []
+    for section in sections:
+        target = targets[section["name"]]
+        start, end = target.span
+        containers = [s for s in plan if s["address"] <= start and end <= s["address"] + s["size"]]
+        overwritten = False
+        for s in containers:
+            if s["wire_bytes"] > 0 and erase and not s["patch"]:
+                overwritten = True  # cleared along with its container
+            if any(s["address"] + p < end and start < s["address"] + p + page_size for p in s["pages"]):
+                overwritten = True
+        segment = plan_segment(section, target, None if overwritten else current, erase,
+                               len(containers) > 0, expected)
+        logger.debug(f"Segment `{segment['name']}`: {len(segment['pages'])} of {segment['total_pages']} pages")
+        plan.append(segment)
+    return plan
+
+
+def estimate(plan: List[dict], baud: int = 115200, latency: float = 0.01) -> dict:
+    """
+    Expected transfer volume and duration of a plan compared to a full flash
+    :param plan: list of segment plan dicts
+    :param baud: serial line speed, 10 bit times per byte
+    :param latency: seconds per command round trip, three per segment
+    :return: dict with `wire_bytes`, `full_wire_bytes`, `seconds`, `full_seconds` and `saved_seconds`
+    """
+    wire_bytes = sum(s["wire_bytes"] for s in plan)
+    full_wire_bytes = sum(s["full_wire_bytes"] for s in plan)
+    segments = sum(1 for s in plan if s["wire_bytes"] > 0)
+    seconds = wire_bytes * 10 / baud + 3 * segments * latency
+    full_seconds = full_wire_bytes * 10 / baud + 3 * len(plan) * latency
+    return {
+        "wire_bytes": wire_bytes,
+        "full_wire_bytes": full_wire_bytes,
+        "seconds": seconds,
+        "full_seconds": full_seconds,
+        "saved_seconds": full_seconds - seconds
+    }
+
+
+class SimulatedFlash(object):
+    """
+    Flash memory of a simulated device, for checking plans without a radio
+    """
+
+    def __init__(self, images: Dict[str, MemoryImage] or None = None, fill: int = 0xff):
+        self.fill = fill
+        self.memory = MemoryImage()
+        self.written = 0
+        if images is not None:
+            self.memory = composite(images.values())
+
+    def erase(self, address: int, size: int) -> None:
+        self.memory.add(address, bytes([self.fill]) * size, "erase")
+
+    def write(self, address: int, data: bytes) -> None:
+        self.memory.add(address, data, "write")
+        self.written += len(data)
+
+    def apply(self, plan: List[dict], targets: Dict[str, MemoryImage], erase: bool = True) -> None:
+        """
+        Flash a plan as the device would receive it
+        :param erase: device clears non-patch segments on setup
+        """
+        for segment in plan:
+            if segment["wire_bytes"] == 0:
+                continue
+            if erase and not segment["patch"]:
+                self.erase(segment["address"], segment["size"])
+            _, data = targets[segment["name"]].flatten(self.fill)
+            for p in segment["pages"]:
+                self.write(segment["address"] + p, data[p:p + page_size])
+
+    def verify(self, targets: Dict[str, MemoryImage], names: List[str] or None = None) -> List[str]:
+        """
+        Names of segments whose flash contents differ from what writing all
+        targets in order would give
+        :param targets: images of the flashed updater by section name
+        :param names: segments to check, defaults to all targets
+        """
+        expected = composite(targets.values())
+        failed = []
+        for name in names or targets.keys():
+            image = targets[name]
+            start, end = image.span
+            if self.memory.read(start, end - start, self.fill) != expected.read(start, end - start, self.fill):
+                failed.append(name)
+        return failed
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from binascii import hexlify, unhexlify
-from functools import reduce
+from collections import deque
+from itertools import chain
 from logging import getLogger
-from struct import pack, unpack
-from time import time, sleep
-from typing import List, Iterable
+from struct import pack, pack_into, unpack, error as StructError
+from time import time
+from typing import List, Iterable, Sequence
 
+from . import fwprog
 from . import tty as thdtty
 
 logger = getLogger(__name__)
@@ -22,6 +24,8 @@ class Message(object):
     """
 
     def __init__(self, verb: int = 0, nouns: Iterable[bytes] = None, payload: Iterable[bytes] = None, parse: bytes = None, key: int = 0):
+        # `parse` is one frame as from `MessageParser`, without the newline. Raw
+        # wire data goes through `Message.parse()`, which frames it by length.
         # 0xab 0xab [2 byte length] [2 byte payload length] [2 byte verb] [optional nouns] [optional payload] [1 byte checksum]
         self.verb = verb
         self.nouns = nouns or []
@@ -30,12 +34,19 @@ class Message(object):
         self.checksum_recv = None
 
         if parse is not None:
-            if parse[0] == parse[1]:
+            if type(parse) is str:
+                parse = parse.encode("latin-1")
+            elif type(parse) is not bytes:
+                parse = bytes(parse)
+            if len(parse) >= 2 and parse[0] == parse[1]:
                 # FWPROG mode command message
                 self.key = parse[0] ^ 0xab
-                cl = bytes([x ^ self.key for x in parse.rstrip(b"\r\n")])
-                ncl, pl, self.verb = unpack(">xxHHH", cl[:8])
-                n, p, self.checksum_recv = unpack(f">8x{ncl-1}s{pl}sB", cl)
+                cl = parse.translate(fwprog.xor_tables[self.key])
+                try:
+                    ncl, pl, self.verb = unpack(">xxHHH", cl[:8])
+                    n, p, self.checksum_recv = unpack(f">8x{ncl-1}s{pl}sB", cl)
+                except StructError:
+                    raise ProtocolError(f"Invalid message `{parse}`")
                 self.nouns = [n]
                 self.payload = [p]
 
@@ -49,25 +60,57 @@ class Message(object):
             return True
         return checksum == self.checksum_recv
 
+    @property
+    def noun_bytes(self) -> bytes:
+        return b"".join(self.nouns)
+
+    @property
+    def payload_bytes(self) -> bytes:
+        return b"".join(self.payload)
+
     @property
     def checksum(self):
-        return reduce(lambda x, y: x + y, self.__bytes_no_check()[2:], 0) % 256
+        return fwprog.checksum(self.__bytes_no_check()[2:])
 
     def __bytes_no_check(self):
-        ncl = reduce(lambda x, y: x + len(y), self.nouns, 1) % 256
-        pl = reduce(lambda x, y: x + len(y), self.payload, 0) % 256
-        return b"\xab\xab" + pack(f">HHH{ncl-1}s{pl}s", ncl, pl, self.verb, b"".join(self.nouns), b"".join(self.payload))
+        nouns = self.noun_bytes
+        payload = self.payload_bytes
+        return b"\xab\xab" + pack(">HHH", len(nouns) + 1, len(payload), self.verb) + nouns + payload
 
     def __bytes__(self):
-        msg = self.__bytes_no_check()
-        msg += bytes([reduce(lambda x, y: x + y, msg[2:], 0) % 256])
-        return bytes(map(lambda x: x ^ self.key, msg)) + b"\r\n"
+        return fwprog.encode(self.verb, self.noun_bytes, self.payload_bytes, self.key)
+
+    def encode_into(self, buffer: bytearray, pos: int = 0) -> int:
+        """
+        Encode the message as sent on the wire directly into `buffer`
+        :param buffer: buffer with at least `len(self)` bytes free at `pos`
+        :param pos: offset of the message in the buffer
+        :return: offset just past the message
+        """
+        view = memoryview(buffer)
+        start = pos
+        nouns = sum(map(len, self.nouns))
+        payload = sum(map(len, self.payload))
+        pack_into(">2sHHH", buffer, pos, fwprog.attention, nouns + 1, payload, self.verb)
+        pos += 8
+        for part in chain(self.nouns, self.payload):
+            view[pos:pos + len(part)] = part
+            pos += len(part)
+        buffer[pos] = fwprog.checksum(view[start + 2:pos])
+        pos += 1
+        if self.key != 0:
+            view[start:pos] = view[start:pos].tobytes().translate(fwprog.xor_tables[self.key])
+        view[pos:pos + 2] = fwprog.newline
+        return pos + 2
+
+    def __len__(self):
+        # attention, three length fields, checksum and newline
+        return sum(map(len, self.nouns)) + sum(map(len, self.payload)) + 11
 
     def __str__(self):
         msg = self.__bytes_no_check()
-        msg += bytes([reduce(lambda x, y: x + y, msg[2:], 0) % 256])
-        h = msg.hex()
-        return " ".join([h[i:i+2] for i in range(0, len(h), 2)]) + f" [^{self.key:02x}]"
+        msg += bytes([fwprog.checksum(msg[2:])])
+        return msg.hex(" ") + f" [^{self.key:02x}]"
 
     def __repr__(self):
         return repr(bytes(self))
@@ -77,40 +120,154 @@ class Message(object):
             yield b
 
     def __eq__(self, other):
-        if str(self) != str(other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        if (self.verb, self.key, self.noun_bytes, self.payload_bytes) != \
+                (other.verb, other.key, other.noun_bytes, other.payload_bytes):
             return False
-        else:
-            if self.checksum_recv == other.checksum_recv:
-                return True
-            else:
-                if self.checksum_recv is None or other.checksum_recv is None:
-                    return True
-                else:
-                    return False
+        if self.checksum_recv is None or other.checksum_recv is None:
+            return True
+        return self.checksum_recv == other.checksum_recv
 
     @classmethod
     def parse(cls, messages):
-        if type(messages) is bytes:
-            messages = messages.decode('ascii')
-        for message in messages.split("\r\n"):
-            if len(message) > 0:
-                yield cls(parse=message)
+        if type(messages) is str:
+            messages = messages.encode("latin-1")
+        for frame in MessageParser().feed(messages):
+            yield cls(parse=frame)
+
+
+def encode_messages(messages: Sequence[Message], buffer: bytearray or None = None) -> memoryview:
+    """
+    Encode many messages back to back into one buffer
+    :param messages: messages to encode
+    :param buffer: buffer to reuse, a new one is allocated if None or too small
+    :return: view of the encoded messages in the buffer
+    """
+    size = sum(map(len, messages))
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+    pos = 0
+    for m in messages:
+        pos = m.encode_into(buffer, pos)
+    return memoryview(buffer)[:pos]
+
+
+class MessageParser(object):
+    """
+    Incremental framing of FWPROG messages from a byte stream. Messages are
+    delimited by their attention bytes and header length fields, so payloads
+    containing newline bytes are framed correctly. Data is fed in chunks of any
+    size, each byte is copied at most twice.
+    """
+
+    header_size = 8  # attention, cmd length, payload length, verb
+
+    def __init__(self, key: int or None = None):
+        """
+        :param key: xor obfuscation key, None to learn it from the first message
+        """
+        self.key = key
+        self.__chunks = []
+        self.__size = 0
+        self.__need = self.header_size
+
+    @property
+    def pending(self) -> int:
+        """
+        Bytes buffered towards the next message
+        """
+        return self.__size
+
+    def reset(self) -> None:
+        self.__chunks = []
+        self.__size = 0
+        self.__need = self.header_size
+
+    def feed(self, data: bytes) -> List[memoryview]:
+        """
+        Add received bytes
+        :param data: next chunk of the stream
+        :return: views of the complete messages, still obfuscated and without newline
+        """
+        if len(data) == 0:
+            return []
+        self.__chunks.append(data)
+        self.__size += len(data)
+        if self.__size < self.__need:
+            return []
+
+        buf = self.__chunks[0] if len(self.__chunks) == 1 else b"".join(self.__chunks)
+        view = memoryview(buf)
+        frames = []
+        pos = 0
+        self.__need = self.header_size
+        while len(buf) - pos >= self.header_size:
+            start = self.__find_attention(buf, pos)
+            if start < 0:
+                pos = len(buf) - 1  # the last byte may start the next attention
+                break
+            if start > pos:
+                logger.debug(f"Skipping {start - pos} bytes of garbage in stream")
+                pos = start
+            if len(buf) - pos < self.header_size:
+                break
+            key = buf[pos] ^ 0xab
+            ncl = (buf[pos + 2] ^ key) << 8 | (buf[pos + 3] ^ key)
+            pl = (buf[pos + 4] ^ key) << 8 | (buf[pos + 5] ^ key)
+            end = pos + self.header_size + ncl + pl
+            if end + 2 > len(buf):
+                self.__need = end + 2 - pos
+                break
+            if buf[end:end + 2] != fwprog.newline:
+                logger.debug("Message length does not match newline, resyncing")
+                pos += 1
+                continue
+            if self.key is None:
+                logger.debug(f"Learned xor key {key:#04x} from stream")
+                self.key = key
+            frames.append(view[pos:end])
+            pos = end + 2
+
+        rest = view[pos:]
+        self.__chunks = [rest] if len(rest) > 0 else []
+        self.__size = len(rest)
+        return frames
+
+    def __find_attention(self, buf: bytes, pos: int) -> int:
+        if self.key is not None:
+            return buf.find(bytes([0xab ^ self.key]) * 2, pos)
+        for i in range(pos, len(buf) - 1):
+            if buf[i] == buf[i + 1]:
+                return i
+        return -1
+
+    def messages(self, data: bytes) -> List[Message]:
+        """
+        Add received bytes
+        :return: complete messages
+        """
+        return [Message(parse=frame) for frame in self.feed(data)]
 
 
 class GenericTHDProtocol(object):
 
-    def __init__(self, tty=None):
+    def __init__(self, tty=None, probe_timeout=0.5):
         self.conn = None
+        self.probe_timeout = probe_timeout
+        self.firmware_version = None
         self.connected = False
         self.thd_hardware = False
         self.fwprog_mode = False
         self.pcrig_mode = False
         self.key = None
+        self.parser = MessageParser()
+        self.received = deque()
         self.__connect(tty)
 
     def __connect(self, tty):
         self.conn = thdtty.GenericTHDTTY(tty)
-        self.__detect_device_mode()
+        self.detect()
         self.connected = True
         if self.thd_hardware:
             logger.debug("Device responds like THD style hardware")
@@ -124,14 +281,17 @@ class GenericTHDProtocol(object):
             # self.cmd_mode()
             # self.sync()
 
-    def __detect_device_mode(self):
+    def detect(self):
+        """
+        Detect the device mode from its reply to `ID`, also to check on a device
+        again after an aborted session
+        """
         self.conn.flush_input()
         self.conn.flush_output()
 
         self.conn.write(b"ID\r")
-        sleep(0.5)
         try:
-            r = self.conn.read_all()
+            r = self.conn.read_until(b"\r", self.probe_timeout)
         except TimeoutError:
             logger.debug("No response, so probably in FWPROG mode")
             self.thd_hardware = True
@@ -139,11 +299,12 @@ class GenericTHDProtocol(object):
             self.fwprog_mode = True
             return
 
-        if r.startswith(b"ID "):
+        if r.startswith(b"ID ") and r.endswith(b"\r"):
             logger.debug("Response like THD hardware in PCRIG mode")
             self.thd_hardware = True
             self.pcrig_mode = True
             self.fwprog_mode = False
+            self.firmware_version = self.get_firmware_version()
             return
 
         logger.warning("Unknown response from `ID` command")
@@ -152,6 +313,10 @@ class GenericTHDProtocol(object):
         self.fwprog_mode = False
         return
 
+    def close(self):
+        self.conn.close()
+        self.connected = False
+
     def available(self):
         return self.conn.available()
 
@@ -168,12 +333,12 @@ class GenericTHDProtocol(object):
         return self.conn.read_line(*args, **kwargs)
 
     def send(self, verb, nouns=None, payload=None):
-        self.write(Message(verb, nouns, payload, self.key))
+        self.write(bytes(Message(verb, nouns, payload, key=self.key)))
 
     def receive(self):
-        while True:
-            m = Message(parse=self.read_line())
-            return m
+        while len(self.received) == 0:
+            self.received.extend(self.parser.messages(self.read(max(1, self.available()))))
+        return self.received.popleft()
 
     def cmd_mode(self):
         if self.fwprog_mode:
@@ -182,9 +347,11 @@ class GenericTHDProtocol(object):
             # self.key = 2
             self.write(b"FPROMOD")
             self.key = 0
+            self.parser = MessageParser(self.key)
+            self.received.clear()
             res = self.read(2)
             if res == b"\x16\x06":
-                logger.debg("Device now ready to receive commands")
+                logger.debug("Device now ready to receive commands")
             else:
                 raise ProtocolError("Unexpected response to command mode request")
 
@@ -207,7 +374,7 @@ class GenericTHDProtocol(object):
             return None
         self.conn.write(b"FV\r")
         try:
-            r = self.read(8)
+            r = self.conn.read_until(b"\r", self.probe_timeout)
         except TimeoutError:
             logger.warning("No reply from device to firware version request")
             return None
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+from logging import getLogger
+import os
+from pathlib import Path
+from threading import Event
+from typing import Callable, Dict, List, Tuple
+
+from serial.tools import list_ports
+
+from . import device
+from .cache import default_cache_dir
+
+logger = getLogger(__name__)
+
+by_id_dir = Path("/dev/serial/by-id")
+poll_interval = 1.0  # seconds between checks for port changes
+
+
+def port_identity(port) -> str or None:
+    """
+    Identity of a USB serial port that changes when the device is reconnected.
+    The USB device number increments on every connect, where available.
+    :return: identity, None where reconnects can not be told apart
+    """
+    usb_path = getattr(port, "usb_device_path", None)
+    if usb_path is None:
+        return None
+    try:
+        devnum = (Path(usb_path) / "devnum").read_text().strip()
+    except OSError:
+        return None
+    return f"{port.hwid} {devnum}"
+
+
+def ports_signature(ttys: List[str] or None = None) -> tuple:
+    """
+    Cheap fingerprint of the attached serial ports for detecting changes.
+    Uses the links in /dev/serial/by-id where udev maintains them.
+    """
+    try:
+        signature = tuple(sorted((p.name, os.readlink(p)) for p in by_id_dir.iterdir()))
+    except OSError:
+        signature = tuple(sorted((p.device, p.hwid) for p in list_ports.comports()))
+    return signature + tuple(tty for tty in ttys or [] if os.path.exists(tty))
+
+
+class DeviceRegistry(object):
+    """
+    Known radios by tty, with model, mode and firmware version as probed when
+    they were connected. Radios are only probed when they appear, entries last
+    until the device disconnects. The registry is kept in a file, so
+    subsequent runs skip probing radios that stayed connected. Ports without
+    an identity, such as explicit ttys or ports on platforms without USB
+    device numbers, are probed again whenever `ports_signature()` changed.
+    Probing writes to the port, so radios are left alone while the port
+    list stays the same.
+    """
+
+    def __init__(self, path: Path or None = None, ttys: List[str] or None = None,
+                 probe_timeout: float = device.probe_timeout):
+        """
+        :param path: registry file, None to keep it in memory only
+        :param ttys: additional tty paths to track, assumed to be TH-D74s
+        :param probe_timeout: seconds to wait for a radio to identify
+        """
+        self.path = path
+        self.ttys = ttys or []
+        self.probe_timeout = probe_timeout
+        self.entries = {}  # tty -> entry dict
+        self.signature = None  # ports_signature() at the last refresh, as stored
+        self.load()
+
+    @classmethod
+    def default(cls, **kwargs) -> "DeviceRegistry":
+        return cls(default_cache_dir() / "devices.json", **kwargs)
+
+    def load(self) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.entries = dict((e["tty"], e) for e in data["devices"])
+            self.signature = data["signature"]
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            self.entries = {}
+            self.signature = None
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"signature": self.signature, "devices": self.devices}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    @property
+    def devices(self) -> List[dict]:
+        return [self.entries[tty] for tty in sorted(self.entries)]
+
+    def scan(self) -> Dict[str, Tuple[type, str]]:
+        """
+        Attached ports of known radio models
+        :return: (device class, port identity or None) by tty
+        """
+        ports = {}
+        for p in list_ports.comports():
+            for model in device.models.values():
+                if p.vid == model.usb_vendor_id and p.pid == model.usb_product_id:
+                    ports[p.device] = (model, port_identity(p))
+        for tty in self.ttys:
+            if os.path.exists(tty) and tty not in ports:
+                ports[tty] = (device.THD74, None)
+        return ports
+
+    def refresh(self) -> Tuple[List[dict], List[dict]]:
+        """
+        Drop entries of disconnected radios and probe newly connected ones
+        :return: (added entries, removed entries)
+        """
+        # As it reads back from the registry file
+        signature = json.loads(json.dumps(ports_signature(self.ttys)))
+        changed = signature != self.signature
+        self.signature = signature
+        ports = self.scan()
+        removed = []
+        for tty in list(self.entries):
+            if tty not in ports or ports[tty][1] != self.entries[tty].get("identity"):
+                removed.append(self.entries.pop(tty))
+
+        added = []
+        # Entries without identity may belong to a reconnected radio, probe them again
+        probe = [tty for tty in sorted(ports) if tty not in self.entries or (changed and ports[tty][1] is None)]
+        for model in set(ports[tty][0] for tty in probe):
+            ttys = [tty for tty in probe if ports[tty][0] is model]
+            for tty, entry in zip(ttys, self.__probe(model, ttys)):
+                entry["identity"] = ports[tty][1]
+                old = self.entries.get(tty)
+                if old == entry:
+                    continue
+                if old is not None:
+                    removed.append(old)
+                self.entries[tty] = entry
+                added.append(entry)
+
+        if changed or len(added) > 0 or len(removed) > 0:
+            self.save()
+        return added, removed
+
+    def __probe(self, model, ttys: List[str]) -> List[dict]:
+        logger.debug(f"Probing {', '.join(ttys)}")
+        with ThreadPoolExecutor(max_workers=len(ttys)) as pool:
+            return list(pool.map(lambda tty: self.__probe_one(model, tty), ttys))
+
+    def __probe_one(self, model, tty: str) -> dict:
+        entry = {"tty": tty, "handle": model.handle, "brand": model.brand, "model": model.model,
+                 "mode": "unknown", "firmware_version": None}
+        try:
+            d = model(tty, self.probe_timeout)
+        except OSError as e:
+            logger.warning(f"Unable to probe {tty}: {e}")
+            return entry
+        if d.comm.thd_hardware:
+            entry["mode"] = "fwprog" if d.comm.fwprog_mode else "pcrig"
+        entry["firmware_version"] = d.firmware_version
+        d.close()
+        return entry
+
+    def watch(self, callback: Callable[[List[dict], List[dict]], None], interval: float = poll_interval,
+              stop: Event or None = None) -> None:
+        """
+        Report radios as they are connected and disconnected, until `stop` is set.
+        Ports are polled through `ports_signature()`, the registry is only
+        refreshed when that changes.
+        :param callback: called with (added entries, removed entries), first with all current radios
+        """
+        stop = stop or Event()
+        signature = ports_signature(self.ttys)
+        added, removed = self.refresh()
+        callback(self.devices, removed)
+        while not stop.wait(interval):
+            current = ports_signature(self.ttys)
+            if current == signature:
+                continue
+            signature = current
+            added, removed = self.refresh()
+            if len(added) > 0 or len(removed) > 0:
+                callback(added, removed)
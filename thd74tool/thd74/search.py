@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+from pathlib import Path
+import re
+from typing import Iterable, List, Tuple
+
+from .binary import parse_blob_records
+from .cache import CacheEntry, SectionCache, load_sections, manifest_section
+from .image import MemoryImage
+
+logger = getLogger(__name__)
+
+min_string_length = 4
+max_hits = 1000  # default cap on reported hits
+
+
+class SectionIndex(object):
+    """
+    Flattened memory images of all known sections of an updater for searching.
+    Each image is one contiguous buffer with holes filled, so every query is a
+    C-level scan. Strings are extracted once per section and minimum length,
+    and kept in the cache entry if there is one.
+    """
+
+    def __init__(self, entry: CacheEntry or None = None):
+        """
+        :param entry: cache entry to keep strings in, None to keep them in memory only
+        """
+        self.entry = entry
+        self.sections = []  # (n, section dict, start address, data)
+        self.__strings = {}  # (n, min_length) -> [(absolute address, string)]
+
+    def add(self, n: int, section: dict, start: int, data: bytes) -> None:
+        self.sections.append((n, section, start, data))
+
+    def select(self, numbers: List[int] or None = None) -> Iterable[Tuple[int, dict, int, bytes]]:
+        for entry in self.sections:
+            if numbers is None or entry[0] in numbers:
+                yield entry
+
+    def find(self, patterns: List[bytes], numbers: List[int] or None = None,
+             limit: int or None = None) -> Iterable[Tuple[dict, int, bytes]]:
+        """
+        All occurrences of any of the patterns, overlapping ones included. All
+        patterns are matched in a single scan, where several of them start at
+        the same address only the longest is reported.
+        :param patterns: byte strings to search for
+        :param numbers: blob numbers of sections to search, default all
+        :param limit: stop after this many hits, default all
+        :return: (section, absolute address, pattern) per hit in address order per section
+        """
+        patterns = sorted(set(p for p in patterns if len(p) > 0), key=len, reverse=True)
+        if len(patterns) == 0:
+            return
+        # Zero-width lookahead, so the scan advances a byte at a time and overlapping hits are found
+        regex = re.compile(b"(?=(" + b"|".join(re.escape(p) for p in patterns) + b"))", re.DOTALL)
+        hits = 0
+        for n, section, start, data in self.select(numbers):
+            for m in regex.finditer(data):
+                if limit is not None and hits >= limit:
+                    return
+                yield section, start + m.start(), m.group(1)
+                hits += 1
+
+    def strings(self, min_length: int = min_string_length,
+                numbers: List[int] or None = None) -> Iterable[Tuple[dict, int, bytes]]:
+        """
+        Runs of printable ASCII like the `strings` tool
+        :return: (section, absolute address, string) per run
+        """
+        for n, section, start, data in self.select(numbers):
+            for address, string in self.__section_strings(n, start, data, min_length):
+                yield section, address, string
+
+    def __section_strings(self, n: int, start: int, data: bytes, min_length: int) -> List[Tuple[int, bytes]]:
+        key = (n, min_length)
+        if key in self.__strings:
+            return self.__strings[key]
+        strings = self.entry.load_strings(n, min_length) if self.entry is not None else None
+        if strings is None:
+            printable = re.compile(rb"[\x20-\x7e]{%d,}" % min_length)
+            strings = [(start + m.start(), m.group()) for m in printable.finditer(data)]
+            if self.entry is not None:
+                self.entry.save_strings(n, min_length, strings)
+        self.__strings[key] = strings
+        return strings
+
+
+def load_index(exe: Path, cache: SectionCache or None = None) -> SectionIndex:
+    """
+    Build a section index for an updater, or load it from the cache. Images are
+    cached along with the decrypted records, so repeated searches skip parsing.
+    """
+    entry = cache.entry(exe) if cache is not None else None
+    manifest = entry.load_manifest() if entry is not None else None
+    index = SectionIndex(entry)
+
+    if manifest is not None:
+        images = [entry.load_image(n) if e["name"] is not None else None
+                  for n, e in zip(range(len(manifest["blobs"])), manifest["blobs"])]
+        if all(image is not None for image, e in zip(images, manifest["blobs"]) if e["name"] is not None):
+            logger.info(f"Serving section index of `{str(exe)}` from cache")
+            for n, e, image in zip(range(len(images)), manifest["blobs"], images):
+                if image is not None:
+                    index.add(n, manifest_section(e), *image)
+            return index
+
+    blobs = load_sections(exe, cache)
+    for n, (section, records) in zip(range(len(blobs)), blobs):
+        if section is None:
+            continue
+        image = MemoryImage.from_records(parse_blob_records(records, section["memory_address"]), section["name"])
+        start, data = image.flatten()
+        data = bytes(data)
+        if entry is not None:
+            entry.save_image(n, start, data)
+        index.add(n, section, start, data)
+    return index
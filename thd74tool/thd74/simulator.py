@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+from logging import getLogger
+import os
+import re
+from select import select
+from struct import unpack
+from threading import Thread, Event
+from time import time, sleep
+from tty import setraw
+from typing import List
+
+from . import fwprog
+from .plan import SimulatedFlash
+from .protocol import MessageParser
+
+logger = getLogger(__name__)
+
+# Nouns of the 0x32 reply to 0x31, as captured
+info_nouns = bytes.fromhex("0200000000000000020000000000000000")
+
+fwprog_magic = re.compile(rb"FPROMOD|[\x00-\xff]{2}Thd74tw([\x00-\xff])([\x00-\xff])", re.DOTALL)
+
+
+def magic_key(y: int, z: int) -> int:
+    """
+    Xor key negotiated by the last two bytes of the encrypted mode magic sequence
+    """
+    k = (((y + z + 72) & 120) - ((y + z) & 7)) % 128
+    return k if k != 0 else 0x74
+
+
+class Simulator(Thread):
+    """
+    Simulated radio on a pseudo-terminal, for exercising the serial code
+    without hardware. Point `GenericTHDTTY` at `tty`. In PCRIG mode it
+    answers `ID` and `FV`. In FWPROG mode it accepts the cleartext and
+    encrypted mode handshakes and runs the flashing protocol against a
+    `SimulatedFlash`.
+    """
+
+    instances = []
+
+    def __init__(self, mode: str = "pcrig", model: str = "TH-D74", firmware_version: str = "1.10",
+                 baud: int or None = None, busy_time: float = 0.3, busy_interval: float = 0.1,
+                 busy_pages: int = 0, fail_setups: int = 0, flash: SimulatedFlash or None = None):
+        """
+        :param mode: `pcrig` or `fwprog`
+        :param model: model name returned by `ID`
+        :param firmware_version: version returned by `FV`
+        :param baud: simulated line speed, 10 bit times per byte, None for unlimited
+        :param busy_time: seconds the device is busy clearing a segment after 0x42
+        :param busy_interval: seconds between BUSY replies while busy
+        :param busy_pages: also be busy after every this many 0x43 data messages, replying
+                           OK when done, 0 for never
+        :param fail_setups: answer this many 0x40 setups with a corrupted reply, as after line noise
+        :param flash: flash memory to program, default empty
+        """
+        super().__init__(daemon=True)
+        if mode not in ("pcrig", "fwprog"):
+            raise ValueError(f"Unknown simulator mode `{mode}`")
+        self.mode = mode
+        self.model = model
+        self.firmware_version = firmware_version
+        self.baud = baud
+        self.busy_time = busy_time
+        self.busy_interval = busy_interval
+        self.busy_pages = busy_pages
+        self.__pages = 0
+        self.fail_setups = fail_setups
+        self.flash = flash or SimulatedFlash()
+        self.key = None
+        self.segment = None
+        self.completed = False
+        self.sessions = 0  # times command mode was entered
+        self.received = []  # verbs of FWPROG messages in order
+        self.__buffer = b""
+        self.__parser = None
+        self.__stop = Event()
+        self.__line_free = time()
+
+        self.master, self.slave = os.openpty()
+        setraw(self.slave)
+        self.tty = os.ttyname(self.slave)
+        Simulator.instances.append(self)
+
+    @classmethod
+    def stop_instances(cls) -> None:
+        for s in cls.instances:
+            s.stop()
+
+    @classmethod
+    def join_instances(cls, timeout: float or None = None) -> None:
+        for s in cls.instances:
+            if s.is_alive():
+                s.join(timeout)
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def run(self) -> None:
+        logger.debug(f"Simulating {self.model} in {self.mode} mode on {self.tty}")
+        try:
+            while not self.__stop.is_set():
+                r, _, _ = select([self.master], [], [], 0.1)
+                if len(r) == 0:
+                    continue
+                try:
+                    data = os.read(self.master, 0x10000)
+                except OSError:
+                    break
+                self.__throttle(len(data))
+                if self.mode == "pcrig":
+                    self.__pcrig(data)
+                elif not self.completed:
+                    self.__fwprog(data)
+        finally:
+            os.close(self.master)
+            os.close(self.slave)
+            if self in Simulator.instances:
+                Simulator.instances.remove(self)
+
+    def __throttle(self, size: int) -> None:
+        """
+        Hold off reading to the simulated line speed, so writers see backpressure
+        """
+        if self.baud is None:
+            return
+        now = time()
+        self.__line_free = max(self.__line_free, now) + size * 10 / self.baud
+        if self.__line_free > now:
+            sleep(self.__line_free - now)
+
+    def __write(self, data: bytes) -> None:
+        self.__throttle(len(data))
+        os.write(self.master, data)
+
+    def __pcrig(self, data: bytes) -> None:
+        self.__buffer += data
+        while b"\r" in self.__buffer:
+            line, self.__buffer = self.__buffer.split(b"\r", 1)
+            if line == b"ID":
+                self.__write(f"ID {self.model}\r".encode("ascii"))
+            elif line == b"FV":
+                self.__write(f"FV {self.firmware_version}\r".encode("ascii"))
+            elif len(line) > 0:
+                self.__write(b"?\r")
+
+    def __fwprog(self, data: bytes) -> None:
+        if self.__parser is not None and fwprog_magic.match(data):
+            # A restarted session enters command mode again
+            self.__parser = None
+        if self.__parser is None:
+            self.__buffer += data
+            m = fwprog_magic.search(self.__buffer)
+            if m is None:
+                self.__buffer = self.__buffer[-10:]  # magic may continue in the next read
+                return
+            self.key = 0 if m.group(1) is None else magic_key(m.group(1)[0], m.group(2)[0])
+            logger.debug(f"Simulator entering command mode with xor key {self.key:#04x}")
+            self.__parser = MessageParser(self.key)
+            self.sessions += 1
+            self.__write(b"\x16\x06")
+            data = self.__buffer[m.end():]
+            self.__buffer = b""
+
+        for m in self.__parser.messages(data):
+            self.received.append(m.verb)
+            if not m.validate():
+                logger.warning(f"Simulator received bad checksum in `{m}`")
+                continue
+            self.__command(m.verb, m.noun_bytes, m.payload_bytes)
+            if self.completed:
+                break
+
+    def __reply(self, verb: int, nouns: bytes = b"") -> None:
+        self.__write(fwprog.encode(verb, nouns, key=self.key))
+
+    def __command(self, verb: int, nouns: bytes, payload: bytes) -> None:
+        if verb in (fwprog.PROGRAM, 0xa0, 0x33):
+            self.__reply(fwprog.OK)
+        elif verb == 0x31:
+            self.__reply(0x32, info_nouns)
+        elif verb == fwprog.SEGMENT_SETUP:
+            self.__setup(nouns)
+        elif verb == fwprog.SEGMENT_PREPARE:
+            self.__busy()
+            if self.segment is not None and self.segment["clear_size"] > 0:
+                self.flash.erase(self.segment["address"], self.segment["clear_size"])
+            self.__reply(fwprog.OK)
+        elif verb == fwprog.DATA:
+            self.__data(nouns, payload)
+        elif verb == fwprog.SEGMENT_DONE:
+            if self.segment is not None and self.segment["received"] != self.segment["transfer_size"]:
+                logger.warning(f"Simulator received {self.segment['received']:#x} bytes, "
+                               f"segment setup announced {self.segment['transfer_size']:#x}")
+            self.__reply(fwprog.SEGMENT_DONE_REPLY, b"\x00")
+        elif verb == fwprog.FINISH:
+            logger.debug("Simulator completed flashing")
+            self.__reply(fwprog.OK)
+            self.completed = True
+        else:
+            logger.warning(f"Simulator ignoring unknown verb {verb:#04x}")
+
+    def __busy(self) -> None:
+        until = time() + self.busy_time
+        while time() < until:
+            self.__reply(fwprog.BUSY)
+            sleep(min(self.busy_interval, max(0.0, until - time())))
+
+    def __setup(self, nouns: bytes) -> None:
+        fields = unpack("<13I", nouns[:52])
+        address = fields[0] - fwprog.address_base
+        version = nouns[52:52 + fields[12]]
+        current = self.flash.memory.read(address + fields[11], len(version), self.flash.fill) if len(version) > 0 else b""
+        self.segment = {
+            "address": address,
+            "transfer_size": fields[1],
+            "clear_size": fields[2],
+            "segment_id": fields[6],
+            "received": 0
+        }
+        logger.debug(f"Simulator segment setup at {address:#010x}, {fields[1]:#x} bytes")
+        reply = fwprog.encode(fwprog.SEGMENT_REPLY, b"\x00" if len(version) > 0 and current == version else b"\x01",
+                              key=self.key)
+        if self.fail_setups > 0:
+            self.fail_setups -= 1
+            reply = reply[:-3] + bytes([reply[-3] ^ 0xff]) + reply[-2:]  # corrupt the checksum
+        self.__write(reply)
+
+    def __data(self, nouns: bytes, payload: bytes) -> None:
+        if self.segment is None:
+            logger.warning("Simulator received data without segment setup")
+            return
+        offset, length = unpack("<II", nouns[:8])
+        data = payload if len(payload) > 0 else nouns[8:8 + length]
+        self.flash.write(self.segment["address"] + offset, data)
+        self.segment["received"] += len(data)
+        self.__pages += 1
+        if self.busy_pages > 0 and self.__pages % self.busy_pages == 0:
+            self.__busy()
+            self.__reply(fwprog.OK)
+
+
+def start(count: int = 1, **kwargs) -> List[Simulator]:
+    """
+    Start simulated radios
+    :param count: number of radios
+    :param kwargs: `Simulator` parameters
+    """
+    simulators = [Simulator(**kwargs) for _ in range(count)]
+    for s in simulators:
+        s.start()
+    return simulators
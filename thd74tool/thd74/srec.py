@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from binascii import unhexlify
-from functools import reduce
-from typing import Iterable
+from typing import Iterable, Tuple
 
 address_bits = {
     0: 16,
@@ -16,20 +15,49 @@ address_bits = {
 }
 
 
+def max_record_size(rectype: int) -> int:
+    """
+    Maximum number of data bytes in a record, limited by the one byte count field
+    """
+    return 255 - (address_bits[rectype] >> 3) - 1
+
+
 def make_record(rectype: int, address: int, data: bytes or None = None) -> str:
     if data is None:
         data = b""
 
-    addr = f"{address:x}".rjust(address_bits[rectype] >> 2, "0")
-    count = (len(addr) >> 1) + len(data) + 1
-    rec = f"S{rectype:1d}{count:02x}{addr}{data.hex()}"
-    checksum = (reduce(lambda a, b: a + b, unhexlify(rec[2:])) % 256) ^ 255
-    reccs = f"{rec}{checksum:02x}\r\n"
-    return reccs
+    address_length = address_bits[rectype] >> 3
+    rec = bytes([address_length + len(data) + 1]) + address.to_bytes(address_length, "big") + data
+    checksum = ~sum(rec) & 255
+    return f"S{rectype:1d}{rec.hex()}{checksum:02x}\r\n"
+
+
+def chunk_records(records: Iterable[Tuple[int, bytes]], record_size: int) -> Iterable[Tuple[int, bytes]]:
+    """
+    Merge contiguous records and split them into chunks of `record_size` bytes
+    """
+    pending = bytearray()
+    pending_address = None
+    for address, data in records:
+        if pending_address is not None and address != pending_address + len(pending):
+            for offset in range(0, len(pending), record_size):
+                yield pending_address + offset, bytes(pending[offset:offset + record_size])
+            pending = bytearray()
+        if len(pending) == 0:
+            pending_address = address
+        pending += data
+        if len(pending) >= record_size:
+            full = len(pending) - len(pending) % record_size
+            for offset in range(0, full, record_size):
+                yield pending_address + offset, bytes(pending[offset:offset + record_size])
+            del pending[:full]
+            pending_address += full
+    for offset in range(0, len(pending), record_size):
+        yield pending_address + offset, bytes(pending[offset:offset + record_size])
 
 
 def make(address_bits: int, records: Iterable, name:str, version: int = 1, revision: int = 1,
-         comment: str = "thd74tool") -> Iterable[str]:
+         comment: str = "thd74tool", record_size: int or None = None) -> Iterable[str]:
         assert address_bits in [16, 24, 32]
         assert len(comment) <= 36
         # CAVE: we do not emit count records
@@ -46,7 +74,34 @@ def make(address_bits: int, records: Iterable, name:str, version: int = 1, revis
             24: (2, 8),
             32: (3, 7)
         }[address_bits]
+        if record_size is not None:
+            # Otherwise emit one data record per input record
+            assert 0 < record_size <= max_record_size(data_type)
+            records = chunk_records(records, record_size)
         for addr, data in records:
             yield make_record(data_type, addr, data)
         # CAVE: We do not know the start execution address for the termination record, defaulting to 0
         yield make_record(term_type, 0)
+
+
+def write(f, address_bits: int, records: Iterable, name: str, record_size: int or None = None,
+          buffer_size: int = 1 << 20, **kwargs) -> int:
+    """
+    Write SREC records to a text file in large batches
+    :param f: file object open for writing text
+    :param buffer_size: approximate number of characters per write
+    :return: number of characters written
+    """
+    written = 0
+    batch = []
+    batch_size = 0
+    for rec in make(address_bits, records, name, record_size=record_size, **kwargs):
+        batch.append(rec)
+        batch_size += len(rec)
+        if batch_size >= buffer_size:
+            written += f.write("".join(batch))
+            batch = []
+            batch_size = 0
+    if batch:
+        written += f.write("".join(batch))
+    return written
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from binascii import hexlify
+from random import Random
+from struct import pack
+from typing import List, Tuple
+
+from .binary import sections, updater_marker
+from .crypto import blob_schedule, encrypt_bytes
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+# Data bytes per record and records per block, as in Kenwood's updaters
+record_size = 16
+block_records = 4096
+
+
+def make_record(noun: int, verb: int, payload: bytes = b"") -> bytes:
+    """
+    Nibble-padded binary record, the plaintext form of one updater line
+    """
+    rec = bytes([len(payload), noun >> 8, noun & 255, verb]) + payload
+    return b"\x00" + rec + bytes([-sum(rec) % 256])
+
+
+def make_section_image(section: dict, size: int or None = None, seed: int = 0) -> bytes:
+    """
+    Random section contents carrying the section's marker and a version string
+    """
+    if size is None:
+        size = section["typical_length"]
+    image = bytearray(Random(f"{seed}-{section['name']}").getrandbits(8 * size).to_bytes(size, "little"))
+    if section["version_offset"] is not None:
+        version = b"1.00.00.00".ljust(section["version_length"], b" ")[:section["version_length"]]
+        image[section["version_offset"]:section["version_offset"] + len(version)] = version
+    image[section["marker_offset"]:section["marker_offset"] + len(section["marker_data"])] = section["marker_data"]
+    return bytes(image[:size])
+
+
+def make_blob(image: bytes, permute_offset: int, end_offset: int = 49) -> List[str]:
+    """
+    Encrypt a section image into updater blob lines: a header line for every
+    block of 4096 records, 16-byte data records and an end record.
+    """
+    records = []
+    for block, block_start in zip(range(len(image)), range(0, len(image), block_records * record_size)):
+        records.append(make_record(0, 4, pack(">H", block)))
+        block_end = min(block_start + block_records * record_size, len(image))
+        for pos in range(block_start, block_end, record_size):
+            records.append(make_record(pos & 0xffff, 0, image[pos:pos + record_size]))
+    records.append(make_record(0, 1))
+
+    lengths = [len(rec) for rec in records]
+    hex_lengths = [2 * length - 1 for length in lengths]
+    cipher = hexlify(encrypt_bytes(b"".join(records), blob_schedule(hex_lengths, permute_offset, end_offset),
+                                   lengths)).decode("ascii").upper()
+    lines = []
+    pos = 0
+    for length in lengths:
+        lines.append(cipher[pos + 1:pos + 2 * length])
+        pos += 2 * length
+    return lines
+
+
+def make_updater(sizes: List[int] or None = None, seed: int = 0) -> Tuple[bytes, List[bytes]]:
+    """
+    Fake firmware updater with all sections of the section table
+    :param sizes: section sizes in bytes, defaults to the typical lengths
+    :param seed: random seed for section contents
+    :return: (updater .exe contents, list of section images) tuple
+    """
+    if sizes is None:
+        sizes = [s["typical_length"] for s in sections]
+    lines = ["$THD74TOOL-SYNTHETIC-UPDATER"]
+    images = []
+    for section, size in zip(sections, sizes):
+        image = make_section_image(section, size, seed)
+        images.append(image)
+        lines += make_blob(image, section["permute_offset"], section["end_offset"])
+    payload = ("\r\n".join(lines) + "\r\n").encode("ascii")
+    exe = b"MZ" + bytes(126) + updater_marker + b"\x00" + pack("<L", len(payload)) + payload
+    return exe, images
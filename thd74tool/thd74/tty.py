@@ -50,6 +50,25 @@ class GenericTHDTTY(object):
         logger.debug("  IN: %s", repr(result))
         return result
 
+    def read_until(self, expected=b"\r", timeout=None):
+        """
+        Read up to and including `expected`, returning early once it arrived
+        :param timeout: float seconds for the whole read, default timeout if None
+        """
+        if timeout is not None:
+            self.s.timeout = timeout
+        try:
+            result = self.s.read_until(expected)
+        finally:
+            self.s.timeout = self.default_timeout
+        if len(result) == 0:
+            raise TimeoutError(f"{self.tty} read_until() timeout")
+        logger.debug("  IN: %s", repr(result))
+        return result
+
+    def close(self):
+        self.s.close()
+
     def available(self):
         return self.s.in_waiting
 